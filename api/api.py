@@ -16,6 +16,7 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import io
+import json
 import os
 import sys
 import traceback
@@ -23,11 +24,17 @@ import binascii
 
 import hug
 from celery import Celery
+from celery.backends.redis import RedisBackend
 from falcon import HTTP_400
+from redis import RedisError
 
 celery_broker_url = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379'),
 celery_result_backend = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379')
 CELERY = Celery('tasks', broker=celery_broker_url, backend=celery_result_backend)
+# Custom states of tasks with progress in their meta
+PROGRESS_STATES = ["SOLVING"]
+# Redis list of JSON lines of its output a running SSM task appends (SSM_STREAM_KEY of backend/tasks.py)
+SSM_STREAM_KEY = "mutation_maker:ssm:stream:{}"
 
 def init_api():
     api = hug.API(sys.modules[__name__])
@@ -101,6 +108,7 @@ def get_urls(task_id, export):
         "forget_url": f"/v1/forget/{task_id}",
         "cancel_url": f"/v1/cancel/{task_id}",
         "result_url": f"/v1/result/{task_id}",
+        "progress_url": f"/v1/progress/{task_id}",
         "export_url": f"/v1/{export}/{task_id}.xlsx",
     }
 
@@ -110,6 +118,27 @@ def check_task(task_id, hug_celery):
     return hug_celery.AsyncResult(task_id).state
 
 
+@hug.get('/progress/{task_id}', versions=1)
+def check_task_progress(task_id, hug_celery, start: hug.types.number = 0):
+    """
+    Return state of task, its meta (progress) while it is solving and the lines of its output
+    ("output" line, then "result" line of each mutation) from the index start appended so far
+    """
+    async_result = hug_celery.AsyncResult(task_id)
+    state = async_result.state
+    return {"state": state, "meta": async_result.info if state in PROGRESS_STATES else None,
+            "lines": [json.loads(line) for line in read_stream_lines(hug_celery, task_id, start)]}
+
+
+def read_stream_lines(celery_app, task_id, start):
+    if not isinstance(celery_app.backend, RedisBackend):
+        return []
+    try:
+        return celery_app.backend.client.lrange(SSM_STREAM_KEY.format(task_id), start, -1)
+    except RedisError:
+        return []
+
+
 @hug.get('/cancel/{task_id}', versions=1)
 def forget_task(task_id, hug_celery):
     hug_celery.AsyncResult(task_id).revoke(terminate=True)
@@ -118,6 +147,11 @@ def forget_task(task_id, hug_celery):
 @hug.get('/forget/{task_id}', versions=1)
 def forget_task(task_id, hug_celery):
     hug_celery.AsyncResult(task_id).forget()
+    if isinstance(hug_celery.backend, RedisBackend):
+        try:
+            hug_celery.backend.client.delete(SSM_STREAM_KEY.format(task_id))
+        except RedisError:
+            pass
 
 
 @hug.get('/result/{task_id}', versions=1)
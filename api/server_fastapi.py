@@ -18,14 +18,18 @@
 
 import io
 import os
+import json
+import time
 import traceback
 import binascii
-from typing import Any, Dict
+from typing import Any, Dict, Iterator, List
 
 from fastapi import FastAPI, HTTPException, Response
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from celery import Celery
+from celery.backends.redis import RedisBackend
+from redis import RedisError
 
 celery_broker_url = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379")
 celery_result_backend = os.environ.get(
@@ -35,6 +39,18 @@ CELERY = Celery("tasks", broker=celery_broker_url, backend=celery_result_backend
 
 app = FastAPI(title="Mutation Maker API", version="1.0.0")
 
+# Custom states of tasks with progress in their meta
+PROGRESS_STATES = ["SOLVING"]
+# Seconds between polls of the state of a streamed task
+STREAM_POLL_INTERVAL = 0.5
+# Seconds after which a stream of a task without any change of its state or progress is closed,
+# e.g. of an unknown (or forgotten) task Celery reports as PENDING
+STREAM_IDLE_TIMEOUT = float(os.environ.get("STREAM_IDLE_TIMEOUT", 900))
+# Seconds after which a stream is closed regardless of the progress of its task
+STREAM_TIMEOUT = float(os.environ.get("STREAM_TIMEOUT", 4 * 3600))
+# Redis list of JSON lines of its output a running SSM task appends (SSM_STREAM_KEY of backend/tasks.py)
+SSM_STREAM_KEY = "mutation_maker:ssm:stream:{}"
+
 
 class TaskBody(BaseModel):
     data: Any = {}
@@ -46,6 +62,8 @@ def get_urls(task_id: str, export: str) -> Dict[str, str]:
         "forget_url": f"/v1/forget/{task_id}",
         "cancel_url": f"/v1/cancel/{task_id}",
         "result_url": f"/v1/result/{task_id}",
+        "progress_url": f"/v1/progress/{task_id}",
+        "stream_url": f"/v1/stream/{task_id}",
         "export_url": f"/v1/{export}/{task_id}.xlsx",
     }
 
@@ -106,6 +124,7 @@ def cancel_task(task_id: str) -> None:
 @app.get("/v1/forget/{task_id}")
 def forget_task(task_id: str) -> None:
     CELERY.AsyncResult(task_id).forget()
+    delete_stream_lines(task_id)
 
 
 @app.get("/v1/result/{task_id}")
@@ -117,6 +136,95 @@ def check_task_result(task_id: str) -> Any:
         return async_result.traceback
 
 
+@app.get("/v1/progress/{task_id}")
+def check_task_progress(task_id: str, start: int = 0) -> Dict[str, Any]:
+    """
+    Returns state of the task, its meta (progress) while it is solving and the lines of its output
+    (see `stream_task`) from the index start appended so far, poll with start increased by their number.
+    """
+    async_result = CELERY.AsyncResult(task_id)
+    state = async_result.state
+    return {"state": state, "meta": async_result.info if state in PROGRESS_STATES else None,
+            "lines": [json.loads(line) for line in read_stream_lines(task_id, start)]}
+
+
+def read_stream_lines(task_id: str, start: int) -> List[str]:
+    """ Returns lines appended by a running SSM task from the index start, none without a Redis result backend """
+    if not isinstance(CELERY.backend, RedisBackend):
+        return []
+    try:
+        lines = CELERY.backend.client.lrange(SSM_STREAM_KEY.format(task_id), start, -1)
+    except RedisError:
+        return []
+    return [line.decode("utf-8") for line in lines]
+
+
+def delete_stream_lines(task_id: str) -> None:
+    if isinstance(CELERY.backend, RedisBackend):
+        try:
+            CELERY.backend.client.delete(SSM_STREAM_KEY.format(task_id))
+        except RedisError:
+            pass
+
+
+@app.get("/v1/stream/{task_id}")
+def stream_task(task_id: str) -> StreamingResponse:
+    """
+    Streams progress and results of a task as JSON lines: "progress" lines with the state and its meta,
+    an "output" line with the output without results and a "result" line for each result. Lines of the output
+    of a running SSM task are forwarded as soon as it appends them, otherwise they follow its success.
+    A failed task ends with a "failure" line with the traceback, a task finished otherwise (e.g. revoked)
+    with an "end" line with its state, a stream closed after STREAM_IDLE_TIMEOUT or STREAM_TIMEOUT
+    with a "timeout" line with the last state.
+    """
+    return StreamingResponse(stream_task_lines(task_id), media_type="application/x-ndjson")
+
+
+def result_lines(result: Any) -> List[str]:
+    if isinstance(result, dict) and "results" in result:
+        return [json.dumps({"type": "output", "output": dict(result, results=[])})] + \
+            [json.dumps({"type": "result", "result": mutation_result}) for mutation_result in result["results"]]
+    return [json.dumps({"type": "result", "result": result})]
+
+
+def stream_task_lines(task_id: str) -> Iterator[str]:
+    async_result = CELERY.AsyncResult(task_id)
+    last_progress = None
+    # Number of output lines sent, the result of the task ends with the same lines
+    sent = 0
+    started = last_change = time.monotonic()
+
+    while True:
+        if async_result.ready():
+            state = async_result.state
+            if state == "SUCCESS":
+                for line in result_lines(async_result.result)[sent:]:
+                    yield line + "\n"
+            elif state == "FAILURE":
+                yield json.dumps({"type": "failure", "traceback": async_result.traceback}) + "\n"
+            else:
+                yield json.dumps({"type": "end", "state": state}) + "\n"
+            return
+
+        state = async_result.state
+        meta = async_result.info if state in PROGRESS_STATES else None
+        progress = (state, meta or {})
+        lines = read_stream_lines(task_id, sent)
+        now = time.monotonic()
+        if progress != last_progress or lines:
+            if progress != last_progress:
+                last_progress = progress
+                yield json.dumps({"type": "progress", "state": state, **(meta or {})}) + "\n"
+            for line in lines:
+                yield line + "\n"
+            sent += len(lines)
+            last_change = now
+        elif now - last_change >= STREAM_IDLE_TIMEOUT or now - started >= STREAM_TIMEOUT:
+            yield json.dumps({"type": "timeout", "state": state}) + "\n"
+            return
+        time.sleep(STREAM_POLL_INTERVAL)
+
+
 @app.get("/v1/export_qclm/{task_id}.xlsx")
 def export_qclm(task_id: str) -> StreamingResponse:
     task = CELERY.send_task("tasks.export_qclm", args=[task_id])
@@ -15,7 +15,7 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from typing import NewType, Sequence, NamedTuple, Tuple, Iterable
+from typing import NewType, Sequence, NamedTuple, Tuple, Iterable, List
 
 AminoAcid = NewType('AminoAcid', str)
 
@@ -85,6 +85,26 @@ class PrimerSpec:
         return "".join([x[0] if x[0] == x[1] else "X"
                         for x in zip(original_sequence, mutated_sequence)])
 
+    def get_mismatch_positions(self, base: DNASequenceForMutagenesis) -> List[Offset]:
+        """
+        Get offsets of the primer bases, which differ from the DNA sequence, in ascending order.
+        These are the bases replaced by "X" in the mismatch sequence. Bases of a codon reaching
+        over the end of the primer are included too, so the offsets stay valid when the primer grows.
+        The primer must have codons for all mutation sites within its range.
+        """
+        dna_sequence, mutation_offsets = base
+        mutation_offsets = [o for o in mutation_offsets if self.offset <= o < self.offset + self.length]
+
+        assert len(mutation_offsets) == len(self.codons)
+
+        mutated_bases = {}
+        for mutation_offset, codon in zip(mutation_offsets, self.codons):
+            for i, codon_base in enumerate(codon):
+                mutated_bases[mutation_offset + i] = codon_base
+
+        return sorted(o for o, mutated_base in mutated_bases.items()
+                      if o < len(dna_sequence) and mutated_base != dna_sequence[o])
+
     def __key(self):
         return self.offset, self.length, self.codons
 
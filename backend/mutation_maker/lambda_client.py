@@ -18,51 +18,97 @@
 import boto3
 from botocore import UNSIGNED
 from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
 import json
 import os
+import random
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
 
 RUN_LAMBDA_LOCAL = os.getenv("RUN_LAMBDA_LOCAL", "0")
 RUN_LAMBDA_DOCKER = os.getenv("RUN_LAMBDA_DOCKER", "0")
+# Endpoint of the Lambda API (e.g. of a local stand-in), takes precedence over RUN_LAMBDA_LOCAL and RUN_LAMBDA_DOCKER
+LAMBDA_ENDPOINT_URL = os.getenv("LAMBDA_ENDPOINT_URL")
 
+# Maximum number of concurrent invocations of a worker process, shared by all its tasks
+LAMBDA_CONCURRENCY = int(os.getenv("LAMBDA_CONCURRENCY", "50"))
+# Number of attempts of an invocation failing with throttling, server, network or runtime errors
+LAMBDA_MAX_ATTEMPTS = int(os.getenv("LAMBDA_MAX_ATTEMPTS", "5"))
+# Seconds of the first backoff, doubled with each retry up to the maximum
+LAMBDA_BACKOFF_BASE = float(os.getenv("LAMBDA_BACKOFF_BASE", "0.5"))
+LAMBDA_BACKOFF_MAX = float(os.getenv("LAMBDA_BACKOFF_MAX", "20"))
+# Seconds to connect and to wait for the result of an invocation
+LAMBDA_CONNECT_TIMEOUT = float(os.getenv("LAMBDA_CONNECT_TIMEOUT", "10"))
+LAMBDA_TIMEOUT = float(os.getenv("LAMBDA_TIMEOUT", "900"))
+# Number of consecutive failed invocations opening the circuit, and seconds before an invocation is tried again
+LAMBDA_BREAKER_THRESHOLD = int(os.getenv("LAMBDA_BREAKER_THRESHOLD", "5"))
+LAMBDA_BREAKER_RESET = float(os.getenv("LAMBDA_BREAKER_RESET", "60"))
 
-def create_client():
-    if RUN_LAMBDA_LOCAL == "1":
+# Maximum number of Boulder-IO records and bytes of records packed in one invocation, 1 record per invocation
+# sends records as single string payloads. Lists need a function accepting them (lambda/deploy-package),
+# so batching is opt-in (e.g. 25)
+LAMBDA_BATCH_SIZE = int(os.getenv("LAMBDA_BATCH_SIZE", "1"))
+LAMBDA_BATCH_BYTES = int(os.getenv("LAMBDA_BATCH_BYTES", str(256 * 1024)))
+
+THROTTLING_ERROR_CODES = {"TooManyRequestsException", "ThrottlingException", "Throttling",
+                          "EC2ThrottledException"}
+# Function errors of the Lambda runtime and sandbox (e.g. "Runtime.ExitError" of an instance out of memory),
+# errors raised by the handler itself (e.g. RuntimeError) fail again with the same payload
+RETRYABLE_FUNCTION_ERROR_TYPE_PREFIXES = ("Runtime.", "Sandbox.")
+RETRYABLE_FUNCTION_ERROR_MESSAGES = ("Task timed out", "out of memory", "signal: killed")
+
+
+class LambdaInvocationError(Exception):
+    pass
+
+
+class LambdaFunctionError(LambdaInvocationError):
+    """ Raised without retrying when the handler of the function failed on the payload """
+    pass
+
+
+class LambdaUnavailableError(LambdaInvocationError):
+    """ Raised without invoking the function while the circuit breaker is open """
+    pass
+
+
+def create_client(endpoint_url: Optional[str] = None):
+    # Retries are left to LambdaInvoker
+    config = Config(max_pool_connections=LAMBDA_CONCURRENCY,
+                    connect_timeout=LAMBDA_CONNECT_TIMEOUT,
+                    read_timeout=LAMBDA_TIMEOUT,
+                    retries={"total_max_attempts": 1})
+
+    if endpoint_url is None:
+        endpoint_url = LAMBDA_ENDPOINT_URL
+    if endpoint_url is None and RUN_LAMBDA_LOCAL == "1":
         print("\nRunning client against LOCAL deployment of AWS Lambda.\n")
 
-        # Creates a client against a local instance of AWS Lambda
-        # created by SAM CLI running on localhost.
-        client = boto3.client('lambda',
-                              endpoint_url="http://localhost:3001",
-                              use_ssl=False,
-                              verify=False,
-                              config=Config(signature_version=UNSIGNED, max_pool_connections=200,
-                                            read_timeout=900))
-
-        return client
-    elif RUN_LAMBDA_DOCKER == "1":
+        # Local instance of AWS Lambda created by SAM CLI running on localhost.
+        endpoint_url = "http://localhost:3001"
+    elif endpoint_url is None and RUN_LAMBDA_DOCKER == "1":
         print("\nRunning client against DOCKER deployment of AWS Lambda.\n")
 
-        # Creates a client against a local instance of AWS Lambda
-        # created by SAM CLI running in `lambda` Docker Compose service.
-        client = boto3.client('lambda',
-                              endpoint_url="http://lambda:3001",
-                              use_ssl=False,
-                              verify=False,
-                              config=Config(signature_version=UNSIGNED, max_pool_connections=200,
-                                            read_timeout=900))
+        # Local instance of AWS Lambda created by SAM CLI running in `lambda` Docker Compose service.
+        endpoint_url = "http://lambda:3001"
 
-        return client
+    if endpoint_url is not None:
+        return boto3.client('lambda',
+                            endpoint_url=endpoint_url,
+                            region_name=os.getenv("AWS_DEFAULT_REGION", "us-east-1"),
+                            use_ssl=False,
+                            verify=False,
+                            config=config.merge(Config(signature_version=UNSIGNED)))
     else:
         print("\nRunning client against CLOUD deployment of AWS Lambda.\n")
-        client = boto3.client('lambda')
-
-        return client
+        return boto3.client('lambda', config=config)
 
 
 def invoke_design_primers(client, json_payload):
 
-    if RUN_LAMBDA_LOCAL == "1" or RUN_LAMBDA_DOCKER == "1":
+    if LAMBDA_ENDPOINT_URL or RUN_LAMBDA_LOCAL == "1" or RUN_LAMBDA_DOCKER == "1":
         function_name = "DesignPrimersFunction"
     else:
         function_name = os.environ.get('LAMBDA_FN_NAME', 'cyb-mutation-maker-primer3')
@@ -72,26 +118,251 @@ def invoke_design_primers(client, json_payload):
                          Payload=json_str.encode("ascii"))
 
 
-def invoke_multiple(payloads):
-    client = create_client()
+def create_payload_batches(records: List[str], groups: Optional[List[Hashable]] = None,
+                           max_records: Optional[int] = None, max_bytes: Optional[int] = None) -> List[List[int]]:
+    """
+    Packs records into batches of indexes of at most max_records records and max_bytes bytes (a larger record
+    is a batch of its own), LAMBDA_BATCH_SIZE and LAMBDA_BATCH_BYTES by default. Only records of the same group
+    (e.g. primer3 global tags) are packed together.
+    """
+    max_records = LAMBDA_BATCH_SIZE if max_records is None else max_records
+    max_bytes = LAMBDA_BATCH_BYTES if max_bytes is None else max_bytes
+    batches = []
+    open_batches: Dict[Hashable, Tuple[List[int], int]] = {}
+    for index, record in enumerate(records):
+        group = None if groups is None else groups[index]
+        size = len(record)
+        batch, batch_size = open_batches.get(group, (None, 0))
+        if batch is None or len(batch) >= max_records or batch_size + size > max_bytes:
+            batch, batch_size = [], 0
+            batches.append(batch)
+        batch.append(index)
+        open_batches[group] = (batch, batch_size + size)
+    return batches
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Semaphore of concurrent invocations whose limit is halved when Lambda throttles and raised by one
+    with each successful invocation (additive increase, multiplicative decrease) up to the maximum.
+    """
+
+    def __init__(self, maximum: int):
+        self.maximum = max(maximum, 1)
+        self.limit = self.maximum
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def throttled(self):
+        with self.condition:
+            self.limit = max(self.limit // 2, 1)
+
+    def succeeded(self):
+        with self.condition:
+            if self.limit < self.maximum:
+                self.limit += 1
+                self.condition.notify()
+
+
+class CircuitBreaker:
+    """
+    Opens after a number of consecutive failed invocations. While open, invocations fail immediately,
+    after reset_timeout seconds a single invocation is let through and closes the circuit if it succeeds.
+    """
+
+    def __init__(self, threshold: int = LAMBDA_BREAKER_THRESHOLD, reset_timeout: float = LAMBDA_BREAKER_RESET,
+                 clock: Callable[[], float] = time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at >= self.reset_timeout:
+                # Other invocations wait for the trial one
+                self.opened_at = self.clock()
+                return True
+            return False
 
-    # TODO: better way than 200 threads?
-    with ThreadPoolExecutor(max_workers=200) as executor:
-        futures = []
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
 
-        for payload in payloads:
-            print("CALL Primer3 AWS Lambda function")
-            futures.append(
-                executor.submit(invoke_design_primers, client, payload)
-            )
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = self.clock()
 
-        # TODO: For now we're assuming the calls succeed. However,
-        # AWS Lambda can fail, not just because of network errors,
-        # but also in case we use all the concurrency which is shared
-        # by all the lambda instances running under one AWS account.
-        results = [json.loads(future.result()["Payload"].read().decode("ascii"))
-                   for future in futures]
 
-        print("INVOKE_MULTIPLE DONE ...")
+def is_retryable_function_error(response_payload: str) -> bool:
+    """ Returns whether the function error of the response payload (errorType and errorMessage) is transient """
+    try:
+        error = json.loads(response_payload)
+    except ValueError:
+        return False
+    if not isinstance(error, dict):
+        return False
+    error_type = str(error.get("errorType", ""))
+    message = str(error.get("errorMessage", ""))
+    return error_type.startswith(RETRYABLE_FUNCTION_ERROR_TYPE_PREFIXES) or \
+        any(text in message for text in RETRYABLE_FUNCTION_ERROR_MESSAGES)
+
+
+class _RetryableError(Exception):
+    def __init__(self, message: str, throttled: bool = False):
+        super().__init__(message)
+        self.throttled = throttled
+
+
+class LambdaInvoker:
+    """
+    Invokes the primer3 Lambda function with a bounded number of concurrent invocations shared by all calls
+    of the process. Throttled invocations, server, network and function errors are retried with exponential
+    backoff with full jitter. Consecutive failures open the circuit breaker, so that callers can fall back
+    to designing primers locally instead of waiting for an unavailable function.
+    """
+
+    def __init__(self, client_factory: Callable = create_client, concurrency: int = LAMBDA_CONCURRENCY,
+                 max_attempts: int = LAMBDA_MAX_ATTEMPTS, backoff_base: float = LAMBDA_BACKOFF_BASE,
+                 backoff_max: float = LAMBDA_BACKOFF_MAX, breaker: Optional[CircuitBreaker] = None,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.client_factory = client_factory
+        self.concurrency = max(concurrency, 1)
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.sleep = sleep
+        self.limit = AdaptiveConcurrencyLimit(self.concurrency)
+        self._client = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _ensure_process_resources(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Clients and threads of the parent are not usable after fork
+                self._client = self.client_factory()
+                self._executor = ThreadPoolExecutor(self.concurrency)
+                self._pid = os.getpid()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def invoke(self, payload) -> Any:
+        """
+        Returns result of the function decoded from JSON (Boulder-IO output of a string payload, list of outputs
+        of a list payload, but not checked), raises LambdaInvocationError when all attempts failed
+        or the error is not retryable, LambdaUnavailableError when the circuit is open.
+        """
+        if not self.breaker.allow():
+            raise LambdaUnavailableError("Primer3 AWS Lambda function is unavailable")
+        self._ensure_process_resources()
+
+        for attempt in range(self.max_attempts):
+            try:
+                result = self._invoke_once(payload)
+            except _RetryableError as e:
+                if e.throttled:
+                    self.limit.throttled()
+                error = e
+            except LambdaFunctionError:
+                # Function is available, the payload is not designable
+                self.breaker.record_success()
+                raise
+            except Exception as e:
+                self.breaker.record_failure()
+                raise LambdaInvocationError(f"Primer3 AWS Lambda function failed: {e}") from e
+            else:
+                self.limit.succeeded()
+                self.breaker.record_success()
+                return result
+
+            if attempt + 1 < self.max_attempts:
+                self.sleep(self.backoff(attempt))
+
+        self.breaker.record_failure()
+        raise LambdaInvocationError(f"Primer3 AWS Lambda function failed {self.max_attempts} times: {error}")
+
+    def _invoke_once(self, payload) -> Any:
+        self.limit.acquire()
+        try:
+            response = invoke_design_primers(self._client, payload)
+            response_payload = response["Payload"].read().decode("ascii")
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+            if code in THROTTLING_ERROR_CODES or status == 429:
+                raise _RetryableError(str(e), throttled=True)
+            if status >= 500:
+                raise _RetryableError(str(e))
+            raise
+        except (ConnectionError, HTTPClientError) as e:
+            # Includes connect and read timeouts
+            raise _RetryableError(str(e))
+        finally:
+            self.limit.release()
+
+        if response.get("FunctionError"):
+            message = f"{response['FunctionError']} function error: {response_payload}"
+            if is_retryable_function_error(response_payload):
+                # E.g. timed out or out of memory instance
+                raise _RetryableError(message)
+            raise LambdaFunctionError(f"Primer3 AWS Lambda function failed: {message}")
+        return json.loads(response_payload)
+
+    def try_invoke(self, payload) -> Optional[Any]:
+        try:
+            return self.invoke(payload)
+        except LambdaInvocationError as e:
+            print(e)
+            return None
+
+    def invoke_multiple(self, payloads) -> List[Optional[Any]]:
+        """ Returns decoded results (see `invoke`) of the payloads in their order, None for the failed invocations """
+        self._ensure_process_resources()
+        return list(self._executor.map(self.try_invoke, payloads))
+
+
+_lambda_invoker: Optional[LambdaInvoker] = None
+
+
+def get_lambda_invoker() -> LambdaInvoker:
+    """ Returns invoker shared by all calls of the process """
+    global _lambda_invoker
+    if _lambda_invoker is None:
+        _lambda_invoker = LambdaInvoker()
+    return _lambda_invoker
+
+
+def invoke_multiple(payloads):
+    results = get_lambda_invoker().invoke_multiple(payloads)
+    if any(result is None for result in results):
+        raise LambdaInvocationError("Primer3 AWS Lambda function failed for {} of {} payloads"
+                                    .format(sum(result is None for result in results), len(results)))
+
+    print("INVOKE_MULTIPLE DONE ...")
 
-        return results
\ No newline at end of file
+    return results
@@ -109,10 +109,11 @@ def compute_tm_distances(gene: DNASequenceForMutagenesis, temp_calculator: Tempe
     :return: [int] list of melting temperatures for sequences between mutation sites
     """
     to_ret = []
+    sequence_temp = temp_calculator.for_sequence(gene.sequence)
     for i in range(len(gene.mutation_sites) - 1):
         _from = gene.mutation_sites[i]+3
         _to = gene.mutation_sites[i + 1]
-        to_ret.append(temp_calculator(gene.sequence[_from:_to]))
+        to_ret.append(sequence_temp(_from, _to))
     return to_ret
 
 ######################################################################################################################
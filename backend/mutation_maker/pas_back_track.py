@@ -23,10 +23,12 @@ import sys
 import time
 from typing import Dict, Optional, Tuple, List
 
+import numpy as np
+
 from mutation_maker.basic_types import Offset
 from mutation_maker.pas_solution import PASSolution, PASFragment, PASProtoFragment, compute_solution_score, pas_fragment_score
 from mutation_maker.pas_types import PASConfig
-from primer3 import calcHairpin, calcHomodimer
+from mutation_maker.temperature_calculator import calc_thermo_batch
 
 
 class PASOptimizer:
@@ -117,31 +119,38 @@ class PASOptimizer:
         divalent_conc = self.config.temperature_config.mg
         dntp_conc = self.config.temperature_config.dntp
 
+        # Thermodynamics of all segments of one length are computed in a batch
         hairpin_segments = []
         for length in hairpin_lengths:
-            for start in range(0, self.gene_length - length):
+            starts = range(0, self.gene_length - length)
+            thermo_results = calc_thermo_batch("hairpin", [self.gene[start:start + length - 1] for start in starts],
+                                               monovalent_conc, divalent_conc, dntp_conc)
+            for start, tm, structure_found in zip(starts, thermo_results.tm.tolist(),
+                                                  thermo_results.structure_found.tolist()):
                 end = start + length - 1
-                thermo_result = calcHairpin(self.gene[start:end], monovalent_conc, divalent_conc, dntp_conc)
-                if self._is_new_hairpin_or_homodimer(start, end, thermo_result, hairpin_segments):
-                    hairpin_segments.append((start, end, thermo_result.tm))
+                if self._is_new_hairpin_or_homodimer(start, end, tm, structure_found, hairpin_segments):
+                    hairpin_segments.append((start, end, tm))
 
         homodimer_segments = []
         for length in homodimer_lengths:
-            for start in range(0, self.gene_length - length, homodimer_offset_step):
+            starts = range(0, self.gene_length - length, homodimer_offset_step)
+            thermo_results = calc_thermo_batch("homodimer", [self.gene[start:start + length - 1] for start in starts],
+                                               monovalent_conc, divalent_conc, dntp_conc)
+            for start, tm, structure_found in zip(starts, thermo_results.tm.tolist(),
+                                                  thermo_results.structure_found.tolist()):
                 end = start + length - 1
-                thermo_result = calcHomodimer(self.gene[start:end], monovalent_conc, divalent_conc, dntp_conc)
-                if thermo_result.structure_found:
-                    if self._is_new_hairpin_or_homodimer(start, end, thermo_result, hairpin_segments):
-                        homodimer_segments.append((start, end, thermo_result.tm))
+                if structure_found:
+                    if self._is_new_hairpin_or_homodimer(start, end, tm, structure_found, hairpin_segments):
+                        homodimer_segments.append((start, end, tm))
 
         return hairpin_segments + homodimer_segments
 
-    def _is_new_hairpin_or_homodimer(self, start, end, thermo_result, segments):
+    def _is_new_hairpin_or_homodimer(self, start, end, tm, structure_found, segments):
         """
         Does (start, end) represent a region forming a hairpin/homodimer, which is not already covered in the 'segments' list?
         """
-        if thermo_result.structure_found:
-            if thermo_result.tm > self.init_solution.tm - self.config.safe_temp_difference:
+        if structure_found:
+            if tm > self.init_solution.tm - self.config.safe_temp_difference:
                 return len([s for s in segments if s[0] >= start and s[1] <= end]) == 0
         else:
             return False
@@ -367,13 +376,14 @@ class PASOptimizer:
         max_overlap_offset = last_bp_offset - self.init_solution.config.min_overlap_length
 
         # Find the shortest overlap with Tm > self.tm
-        overlap_offset = max_overlap_offset
-        while self.init_solution.temp_calculator(self.init_solution.gene.sequence[overlap_offset:last_bp_offset]) <= self.init_solution.tm \
-                and overlap_offset >= min_overlap_offset:
-            overlap_offset -= 1
+        sequence_temp = self.init_solution.temp_calculator.for_sequence(self.init_solution.gene.sequence)
+        overlap_offsets = np.arange(max_overlap_offset, min_overlap_offset - 1, -1)
+        index = sequence_temp.first_reaching(overlap_offsets, last_bp_offset, self.init_solution.tm, strict=True)
+        if index is None:
+            return None
 
-        if overlap_offset >= min_overlap_offset \
-                and self.init_solution.temp_calculator(self.init_solution.gene.sequence[overlap_offset:last_bp_offset]) <= self.init_solution.config.temp_range_size + self.init_solution.tm:
+        overlap_offset = int(overlap_offsets[index])
+        if sequence_temp(overlap_offset, last_bp_offset) <= self.init_solution.config.temp_range_size + self.init_solution.tm:
             return overlap_offset
         else:
             return None
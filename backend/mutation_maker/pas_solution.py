@@ -18,6 +18,9 @@
 from math import sqrt
 from typing import List, Set, Tuple, Optional
 from dataclasses import dataclass
+
+import numpy as np
+
 from mutation_maker.basic_types import Offset, DNASequenceForMutagenesis
 from mutation_maker.pas_types import PASConfig, PASMutationSite
 
@@ -126,17 +129,19 @@ def fragment_constraints(
         )
 
     # Extend the fragment sequence in the direction to the start of the gene, until the overlap reaches Tmin
-    calculator = config.temperature_config.create_calculator()
-    while calculator(gene.sequence[max_start:mut_start]) < t_min:
-        max_start -= 1
-        if max_start < min_start:
-            return False, FragmentConstraints(min_start, max_start, min_end, max_end)
+    sequence_temp = config.temperature_config.create_calculator().for_sequence(gene.sequence)
+    starts = np.arange(max_start, min_start - 1, -1)
+    index = sequence_temp.first_reaching(starts, mut_start, t_min)
+    if index is None:
+        return False, FragmentConstraints(min_start, min_start - 1, min_end, max_end)
+    max_start = int(starts[index])
 
     # The same for the overlap after the fragment
-    while calculator(gene.sequence[mut_end:min_end]) < t_min:
-        min_end += 1
-        if min_end > max_end:
-            return False, FragmentConstraints(min_start, max_start, min_end, max_end)
+    ends = np.arange(min_end, max_end + 1)
+    index = sequence_temp.first_reaching(mut_end, ends, t_min)
+    if index is None:
+        return False, FragmentConstraints(min_start, max_start, max_end + 1, max_end)
+    min_end = int(ends[index])
 
     return True, FragmentConstraints(min_start, max_start, min_end, max_end)
 
@@ -15,7 +15,9 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from typing import Sized, Tuple
+from typing import Sized, Tuple, Sequence, Dict, Optional
+
+import numpy as np
 
 try:
     from Bio.SeqUtils import GC
@@ -237,3 +239,84 @@ class Primer(Sized):
             raise ValueError("Length must be greater than zero")
         if not Primer.is_end_in_sequence(parent_sequence, direction, start, length):
             raise ValueError("Primer end is not in sequence")
+
+
+# Directions of primers in a PrimerTable are indexes into this list
+PRIMER_DIRECTIONS = [Primer.FORWARD, Primer.REVERSE]
+
+
+class PrimerTable(Sequence[Primer]):
+    """
+    Primers of a parent sequence stored as columns of arrays, directions are indexes into PRIMER_DIRECTIONS.
+    Unlike Primer, the table doesn't copy primer sequences out of the parent sequence.
+    A Primer is created when it's accessed for the first time, so that filtering large tables
+    doesn't create primers which are thrown away.
+    """
+
+    __slots__ = ("parent_sequence", "starts", "lengths", "directions", "normal_starts", "normal_ends", "_primers")
+
+    def __init__(self, parent_sequence: str, starts: np.ndarray, lengths: np.ndarray, directions: np.ndarray,
+                 primers: Optional[Dict[int, Primer]] = None) -> None:
+        self.parent_sequence = parent_sequence
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.directions = np.asarray(directions, dtype=np.int8)
+
+        is_reverse = self.directions == PRIMER_DIRECTIONS.index(Primer.REVERSE)
+        self.normal_starts = np.where(is_reverse, self.starts - self.lengths + 1, self.starts)
+        self.normal_ends = np.where(is_reverse, self.starts + 1, self.starts + self.lengths)
+
+        # Primers already created, by their index
+        self._primers = primers if primers is not None else {}
+
+    @staticmethod
+    def from_primers(parent_sequence: str, primers: Sequence[Primer]) -> "PrimerTable":
+        """ Table of already created primers of the parent sequence """
+        if isinstance(primers, PrimerTable):
+            return primers
+        return PrimerTable(parent_sequence,
+                           np.fromiter((primer.start for primer in primers), dtype=np.int64, count=len(primers)),
+                           np.fromiter((primer.length for primer in primers), dtype=np.int64, count=len(primers)),
+                           np.fromiter((PRIMER_DIRECTIONS.index(primer.direction) for primer in primers),
+                                       dtype=np.int8, count=len(primers)),
+                           dict(enumerate(primers)))
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __getitem__(self, index: int) -> Primer:
+        if not -len(self) <= index < len(self):
+            raise IndexError("Primer table index out of range")
+        index %= len(self)
+        primer = self._primers.get(index)
+        if primer is None:
+            primer = Primer(self.parent_sequence, PRIMER_DIRECTIONS[self.directions[index]],
+                            self.starts[index].item(), self.lengths[index].item())
+            self._primers[index] = primer
+        return primer
+
+    def is_reverse(self) -> np.ndarray:
+        return self.directions == PRIMER_DIRECTIONS.index(Primer.REVERSE)
+
+    def select(self, indexes: np.ndarray) -> "PrimerTable":
+        """ Table of primers at the given indexes or boolean mask """
+        indexes = np.flatnonzero(indexes) if indexes.dtype == bool else indexes
+        primers = {new_index: self._primers[index] for new_index, index in enumerate(indexes.tolist())
+                   if index in self._primers} if self._primers else None
+        return PrimerTable(self.parent_sequence, self.starts[indexes], self.lengths[indexes],
+                           self.directions[indexes], primers)
+
+    def get_three_end_sizes_from_mutation(self, mutation: AminoMutation) -> np.ndarray:
+        """ Same as Primer.get_three_end_size_from_mutation of each primer """
+        return np.where(self.is_reverse(), mutation.position - self.normal_starts,
+                        self.normal_ends - mutation.position - mutation.length)
+
+    def get_five_end_sizes_from_mutation(self, mutation: AminoMutation) -> np.ndarray:
+        """ Same as Primer.get_five_end_size_from_mutation of each primer """
+        return np.where(self.is_reverse(), self.normal_ends - mutation.position - mutation.length,
+                        mutation.position - self.normal_starts)
+
+    def get_three_end_bounds_with_sizes(self, sizes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Start and end positions in the parent sequence of Primer.get_three_end_with_size of each primer """
+        starts = np.where(self.is_reverse(), self.normal_starts, self.normal_ends - sizes)
+        return starts, starts + sizes
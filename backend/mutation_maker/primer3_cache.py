@@ -0,0 +1,264 @@
+#    Copyright (c) 2020 Merck Sharp & Dohme Corp. a subsidiary of Merck & Co., Inc., Kenilworth, NJ, USA.
+#
+#    This file is part of the Mutation Maker, An Open Source Oligo Design Software For Mutagenesis and De Novo Gene Synthesis Experiments.
+#
+#    Mutation Maker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from .primer import Primer
+from .primer3_interoperability import PrimerGenerator, _formatBoulderIO
+
+# Default maximum number of designed records kept in memory
+DEFAULT_PRIMER3_CACHE_SIZE = 1000
+# Version of cached values, part of every key so that changed formats don't collide
+PRIMER3_CACHE_VERSION = "1"
+
+
+def primer3_record_key(primer3_config) -> str:
+    """
+    Returns content address of the Boulder-IO record of the config. Tags are sorted, so that the same settings
+    set in a different order share the result. Path of thermodynamic parameters is local to the designer.
+    """
+    config = {tag: value for tag, value in sorted(primer3_config.config.items())
+              if tag != "PRIMER_THERMODYNAMIC_PARAMETERS_PATH"}
+    record = PRIMER3_CACHE_VERSION + "\n" + _formatBoulderIO(config)
+    return hashlib.sha256(record.encode("ascii")).hexdigest()
+
+
+def serialize_primers(primers: Iterable[Primer]) -> str:
+    return json.dumps([[primer.direction, int(primer.start), int(primer.length)] for primer in primers])
+
+
+def deserialize_primers(template: str, value: str) -> List[Primer]:
+    return [Primer(template, direction, start, length) for direction, start, length in json.loads(value)]
+
+
+class Primer3ResultStore(ABC):
+    """
+    Shared tier of designed records behind the in-memory cache. Stores are best effort,
+    their errors only cause records to be designed again.
+    """
+
+    @abstractmethod
+    def get_many(self, keys: Sequence[str]) -> Dict[str, str]:
+        pass
+
+    @abstractmethod
+    def put_many(self, values: Dict[str, str]):
+        pass
+
+
+class Primer3DiskStore(Primer3ResultStore):
+    """
+    Designed records in an SQLite database shared by all processes using the same file.
+    Each process opens its own connection (also after fork), database runs in WAL mode.
+    """
+
+    def __init__(self, path: str, timeout: float = 10.0):
+        self.path = path
+        self.timeout = timeout
+        self.connection = None
+        self.pid = None
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self.pid != os.getpid():
+            # Connections must not be shared with forked children
+            self.connection = None
+            self.pid = os.getpid()
+            try:
+                connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS primer3_results ("
+                                   "key TEXT NOT NULL PRIMARY KEY, primers TEXT NOT NULL) WITHOUT ROWID")
+                connection.commit()
+                self.connection = connection
+            except sqlite3.Error as e:
+                print("Cannot open primer3 result store {}: {}".format(self.path, e))
+        return self.connection
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, str]:
+        connection = self._connect()
+        if connection is None or not keys:
+            return {}
+        values = {}
+        try:
+            # Number of SQL variables of a statement is limited
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = connection.execute("SELECT key, primers FROM primer3_results WHERE key IN ({})"
+                                          .format(",".join("?" * len(chunk))), chunk).fetchall()
+                values.update(rows)
+        except sqlite3.Error:
+            return {}
+        return values
+
+    def put_many(self, values: Dict[str, str]):
+        connection = self._connect()
+        if connection is None or not values:
+            return
+        try:
+            with connection:
+                connection.executemany("INSERT OR IGNORE INTO primer3_results VALUES (?, ?)", values.items())
+        except sqlite3.Error as e:
+            print("Cannot write to primer3 result store {}: {}".format(self.path, e))
+
+
+class Primer3RedisStore(Primer3ResultStore):
+    """
+    Designed records in Redis shared by all workers, entries expire after ttl seconds (never if None).
+    """
+
+    def __init__(self, url: str, ttl: Optional[int] = None, prefix: str = "mutation_maker:primer3:"):
+        import redis
+
+        self.redis_errors = redis.RedisError
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, str]:
+        if not keys:
+            return {}
+        try:
+            values = self.client.mget([self.prefix + key for key in keys])
+        except self.redis_errors as e:
+            print("Cannot read primer3 results from Redis: {}".format(e))
+            return {}
+        return {key: value.decode("ascii") for key, value in zip(keys, values) if value is not None}
+
+    def put_many(self, values: Dict[str, str]):
+        if not values:
+            return
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            for key, value in values.items():
+                pipeline.set(self.prefix + key, value, ex=self.ttl)
+            pipeline.execute()
+        except self.redis_errors as e:
+            print("Cannot write primer3 results to Redis: {}".format(e))
+
+
+class Primer3ResultCache:
+    """
+    Least recently used cache of designed records keyed by `primer3_record_key`. Records missing in memory
+    are looked up in the stores in their order, values found in a later store are copied to earlier tiers.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_PRIMER3_CACHE_SIZE, stores: Sequence[Primer3ResultStore] = ()):
+        self.max_size = max_size
+        self.stores = list(stores)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        values = {}
+        missing = []
+        for key in keys:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                values[key] = value
+            else:
+                missing.append(key)
+        self.hits += len(values)
+
+        for i, store in enumerate(self.stores):
+            if not missing:
+                break
+            found = store.get_many(missing)
+            for earlier_store in self.stores[:i]:
+                earlier_store.put_many(found)
+            for key, value in found.items():
+                self._insert(key, value)
+            values.update(found)
+            self.store_hits += len(found)
+            missing = [key for key in missing if key not in found]
+
+        self.misses += len(missing)
+        return values
+
+    def put_many(self, values: Dict[str, str]):
+        for key, value in values.items():
+            self._insert(key, value)
+        for store in self.stores:
+            store.put_many(values)
+
+    def _insert(self, key: str, value: str):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "store_hits": self.store_hits, "misses": self.misses,
+                "size": len(self.entries)}
+
+
+class CachedPrimerGenerator(PrimerGenerator):
+    """
+    Designs primers of records missing in the cache with the wrapped generator (e.g. primer3 on AWS Lambda),
+    so that records of unchanged plasmid, flanking primers and search area are not designed again.
+    """
+
+    def __init__(self, generator: PrimerGenerator, cache: Primer3ResultCache):
+        self.generator = generator
+        self.cache = cache
+
+    def design_primers(self, primer3_config) -> List[Primer]:
+        return self.design_primers_for_all_mutations([primer3_config])[0]
+
+    def design_primers_for_all_mutations(self, config_list) -> List[List[Primer]]:
+        keys = [primer3_record_key(config) for config in config_list]
+        cached = self.cache.get_many(OrderedDict.fromkeys(keys))
+
+        # Same records of a batch are designed once
+        missing: Dict[str, int] = OrderedDict()
+        for index, key in enumerate(keys):
+            if key not in cached:
+                missing.setdefault(key, index)
+        designed_by_key = {}
+        if missing:
+            designed = self.generator.design_primers_for_all_mutations([config_list[i] for i in missing.values()])
+            designed_by_key = dict(zip(missing, designed))
+            self.cache.put_many({key: serialize_primers(primers) for key, primers in designed_by_key.items()})
+
+        results = []
+        for index, (config, key) in enumerate(zip(config_list, keys)):
+            if missing.get(key) == index:
+                results.append(designed_by_key[key])
+            elif key in designed_by_key:
+                results.append(list(designed_by_key[key]))
+            else:
+                results.append(deserialize_primers(config.get_template(), cached[key]))
+        return results
@@ -15,16 +15,24 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
 import os
+import select
+import shutil
 import subprocess
+import threading
+import warnings
 from abc import abstractmethod, ABC
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence, Optional, Dict, Tuple, FrozenSet
 
 from collections import OrderedDict
 
-from .lambda_client import invoke_design_primers, invoke_multiple
-from .primer import Primer
+import numpy as np
+import primer3
+
+from .lambda_client import LambdaInvocationError, LAMBDA_BATCH_SIZE, create_payload_batches, get_lambda_invoker
+from .primer import Primer, PrimerTable, PRIMER_DIRECTIONS
+from .process_pool import create_process_pool, in_pool_worker
 
 
 def _formatBoulderIO(primer3_config, terminate=True):
@@ -57,15 +65,8 @@ def parse_primers(raw_primers) -> List[Primer]:
     return forward + reverse
 
 
-def parse_primers_from_generator(raw_primers) -> List[Primer]:
-    all_primers = []
-    splitted = raw_primers.split("\n")
-    template = splitted[0]
-    all_raw_primers = splitted[1:]
-    for raw_primer in all_raw_primers:
-        direction, start, length = raw_primer.split(",")
-        all_primers.append(Primer(template, direction, int(start), int(length)))
-    return all_primers
+# Primer candidates, start, length and direction (index into PRIMER_DIRECTIONS) as in the Primer constructor
+PRIMER_CANDIDATE_DTYPE = np.dtype([("start", np.int64), ("length", np.int64), ("direction", np.int8)])
 
 
 def extract_primer_position(raw_value):
@@ -89,13 +90,18 @@ def parse_primers_in_direction(raw_primers, direction) -> List[Primer]:
     return [Primer(parent_sequence, primer_direction, start, length) for start, length in positions]
 
 
+def primer3_global_tags(primer3_config) -> FrozenSet[str]:
+    """ Tags primer3_core keeps set for the following records of its input """
+    return frozenset(tag for tag in primer3_config.config if not tag.startswith("SEQUENCE_"))
+
+
 class PrimerGenerator(ABC):
     @abstractmethod
-    def design_primers(self, primer3_config) -> List[Primer]:
+    def design_primers(self, primer3_config) -> Sequence[Primer]:
         pass
 
     @abstractmethod
-    def design_primers_for_all_mutations(self, config_list) -> List[List[Primer]]:
+    def design_primers_for_all_mutations(self, config_list) -> List[Sequence[Primer]]:
         pass
 
 
@@ -108,48 +114,61 @@ class NullPrimerGenerator(PrimerGenerator):
 
 
 class AllPrimerGenerator(PrimerGenerator):
-    def design_primers(self, primer3_config) -> List[Primer]:
-        direction = primer3_config.get_direction()
-
-        if direction == Primer.FORWARD:
-            result = self.design_all_primers_in_direction(
-                primer3_config, lambda start, length: start)
-        elif direction == Primer.REVERSE:
-            result = self.design_all_primers_in_direction(
-                primer3_config, lambda start, length: start + length - 1)
-        else:
-            raise RuntimeError(f"Invalid value of {primer3_config.get_direction()}")
+    def design_primers(self, primer3_config) -> PrimerTable:
+        candidates = self.design_primer_candidates(primer3_config)
+        return PrimerTable(primer3_config.get_template(),
+                           candidates["start"], candidates["length"], candidates["direction"])
 
-        # Generate DNA sequences for primers from their direction, position and length
-        # specifications.
-        return parse_primers_from_generator(result)
-
-    def design_primers_for_all_mutations(self, config_list) -> List[List[Primer]]:
+    def design_primers_for_all_mutations(self, config_list) -> List[PrimerTable]:
         return [self.design_primers(config) for config in config_list]
 
-    # Params:
-    # start_generator: A function that sets the start position for the primer.
-    # Output:
-    # Specification of primers a a string
-    # "{direction, start_position, length}*"
-    def design_all_primers_in_direction(self, primer3_config, start_generator):
+    def design_primer_candidates(self, primer3_config) -> np.ndarray:
+        """
+        Returns all primers of the search area and length range of the config as a structured array
+        of PRIMER_CANDIDATE_DTYPE, ordered by length and position.
+        """
         template = primer3_config.get_template()
         direction = primer3_config.get_direction()
         search_area_start, search_area_len = primer3_config.get_search_area()
         min_len, max_len = primer3_config.get_primer_length_range()
 
-        all_primers = [template]
-        for primer_length in range(min_len, max_len + 1):
-            for start in range(search_area_start,
-                               search_area_start + search_area_len - primer_length):
-                start_position = start_generator(start, primer_length)
-                all_primers.append(f"{direction},{start_position},{primer_length}")
+        if direction not in PRIMER_DIRECTIONS:
+            raise RuntimeError(f"Invalid value of {primer3_config.get_direction()}")
 
-        return "\n".join(all_primers)
+        starts = []
+        lengths = []
+        for primer_length in range(min_len, max_len + 1):
+            primer_starts = np.arange(search_area_start, search_area_start + search_area_len - primer_length)
+            if direction == Primer.REVERSE:
+                # Reverse primers start at their 3' end
+                primer_starts += primer_length - 1
+            starts.append(primer_starts)
+            lengths.append(np.full(len(primer_starts), primer_length))
+
+        candidates = np.zeros(sum(len(primer_starts) for primer_starts in starts), dtype=PRIMER_CANDIDATE_DTYPE)
+        if len(candidates) == 0:
+            return candidates
+        candidates["start"] = np.concatenate(starts)
+        candidates["length"] = np.concatenate(lengths)
+        candidates["direction"] = PRIMER_DIRECTIONS.index(direction)
+
+        # Validation of Primer constructor of all candidates at once
+        primers = PrimerTable(template, candidates["start"], candidates["length"], candidates["direction"])
+        if candidates["start"].min() < 0 or candidates["start"].max() >= len(template):
+            raise ValueError("Primer start is not in sequence")
+        if primers.normal_starts.min() < 0 or primers.normal_ends.max() > len(template):
+            raise ValueError("Primer end is not in sequence")
+
+        return candidates
 
 
 class Primer3(PrimerGenerator):
-    def __init__(self, primer3_path=None):
+    """
+    Designs primers with primer3 on AWS Lambda. Configs the Lambda function fails to design (or all configs
+    while its circuit breaker is open) are designed by the fallback generator, by primer3_core if not set.
+    """
+
+    def __init__(self, primer3_path=None, lambda_fallback: Optional[PrimerGenerator] = None):
         if primer3_path is None:
             if not os.environ.get("PRIMER3HOME"):
                 raise Exception("""Primer 3 path is not set - must be passed as parameter or set \
@@ -161,19 +180,56 @@ as environment variable PRIMER3HOME""")
         self.binary = os.path.join(primer3_base_path, 'primer3_core')
         self.thermodynamic_parameters_path = os.path.join(
             primer3_base_path, 'primer3_config/')
+        self.lambda_fallback = lambda_fallback
 
     def design_primers_for_all_mutations(self, config_list) -> List[List[Primer]]:
         return self.design_multiple_lambda_primers(config_list)
 
     def design_multiple_lambda_primers(self, configs):
         str_configs = [self.create_raw_primer3_input_string(config) for config in configs]
-        results = invoke_multiple(str_configs)
-        return [parse_primers(_parseBoulderIO(result)) for result in results]
+        batches = create_payload_batches(str_configs, [primer3_global_tags(config) for config in configs])
+        if LAMBDA_BATCH_SIZE <= 1:
+            payloads = [str_configs[batch[0]] for batch in batches]
+        else:
+            payloads = [[str_configs[i] for i in batch] for batch in batches]
+        results = get_lambda_invoker().invoke_multiple(payloads)
+
+        designed = [None] * len(configs)
+        failed = []
+        for batch, payload, result in zip(batches, payloads, results):
+            # Results must match the protocol of the payload, e.g. a function not accepting lists echoes them
+            if isinstance(payload, str):
+                outputs = [result] if isinstance(result, str) else None
+            elif isinstance(result, list) and all(isinstance(output, str) for output in result):
+                outputs = result
+            else:
+                outputs = None
+            if outputs is None or len(outputs) != len(batch):
+                failed.extend(batch)
+                continue
+            for i, output in zip(batch, outputs):
+                raw_primers = _parseBoulderIO(output)
+                # Outputs of batches leave out the template of the record
+                if "SEQUENCE_TEMPLATE" not in raw_primers:
+                    raw_primers["SEQUENCE_TEMPLATE"] = configs[i].get_template()
+                designed[i] = parse_primers(raw_primers)
+
+        if failed:
+            failed.sort()
+            print("Designing {} of {} configs locally".format(len(failed), len(configs)))
+            for i, primers in zip(failed, self.design_lambda_fallback_primers([configs[i] for i in failed])):
+                designed[i] = primers
+        return designed
 
     def design_lambda_primers(self, primer3_config):
-        aws_response = invoke_design_primers(self.create_raw_primer3_input_string(primer3_config))
-        aws_json = json.loads(aws_response["Payload"].read().decode("ascii"))
-        return parse_primers(_parseBoulderIO(aws_json))
+        return self.design_multiple_lambda_primers([primer3_config])[0]
+
+    def design_lambda_fallback_primers(self, configs):
+        if self.lambda_fallback is not None:
+            return self.lambda_fallback.design_primers_for_all_mutations(configs)
+        if not os.path.exists(self.binary):
+            raise LambdaInvocationError("Primer3 AWS Lambda function failed and primer3_core is not installed")
+        return self.design_multiple_local_primers(configs)
 
     def design_multiple_local_primers(self, config_list):
         return [self.design_primers(config) for config in config_list]
@@ -200,6 +256,326 @@ as environment variable PRIMER3HOME""")
         return _formatBoulderIO(primer3_config.config)
 
 
+# Number of long-lived primer3_core processes of `Primer3Pool`
+# of each worker process. Celery starts a worker process per CPU by default, so the default is 1,
+# e.g. 2 worker processes (--concurrency=2) on 16 CPUs can have 8 primer3_core processes each.
+PRIMER3_CORE_PROCESSES = int(os.environ.get("PRIMER3_CORE_PROCESSES", 1))
+# Seconds a primer3_core process may take to output a record before it is considered hung and killed
+PRIMER3_CORE_TIMEOUT = float(os.environ.get("PRIMER3_CORE_TIMEOUT", 300))
+
+# primer3_core doesn't flush its stdout after a record, the output of a long-lived process must be line buffered
+# by stdbuf of GNU coreutils (BusyBox has none, the backend image installs coreutils)
+_LINE_BUFFERED_PREFIX = ["stdbuf", "-oL"] if shutil.which("stdbuf") else None
+
+
+class Primer3ProcessError(Exception):
+    pass
+
+
+class Primer3ProcessTimeout(Primer3ProcessError):
+    pass
+
+
+class Primer3Process:
+    """
+    primer3_core process designing primers of batches of Boulder-IO records written to its stdin.
+    The process is kept alive between batches when its output can be line buffered, otherwise
+    a process is started per batch. A crashed process is restarted and its batch is retried once,
+    a process not outputting a record for `timeout` seconds is killed and Primer3ProcessTimeout is raised.
+
+    Global (non SEQUENCE_) tags of a record stay set for the following records of the process,
+    the process is restarted before records of different global tags than the records it designed.
+    """
+
+    def __init__(self, binary: str, timeout: float = PRIMER3_CORE_TIMEOUT):
+        self.timeout = timeout
+        self.persistent = _LINE_BUFFERED_PREFIX is not None
+        self.command = _LINE_BUFFERED_PREFIX + [binary] if self.persistent else [binary]
+        self.process: Optional[subprocess.Popen] = None
+        self.global_tags: Optional[FrozenSet[str]] = None
+        self.lock = threading.Lock()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, global_tags: FrozenSet[str]):
+        self.stop()
+        self.process = subprocess.Popen(self.command,
+                                        stdout=subprocess.PIPE,
+                                        stdin=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        self.global_tags = global_tags
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        for pipe in [self.process.stdin, self.process.stdout]:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        self.process = None
+        self.global_tags = None
+
+    def design(self, records: List[str], global_tags: FrozenSet[str]) -> List[str]:
+        """
+        Returns Boulder-IO outputs of the "="-terminated records with the global tags in their order.
+        """
+        with self.lock:
+            try:
+                return self._design(records, global_tags)
+            except Primer3ProcessTimeout:
+                # Process was killed, a hung record would hang again
+                raise
+            except Primer3ProcessError:
+                self.stop()
+                return self._design(records, global_tags)
+
+    def _design(self, records: List[str], global_tags: FrozenSet[str]) -> List[str]:
+        if not self.is_alive() or self.global_tags != global_tags:
+            self.start(global_tags)
+
+        # Records are written by another thread, primer3_core blocks on a full stdout pipe
+        writer = threading.Thread(target=self._write, args=(self.process, "".join(records).encode("ascii")))
+        writer.start()
+        try:
+            outputs = self._read_outputs(len(records))
+        except Primer3ProcessTimeout:
+            # Unblocks the writer
+            self.stop()
+            raise
+        finally:
+            writer.join()
+
+        if not self.persistent:
+            self.stop()
+        return outputs
+
+    def _read_outputs(self, count: int) -> List[str]:
+        stdout = self.process.stdout.fileno()
+        outputs = []
+        lines = []
+        pending = b""
+        while len(outputs) < count:
+            # Without line buffering all outputs come at the end of the batch
+            timeout = self.timeout if self.persistent else self.timeout * (count - len(outputs))
+            if not select.select([stdout], [], [], timeout)[0]:
+                raise Primer3ProcessTimeout(f"primer3_core did not output a record in {timeout} seconds")
+            chunk = os.read(stdout, 65536)
+            if not chunk:
+                raise Primer3ProcessError(f"primer3_core exited with {self.process.poll()}")
+
+            *complete_lines, pending = (pending + chunk).split(b"\n")
+            for line in complete_lines:
+                line = line.decode("ascii")
+                if line == "=":
+                    outputs.append("".join(lines))
+                    lines = []
+                else:
+                    lines.append(line + "\n")
+        return outputs
+
+    def _write(self, process: subprocess.Popen, input_bytes: bytes):
+        try:
+            process.stdin.write(input_bytes)
+            if self.persistent:
+                process.stdin.flush()
+            else:
+                process.stdin.close()
+        except (OSError, ValueError):
+            # The crash is reported by the reader
+            pass
+
+
+class Primer3ProcessPool:
+    """
+    Pool of primer3_core processes designing records of a batch in parallel. Records of the same global tags
+    are split into contiguous chunks, processes prefer chunks of the global tags they designed last.
+    """
+
+    def __init__(self, binary: str, size: int):
+        if _LINE_BUFFERED_PREFIX is None:
+            warnings.warn("stdbuf is not installed, primer3_core pool starts a process per batch", RuntimeWarning)
+        self.processes = [Primer3Process(binary) for _ in range(max(size, 1))]
+        self.executor = ThreadPoolExecutor(len(self.processes))
+
+    def design(self, records: List[str], global_tags: List[FrozenSet[str]]) -> List[str]:
+        groups: Dict[FrozenSet[str], List[int]] = OrderedDict()
+        for index, tags in enumerate(global_tags):
+            groups.setdefault(tags, []).append(index)
+
+        chunk_size = max(-(-len(records) // len(self.processes)), 1)
+        chunks = [(tags, indexes[i:i + chunk_size])
+                  for tags, indexes in groups.items() for i in range(0, len(indexes), chunk_size)]
+        chunks_lock = threading.Lock()
+        outputs: List[Optional[str]] = [None] * len(records)
+
+        def design_chunks(process: Primer3Process):
+            while True:
+                with chunks_lock:
+                    if not chunks:
+                        return
+                    chunk = next((chunk for chunk in chunks if chunk[0] == process.global_tags), chunks[0])
+                    chunks.remove(chunk)
+                tags, indexes = chunk
+                chunk_outputs = process.design([records[index] for index in indexes], tags)
+                for index, output in zip(indexes, chunk_outputs):
+                    outputs[index] = output
+
+        if len(chunks) <= 1:
+            design_chunks(self.processes[0])
+        else:
+            list(self.executor.map(design_chunks, self.processes))
+        return outputs
+
+    def close(self):
+        for process in self.processes:
+            with process.lock:
+                process.stop()
+        self.executor.shutdown()
+
+
+class Primer3Pool(Primer3):
+    """
+    Designs primers locally with a pool of long-lived primer3_core processes instead of a process per config
+    (or AWS Lambda), configs of all mutations are written to the processes as multi-record Boulder-IO batches.
+    """
+
+    def __init__(self, primer3_path=None, processes: int = PRIMER3_CORE_PROCESSES):
+        super().__init__(primer3_path)
+        self.processes = processes
+        self._pool: Optional[Primer3ProcessPool] = None
+        self._pool_pid: Optional[int] = None
+
+    def get_pool(self) -> Primer3ProcessPool:
+        if self._pool_pid != os.getpid():
+            # Processes of the parent are not usable after fork
+            self._pool = Primer3ProcessPool(self.binary, self.processes)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def design_primers(self, primer3_config) -> List[Primer]:
+        return self.design_primers_for_all_mutations([primer3_config])[0]
+
+    def design_primers_for_all_mutations(self, config_list) -> List[List[Primer]]:
+        records = [self.create_primer3_input_string(config) for config in config_list]
+        global_tags = [primer3_global_tags(config) for config in config_list]
+        return [parse_primers(_parseBoulderIO(output)) for output in self.get_pool().design(records, global_tags)]
+
+    def close(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.close()
+        self._pool = None
+        self._pool_pid = None
+
+
+# Number of processes designing primers with primer3-py (`Primer3InProcess`) of each worker process,
+# 1 designs them in-process. Celery starts a worker process per CPU by default, so the default is 1.
+PRIMER3_PROCESSES = int(os.environ.get("PRIMER3_PROCESSES", 1))
+
+_primer3_executor = None
+_primer3_executor_pid: Optional[int] = None
+
+
+def _get_primer3_executor():
+    global _primer3_executor, _primer3_executor_pid
+    if PRIMER3_PROCESSES <= 1 or in_pool_worker():
+        return None
+    if _primer3_executor_pid != os.getpid():
+        # Executor of the parent process cannot be used after fork
+        _primer3_executor = create_process_pool(PRIMER3_PROCESSES)
+        _primer3_executor_pid = os.getpid()
+    return _primer3_executor
+
+
+def create_primer3py_args(config: Dict) -> Tuple[Dict, Dict]:
+    """
+    Splits `Primer3Config.config` into sequence and global arguments of primer3-py design_primers.
+    primer3-py uses its own thermodynamic parameters, the path of primer3_core parameters is left out.
+    """
+    seq_args = {}
+    global_args = {}
+    for key, value in config.items():
+        if key == "SEQUENCE_PRIMER_PAIR_OK_REGION_LIST":
+            # Boulder-IO list with empty values of the other direction
+            value = [[int(bound) if bound != "" else -1 for bound in value.split(",")]]
+        if key.startswith("SEQUENCE_"):
+            seq_args[key] = value
+        elif key != "PRIMER_THERMODYNAMIC_PARAMETERS_PATH":
+            global_args[key] = value
+    return seq_args, global_args
+
+
+# Maximum size of primers released primer3-py is built for, primer3 defaults PRIMER_MAX_SIZE to 27
+PRIMER3PY_MAX_PRIMER_SIZE = 36
+PRIMER3_DEFAULT_MAX_SIZE = 27
+
+
+def _design_primers_in_process(config: Dict) -> Optional[Dict[str, str]]:
+    """
+    Designs primers of the config with primer3-py, returns positions of the primers as the raw Boulder-IO
+    values primer3_core outputs, None when primer3-py rejects the config.
+    """
+    try:
+        output = primer3.bindings.design_primers(*create_primer3py_args(config))
+    except OSError:
+        return None
+
+    raw_primers = {"SEQUENCE_TEMPLATE": config["SEQUENCE_TEMPLATE"]}
+    for direction in [PRIMER3_DIRECTION_FORWARD, PRIMER3_DIRECTION_REVERSE]:
+        primers_count = output.get(f"PRIMER_{direction}_NUM_RETURNED", 0)
+        raw_primers[f"PRIMER_{direction}_NUM_RETURNED"] = str(primers_count)
+        for i in range(primers_count):
+            start, length = output[f"PRIMER_{direction}_{i}"]
+            raw_primers[f"PRIMER_{direction}_{i}"] = f"{start},{length}"
+    return raw_primers
+
+
+class Primer3InProcess(PrimerGenerator):
+    """
+    Designs primers with the design_primers binding of primer3-py instead of a primer3_core process per config,
+    configs of all mutations are designed by a process pool. Primers are parsed as the output of primer3_core.
+    Released primer3-py is built for primers of at most 36 bases (primer3_core is patched for 60 bases),
+    configs of longer primers and configs primer3-py rejects are designed by the fallback generator at once.
+    """
+
+    def __init__(self, fallback: Optional[PrimerGenerator] = None):
+        self.fallback = fallback
+
+    def design_primers(self, primer3_config) -> List[Primer]:
+        return self.design_primers_for_all_mutations([primer3_config])[0]
+
+    def design_primers_for_all_mutations(self, config_list) -> List[List[Primer]]:
+        # Configs of longer primers would be rejected by primer3-py
+        supported = [index for index, primer3_config in enumerate(config_list)
+                     if int(primer3_config.config.get("PRIMER_MAX_SIZE", PRIMER3_DEFAULT_MAX_SIZE))
+                     <= PRIMER3PY_MAX_PRIMER_SIZE]
+        configs = [config_list[index].config for index in supported]
+
+        executor = _get_primer3_executor()
+        if executor is None or len(configs) < 2:
+            outputs = [_design_primers_in_process(config) for config in configs]
+        else:
+            outputs = list(executor.map(_design_primers_in_process, configs))
+
+        results: List[Optional[List[Primer]]] = [None] * len(config_list)
+        for index, raw_primers in zip(supported, outputs):
+            if raw_primers is not None:
+                results[index] = parse_primers(raw_primers)
+
+        rejected = [index for index, primers in enumerate(results) if primers is None]
+        if rejected:
+            if self.fallback is None:
+                raise ValueError(f"primer3-py can't design primers of {config_list[rejected[0]].config}")
+            designed = self.fallback.design_primers_for_all_mutations([config_list[index] for index in rejected])
+            for index, primers in zip(rejected, designed):
+                results[index] = primers
+        return results
+
+
 class Primer3Config:
     def __init__(self):
         self.config = {}
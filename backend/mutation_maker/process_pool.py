@@ -0,0 +1,44 @@
+#    Copyright (c) 2020 Merck Sharp & Dohme Corp. a subsidiary of Merck & Co., Inc., Kenilworth, NJ, USA.
+#
+#    This file is part of the Mutation Maker, An Open Source Oligo Design Software For Mutagenesis and De Novo Gene Synthesis Experiments.
+#
+#    Mutation Maker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Set in processes of pools created by `create_process_pool`, so that they don't create pools of their own
+_pool_worker = False
+
+
+def _mark_pool_worker():
+    global _pool_worker
+    _pool_worker = True
+
+
+def in_pool_worker() -> bool:
+    return _pool_worker
+
+
+def create_process_pool(processes: int):
+    """
+    Returns pool of processes mapping functions over iterables in order (ProcessPoolExecutor.map).
+    Prefork Celery workers are daemonic processes, which multiprocessing doesn't allow to have children,
+    the pool of billiard (multiprocessing fork of Celery) is used in them instead.
+    """
+    if multiprocessing.current_process().daemon:
+        import billiard
+
+        return billiard.Pool(processes, initializer=_mark_pool_worker)
+    return ProcessPoolExecutor(processes, initializer=_mark_pool_worker)
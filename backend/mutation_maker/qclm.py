@@ -810,18 +810,22 @@ class QCLMSolver:
         safe_self_bind_limit = (
             partial_solution.temperature - 2 * self.config.temp_range_size
         )
+        other_sequences = [
+            other_primer[0].get_sequence(base)
+            for other_site in partial_solution.primers.keys()
+            if other_site != current_site
+            for other_primer in partial_solution.primers[other_site]
+        ]
+        # Temperatures with all other primers are computed in a batch
+        hb_tms = self.__hetero_bind_calculator.many(
+            [this_primer.get_sequence(base)] * len(other_sequences), other_sequences
+        )
         penalty = 0.0
-        for other_site in partial_solution.primers.keys():
-            if other_site != current_site:
-                for other_primer in partial_solution.primers[other_site]:
-                    hb_tm = self.__hetero_bind_calculator(
-                        this_primer.get_sequence(base),
-                        other_primer[0].get_sequence(base),
-                    )
-                    if hb_tm > safe_self_bind_limit:
-                        penalty += self.config.hairpin_temperature_weight * (
-                            hb_tm - safe_self_bind_limit
-                        )
+        for hb_tm in hb_tms.tolist():
+            if hb_tm > safe_self_bind_limit:
+                penalty += self.config.hairpin_temperature_weight * (
+                    hb_tm - safe_self_bind_limit
+                )
         return penalty
 
     @staticmethod
@@ -21,6 +21,8 @@ from enum import IntEnum
 from pprint import pformat
 from statistics import mean
 
+import numpy as np
+
 try:
     from Bio.SeqUtils import GC
 except ImportError:
@@ -51,6 +53,7 @@ from mutation_maker.temperature_calculator import (
     TemperatureConfig,
     SelfBindingTemps,
     SelfBindingCalculator,
+    PrimerTemperatureState,
 )
 from typing import (
     Iterable,
@@ -459,6 +462,7 @@ class QCLMPrimers:
         max_primer_offset = first_site - self.config.min_five_end_size
 
         # Add primers
+        primer_specs = []
         for start in range(min_primer_offset, max_primer_offset + 1):
             # Find the minimum primer length that conforms to the requirements
             length = last_site + CODON_LENGTH + self.config.min_three_end_size - start
@@ -479,10 +483,20 @@ class QCLMPrimers:
             ):  # we hit the end of the mutated DNA
                 break
 
-            primer_spec = PrimerSpec(start, length, codons)
-
-            # Calculate Tm for the new primer
-            tm = self.temp_calculator(primer_spec.get_mismatch_sequence(self.base))
+            primer_specs.append(PrimerSpec(start, length, codons))
+
+        # Calculate Tm for the new primers, all of them have the same mismatches
+        mismatches = primer_specs[0].get_mismatch_positions(self.base) if primer_specs else []
+        temps = self.temp_calculator.many(
+            (
+                [primer_spec.offset for primer_spec in primer_specs],
+                [primer_spec.offset + primer_spec.length for primer_spec in primer_specs],
+            ),
+            self.base.sequence,
+            dtype=np.float64,
+            mismatches=mismatches,
+        )
+        for primer_spec, tm in zip(primer_specs, temps.tolist()):
             self.__primers[site_set].add_or_update(primer_spec, [tm])
 
     def grow(self, temp_threshold: float):
@@ -517,11 +531,15 @@ class QCLMPrimers:
                     primer_spec.offset, primer_spec.length + 1, primer_spec.codons
                 )
                 three_end_size = primer_spec.offset + primer_spec.length - max(seq)
+                # Temperature of the primer is updated with every added base
+                temp_state = self._primer_temperature_state(primer_spec)
+                tm = None
 
                 while self._primer_not_too_long(
                     extended, seq, end_limit=primer_end_limit
                 ):
-                    tm = self._primer_temperature(extended)
+                    temp_state.extend_right()
+                    tm = temp_state.temperature()
                     if (
                         tm >= temp_threshold
                         and three_end_size >= self.config.min_three_end_size
@@ -531,14 +549,29 @@ class QCLMPrimers:
                     three_end_size += 1
                 else:  # The extension is too long, let's step back
                     extended.length -= 1
-                    tm = self._primer_temperature(extended)
+                    if tm is None:
+                        tm = self._primer_temperature(extended)
 
                 # Replace the original primer with its extension
                 primers_for_seq.remove(primer_spec)
                 primers_for_seq.add_or_update(extended, [tm])
 
     def _primer_temperature(self, primer_spec: PrimerSpec) -> float:
-        return self.temp_calculator(primer_spec.get_mismatch_sequence(self.base))
+        return self.temp_calculator.many(
+            ([primer_spec.offset], [primer_spec.offset + primer_spec.length]),
+            self.base.sequence,
+            dtype=np.float64,
+            mismatches=primer_spec.get_mismatch_positions(self.base),
+        ).item()
+
+    def _primer_temperature_state(self, primer_spec: PrimerSpec) -> PrimerTemperatureState:
+        return PrimerTemperatureState(
+            self.temp_calculator,
+            self.base.sequence,
+            primer_spec.offset,
+            primer_spec.offset + primer_spec.length,
+            primer_spec.get_mismatch_positions(self.base),
+        )
 
     def _primer_not_too_long(
         self, primer_spec: PrimerSpec, site_set: SiteSet, end_limit: int
@@ -599,6 +632,12 @@ class QCLMPrimers:
         """
 
         result = {site_set: [] for site_set in self.__primers.keys()}
+        self._compute_self_binding_temps(
+            primer_spec
+            for site_set in self.__primers.keys()
+            for codons in self.__primer_defs[site_set]
+            for primer_spec, _ in self.__primers[site_set].get_by_codons(codons)
+        )
 
         for site_set in self.__primers.keys():
             for codons in self.__primer_defs[site_set]:
@@ -632,6 +671,22 @@ class QCLMPrimers:
 
         return result
 
+    def _compute_self_binding_temps(self, primer_specs: Iterable[PrimerSpec]):
+        """Computes self binding temperatures of all given primers, which are not cached yet, in a batch."""
+        if not self.config.use_primer3:
+            return
+        missing_specs = [
+            primer_spec
+            for primer_spec in dict.fromkeys(primer_specs)
+            if primer_spec.length <= MAX_PRIMER3_PRIMER_SIZE
+            and self.__self_binding_tm_cache.get(primer_spec) is None
+        ]
+        self_tms = self.__self_bind_calculator.many(
+            [primer_spec.get_sequence(self.base) for primer_spec in missing_specs]
+        )
+        for primer_spec, self_tm in zip(missing_specs, self_tms):
+            self.__self_binding_tm_cache[primer_spec] = self_tm
+
     def _get_self_binding_temps(self, primer_spec: PrimerSpec) -> SelfBindingTemps:
         if self.config.use_primer3 and primer_spec.length <= MAX_PRIMER3_PRIMER_SIZE:
             # TODO that should not be cached
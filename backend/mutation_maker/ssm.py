@@ -16,24 +16,59 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import math
+import os
+import warnings
+from functools import partial
 from pprint import pprint
-from typing import List, Tuple
+from typing import List, Tuple, Optional, Sequence, NamedTuple, Callable, Iterator, Union
 
 import numpy as np
-import primer3
 from Bio import Seq
 
-from mutation_maker.ssm_fast_approximation import pick_best_grown_solution, grow_primers, find_best_overlaps, \
-    compute_grown_solution_score, calc_GC_content
+from mutation_maker.ssm_fast_approximation import pick_best_grown_solution, grow_primers, find_best_overlaps_for_temps, \
+    GrownSolutionScorer, calc_GC_contents, find_alternative_pairs
 from mutation_maker.ssm_types import SSMConfig, SSMSequences, MinOptMax, SSMInput, SSMGrownSolution, \
     SSMSolution, SSMPrimerPossibilities, SSMPrimerPairPossibilities, SSMPrimerPair, \
-    SSMMutagenicPrimer, SSMMutationOutput, SSMOutput, create_output_sequence, PrimerOutput, OverlapOutput, \
-    SSMPrimerSpec, SSMFlankingSequences
-from mutation_maker.temperature_calculator import PrimerDimerCalculator
+    SSMMutagenicPrimer, SSMMutationOutput, SSMAlternativeOutput, SSMOutput, create_output_sequence, PrimerOutput, OverlapOutput, \
+    SSMPrimerSpec, SSMFlankingSequences, SSMGrownPrimerPair
+from mutation_maker.temperature_calculator import PrimerDimerCalculator, TemperatureCalculator
 from .section_timer import SectionTimer
 from .mutation import AminoMutation
-from .primer import Primer
+from .primer import Primer, PrimerTable
 from .primer3_interoperability import Primer3Config, PrimerGenerator
+from .process_pool import create_process_pool, in_pool_worker
+
+
+# Maximal number of primer pair scores computed at once by `SSMSolver.score_temp_combinations`
+MAX_SCORED_ELEMENTS = 2 ** 20
+# Maximal number of processes of the parallel solve (`SSMConfig.parallel_solve`) of each worker process,
+# 1 solves in-process. Celery starts a worker process per CPU by default, so the default is 1,
+# e.g. 2 worker processes (--concurrency=2) on 16 CPUs can have 8 processes each.
+SSM_PROCESSES = int(os.environ.get("SSM_PROCESSES", 1))
+
+# Number of temperature combinations scored at once when pruning them (`SSMConfig.prune_temp_combinations`)
+PRUNING_BATCH_SIZE = 16
+# Relative margin of lower bounds of sums of non-optimality covering rounding errors of the scores
+PRUNING_TOLERANCE = 1e-5
+
+# Callback reporting progress of a solve, called with the name of the stage ("primers", "temperatures"
+# or "results"), the number of its finished steps and the number of all its steps
+ProgressCallback = Callable[[str, int, int], None]
+
+_ssm_executor = None
+_ssm_executor_pid: Optional[int] = None
+
+
+class TempCombinationScores(NamedTuple):
+    """
+    Index of the best pair of each mutation (rows) for each temperature combination (columns)
+    into its `pair_indexes` and score of that pair. Indexes and scores of the next best pairs
+    (`alternative_primer_pairs` of them) are along the last axis, -1 and infinity where there are fewer pairs.
+    """
+    best_indexes: np.ndarray
+    best_scores: np.ndarray
+    alternative_indexes: np.ndarray
+    alternative_scores: np.ndarray
 
 
 def calculate_mutagenic_primer_search_area(mutation, ssm_config, primer_direction):
@@ -53,8 +88,23 @@ def calculate_mutagenic_primer_search_area(mutation, ssm_config, primer_directio
 
 
 def ssm_solve(workflow_input: SSMInput, main_primer_generator, secondary_primer_generator):
+    output = collect_output(ssm_solve_stream(workflow_input, main_primer_generator, secondary_primer_generator))
+
+    return output.to_json()
+
+
+def ssm_solve_stream(workflow_input: SSMInput, main_primer_generator, secondary_primer_generator,
+                     on_progress: Optional[ProgressCallback] = None) \
+        -> Iterator[Union[SSMOutput, SSMMutationOutput]]:
+    """
+    Solves SSM like `ssm_solve` and yields the output as soon as the reaction temperatures are fixed:
+    first `SSMOutput` without results, then `SSMMutationOutput` of each mutation in order as it is built.
+    Output of all mutations depends on the reaction temperatures and on the output sequence spanning
+    all primers, so the first item is yielded after the solve, its progress is reported to `on_progress`.
+    """
     solver = SSMSolver(workflow_input.sequences, workflow_input.config,
                        main_primer_generator, secondary_primer_generator)
+    solver.on_progress = on_progress
 
     flanks = SSMFlankingSequences(workflow_input.sequences.forward_primer,
                                   workflow_input.sequences.reverse_primer)
@@ -62,12 +112,22 @@ def ssm_solve(workflow_input: SSMInput, main_primer_generator, secondary_primer_
 
     if workflow_input.config.use_fast_approximation_algorithm:
         result = solver.solve_for_mutations_faster(mutations)
-        output = format_fast_output(mutations, solver, workflow_input, result, workflow_input.degenerate_codon)
+        stream = stream_fast_output(mutations, solver, workflow_input, result, workflow_input.degenerate_codon)
     else:
         result = solver.solve_for_mutations(mutations,flanks)
-        output = format_output(solver, workflow_input, result, workflow_input.degenerate_codon)
+        stream = stream_output(solver, workflow_input, result, workflow_input.degenerate_codon)
+
+    yield next(stream)
+    for mutation_idx, mutation_output in enumerate(stream):
+        solver.report_progress("results", mutation_idx + 1, len(mutations))
+        yield mutation_output
 
-    return output.to_json()
+
+def collect_output(stream: Iterator[Union[SSMOutput, SSMMutationOutput]]) -> SSMOutput:
+    """ Collects the output yielded by `ssm_solve_stream` or the `stream_*output` functions """
+    output = next(stream)
+    output.results = list(stream)
+    return output
 
 
 def pick_best_solution(solutions: List[SSMSolution]) -> SSMSolution:
@@ -79,29 +139,78 @@ def pick_best_solution(solutions: List[SSMSolution]) -> SSMSolution:
     return best_solution
 
 
-def compute_heterodimer_err(this_primer_pair: SSMPrimerPair, config: SSMConfig,
-                            flanks: SSMFlankingSequences):
+def _get_ssm_executor(config: SSMConfig):
+    global _ssm_executor, _ssm_executor_pid
+    if not config.parallel_solve or in_pool_worker():
+        return None
+    if SSM_PROCESSES <= 1:
+        warnings.warn("Parallel solve is enabled, but SSM_PROCESSES is not set above 1, solving in-process",
+                      RuntimeWarning)
+        return None
+    if _ssm_executor_pid != os.getpid():
+        # Executor of the parent process cannot be used after fork
+        _ssm_executor = create_process_pool(SSM_PROCESSES)
+        _ssm_executor_pid = os.getpid()
+    return _ssm_executor
+
+
+def split_into_chunks(items: Sequence, count: int) -> List[Sequence]:
+    """ Splits items into at most `count` consecutive chunks of nearly the same size """
+    chunk_size = -(-len(items) // max(1, count))
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def _score_temp_combinations_chunk(possible_pairs: List[SSMPrimerPairPossibilities],
+                                   temp_combinations: List[Tuple[float, float, float]],
+                                   config: SSMConfig) -> TempCombinationScores:
+    return SSMSolver.score_temp_combinations(possible_pairs, temp_combinations, config)
+
+
+def _grow_primers_chunk(sequence: str, mutations: List[AminoMutation],
+                        tasks: List[Tuple[List[SSMPrimerSpec], float, float]],
+                        config: SSMConfig,
+                        temp_calculator: Optional[TemperatureCalculator] = None) -> List[SSMGrownSolution]:
+    if temp_calculator is None:
+        # Models of calculators are memoized per process, so each worker computes them once
+        temp_calculator = config.temperature_config.create_calculator()
+    return [SSMGrownSolution(overlaps, *grow_primers(config.max_primer_size,
+                                                     config.min_three_end_size,
+                                                     sequence,
+                                                     mutations,
+                                                     overlaps,
+                                                     fw_temp,
+                                                     rw_temp,
+                                                     temp_calculator))
+            for overlaps, fw_temp, rw_temp in tasks]
+
+
+def sum_of_non_optimalities(best_scores: np.ndarray) -> np.ndarray:
     """
-    Computes error of heterodimer temperature for forward and reverse primers.
-    The error is computed as sum of all hetero-dimers combinations. e.g. we have primer A as this primer pair.
-    Other_primer_pairs contains primers A,B,C,D,E. We compute error for A-B, A-C, A-D, A-E. We skip A-A combination
-    because it does not make sens to compute heterodimer error with its-self.
-    :return: square root ( sum of (weighted heterodimers error pairs) )
+    Returns sums of non-optimality of temperature combinations, given scores of the best pair
+    of each mutation (rows) for each combination (columns).
+    Scores are summed in the order of mutations as in `SSMSolution.sum_of_non_optimality`.
     """
-    if flanks.reverse_flank is None or flanks.forward_flank is None:
-        return 0
-    return primer3.calcHeterodimerTm(this_primer_pair.fw_primer.normal_order_sequence,
-                                     flanks.reverse_flank,
-                                     config.temperature_config.k,
-                                     config.temperature_config.mg,
-                                     config.temperature_config.dntp) + \
-           primer3.calcHeterodimerTm(this_primer_pair.rw_primer.normal_order_sequence,
-                                     flanks.forward_flank,
-                                     config.temperature_config.k,
-                                     config.temperature_config.mg,
-                                     config.temperature_config.dntp)
+    sums = np.zeros(best_scores.shape[1], dtype=np.float64)
+    for scores in best_scores:
+        sums += scores
+    return sums
 
 
+def compute_heterodimer_errs(primer_pairs: List[SSMPrimerPair], flanks: SSMFlankingSequences,
+                             pd_calc: PrimerDimerCalculator) -> np.ndarray:
+    """
+    Computes error of heterodimer temperature for forward and reverse primers of each primer pair.
+    The error is a sum of heterodimer temperatures of the forward primer with the reverse flanking primer
+    and of the reverse primer with the forward flanking primer.
+    :return: array of errors, one for each primer pair
+    """
+    if flanks.reverse_flank is None or flanks.forward_flank is None:
+        return np.zeros(len(primer_pairs))
+    fw_sequences = [pair.fw_primer.normal_order_sequence for pair in primer_pairs]
+    rw_sequences = [pair.rw_primer.normal_order_sequence for pair in primer_pairs]
+    return pd_calc.heterodimers(fw_sequences, [flanks.reverse_flank] * len(primer_pairs)) + \
+        pd_calc.heterodimers(rw_sequences, [flanks.forward_flank] * len(primer_pairs))
+
 
 def penalize_solution(best_solution: SSMSolution, config: SSMConfig, fw_opt_temp, rv_opt_temp,
                       flanks: SSMFlankingSequences):
@@ -112,29 +221,32 @@ def penalize_solution(best_solution: SSMSolution, config: SSMConfig, fw_opt_temp
         - hetero dimer penalty (this is applied for each combinations of primer pairs with the rest)
     Each component is computed with help of primer3 library. It is weighted squared error by corresponding weights
     from config. Than all errors are added together and we return square error of this errors.
+    Temperatures of all primers of the solution are computed in a batch.
     :param best_solution:
     :param config:
     :param fw_opt_temp:
     :param rv_opt_temp:
     :return:
     """
-    for pair in best_solution.result:
-        fw_sequence = pair.fw_primer.normal_order_sequence
-        rw_sequence = pair.rw_primer.normal_order_sequence
-        temp_cfg = config.temperature_config
-        fw_hairpin_tm = primer3.calcHairpinTm(fw_sequence, temp_cfg.k, temp_cfg.mg, temp_cfg.dntp)
-        rw_hairpin_tm = primer3.calcHairpinTm(rw_sequence, temp_cfg.k, temp_cfg.mg, temp_cfg.dntp)
+    temp_cfg = config.temperature_config
+    pd_calc = PrimerDimerCalculator(temp_cfg.k, temp_cfg.mg, temp_cfg.dntp)
+    fw_sequences = [pair.fw_primer.normal_order_sequence for pair in best_solution.result]
+    rw_sequences = [pair.rw_primer.normal_order_sequence for pair in best_solution.result]
 
-        fw_homodimer_tm = primer3.calcHomodimerTm(fw_sequence, temp_cfg.k, temp_cfg.mg, temp_cfg.dntp)
-        rw_homodimer_tm = primer3.calcHomodimerTm(rw_sequence, temp_cfg.k, temp_cfg.mg, temp_cfg.dntp)
+    fw_hairpin_tms = pd_calc.hairpins(fw_sequences)
+    rw_hairpin_tms = pd_calc.hairpins(rw_sequences)
+    fw_homodimer_tms = pd_calc.homodimers(fw_sequences)
+    rw_homodimer_tms = pd_calc.homodimers(rw_sequences)
+    heterodimer_errs = compute_heterodimer_errs(best_solution.result, flanks, pd_calc)
 
-        fw_hairpin_err = (best_solution.forward_temp - fw_hairpin_tm) ** 2
-        rw_hairpin_err = (best_solution.reverse_temp - rw_hairpin_tm) ** 2
+    for i, pair in enumerate(best_solution.result):
+        fw_hairpin_err = (best_solution.forward_temp - fw_hairpin_tms[i].item()) ** 2
+        rw_hairpin_err = (best_solution.reverse_temp - rw_hairpin_tms[i].item()) ** 2
 
-        fw_homodimer_err = (fw_opt_temp - fw_homodimer_tm) ** 2
-        rw_homodimer_err = (rv_opt_temp - rw_homodimer_tm) ** 2
+        fw_homodimer_err = (fw_opt_temp - fw_homodimer_tms[i].item()) ** 2
+        rw_homodimer_err = (rv_opt_temp - rw_homodimer_tms[i].item()) ** 2
 
-        heterodimer_err = compute_heterodimer_err(pair, config, flanks)
+        heterodimer_err = heterodimer_errs[i].item()
 
         penalty = math.sqrt(
                     config.hairpin_temperature_weight * fw_hairpin_err +
@@ -146,6 +258,21 @@ def penalize_solution(best_solution: SSMSolution, config: SSMConfig, fw_opt_temp
         pair.non_optimality += penalty
 
 
+def penalize_alternatives(solution: SSMSolution, config: SSMConfig, flanks: SSMFlankingSequences):
+    """
+    Adds primer dimer penalty (see `penalize_solution`) to the alternative pairs of the solution
+    and reorders them by their penalized non-optimality.
+    """
+    alternative_pairs = [pair for pairs in solution.alternatives for pair in pairs]
+    if len(alternative_pairs) == 0:
+        return
+    alternatives_solution = SSMSolution(solution.forward_temp, solution.reverse_temp, solution.overlap_temp,
+                                        alternative_pairs, config.three_end_temp_range)
+    penalize_solution(alternatives_solution, config, solution.forward_temp, solution.reverse_temp, flanks)
+    for pairs in solution.alternatives:
+        pairs.sort(key=lambda pair: pair.non_optimality)
+
+
 class SSMSolver:
     def __init__(self, ssm_sequences: SSMSequences, ssm_config: SSMConfig,
                  main_primer_generator: PrimerGenerator, secondary_primer_generator: PrimerGenerator) -> None:
@@ -172,6 +299,13 @@ is not needed and have severe negative impact on performance""")
         ]
         self.sequence, self.goi_range = ssm_sequences.get_full_sequence_with_offset()
         self.flanks = SSMFlankingSequences(ssm_sequences.forward_primer, ssm_sequences.reverse_primer)
+        # Memoized scores of grown solutions, shared by the solve and the output of the fast approximation
+        self.grown_solution_scorer = GrownSolutionScorer(self.config, self.sequence, self.flanks)
+        self.on_progress: Optional[ProgressCallback] = None
+
+    def report_progress(self, stage: str, done: int, total: int) -> None:
+        if self.on_progress is not None:
+            self.on_progress(stage, done, total)
 
     def generate_fw_rw_primers(self, mutations: List[AminoMutation], primer_generator):
         fw_configs = [
@@ -208,15 +342,8 @@ is not needed and have severe negative impact on performance""")
                     fw_primers, fw_sizes, fw_gc_contents = self.filter_by_three_end_size(mutation, fw_primers_list)
                     rw_primers, rw_sizes, rw_gc_contents = self.filter_by_three_end_size(mutation, rw_primers_list)
 
-                    fw_temps = np.fromiter((
-                        primer.get_three_end_temperature_with_size(size, self.temp_calculator)
-                        for primer, size in zip(fw_primers, fw_sizes)
-                    ), dtype=np.float32)
-
-                    rw_temps = np.fromiter((
-                        primer.get_three_end_temperature_with_size(size, self.temp_calculator)
-                        for primer, size in zip(rw_primers, rw_sizes)
-                    ), dtype=np.float32)
+                    fw_temps = self.get_three_end_temperatures(fw_primers, fw_sizes)
+                    rw_temps = self.get_three_end_temperatures(rw_primers, rw_sizes)
 
                     primer_options.append(SSMPrimerPossibilities(mutation,
                                                                  fw_primers, fw_sizes, fw_temps, fw_gc_contents,
@@ -227,50 +354,60 @@ is not needed and have severe negative impact on performance""")
 
         return primer_options, possible_pairs
 
+    def get_three_end_temperatures(self, primers: PrimerTable, sizes: np.ndarray) -> np.ndarray:
+        """
+        Returns 3' end temperatures of primers with given 3' end sizes, -1 for empty 3' ends.
+        """
+        temps = self.temp_calculator.many(primers.get_three_end_bounds_with_sizes(np.maximum(sizes, 0)),
+                                          self.sequence)
+        temps[sizes <= 0] = -1
+        return temps
+
     def solve_for_mutations_faster(self, mutations: List[AminoMutation]) -> SSMGrownSolution:
         temps: List[Tuple[float, float, float]] = self.get_temp_combinations()
 
-        solutions: List[SSMGrownSolution] = []
-
         overlap_temps = self.get_overlap_temps()
-        overlaps_with_temps: List[Tuple[float, List[SSMPrimerSpec]]] = []
-
-        for overlap_temp in overlap_temps:
-            overlaps = find_best_overlaps(self.sequence,
-                                          self.config.min_five_end_size,
-                                          self.config.min_overlap_size,
-                                          self.config.max_overlap_size,
-                                          mutations,
-                                          overlap_temp,
-                                          self.temp_calculator,
-                                          self.config.overlap_temp_range / 2)
-
-            overlaps_with_temps.append((overlap_temp, overlaps))
-
-        for fw_temp, rw_temp, overlap_temp in temps:
-            pair_temps = np.array([pair[0] for pair in overlaps_with_temps])
-            overlaps = overlaps_with_temps[np.argmin(abs(pair_temps - overlap_temp)).item()][1]
-
-            fw_primers, rw_primers = grow_primers(self.config.max_primer_size,
-                                                  self.config.min_three_end_size,
-                                                  self.sequence,
-                                                  mutations,
-                                                  overlaps,
-                                                  fw_temp,
-                                                  rw_temp,
-                                                  self.temp_calculator)
-
-            solutions.append(SSMGrownSolution(overlaps, fw_primers, rw_primers))
-
-        best_solution = pick_best_grown_solution(self.config, self.sequence, solutions, self.flanks)
+        overlaps_for_temps = find_best_overlaps_for_temps(self.sequence,
+                                                          self.config.min_five_end_size,
+                                                          self.config.min_overlap_size,
+                                                          self.config.max_overlap_size,
+                                                          mutations,
+                                                          overlap_temps,
+                                                          self.temp_calculator,
+                                                          self.config.overlap_temp_range / 2)
+        overlaps_with_temps: List[Tuple[float, List[SSMPrimerSpec]]] = list(zip(overlap_temps, overlaps_for_temps))
+
+        pair_temps = np.array([pair[0] for pair in overlaps_with_temps])
+        tasks = [(overlaps_with_temps[np.argmin(abs(pair_temps - overlap_temp)).item()][1], fw_temp, rw_temp)
+                 for fw_temp, rw_temp, overlap_temp in temps]
+
+        self.report_progress("temperatures", 0, len(tasks))
+        executor = _get_ssm_executor(self.config)
+        if executor is None or len(tasks) < 2:
+            solutions = _grow_primers_chunk(self.sequence, mutations, tasks, self.config, self.temp_calculator)
+        else:
+            # Chunks of temperature combinations are grown by the processes, in order
+            grow_chunk = partial(_grow_primers_chunk, self.sequence, mutations, config=self.config)
+            solutions = [solution for chunk_solutions in executor.map(grow_chunk,
+                                                                      split_into_chunks(tasks, SSM_PROCESSES))
+                         for solution in chunk_solutions]
+
+        best_solution = pick_best_grown_solution(self.config, self.sequence, solutions, self.flanks,
+                                                 self.grown_solution_scorer)
+        self.report_progress("temperatures", len(tasks), len(tasks))
+        if self.config.alternative_primer_pairs > 0:
+            best_solution.alternatives = find_alternative_pairs(solutions, best_solution, self.grown_solution_scorer,
+                                                                self.config.alternative_primer_pairs)
 
         return best_solution
 
     def solve_for_mutations(self, mutations: List[AminoMutation], flanks: SSMFlankingSequences) -> SSMSolution:
         with SectionTimer("solve_for_mutations") as timer:
             with timer.child("main primers"):
+                self.report_progress("primers", 0, 2)
                 main_primer_options, main_possible_pairs = \
                     self.generate_primers(mutations, self.main_primer_generator, "main")
+                self.report_progress("primers", 1, 2)
 
             with timer.child("secondary primers"):
                 secondary_mutations = [pair.mutation for pair in main_possible_pairs
@@ -282,24 +419,13 @@ is not needed and have severe negative impact on performance""")
 
                 main_valid_pairs = [pair for pair in main_possible_pairs if len(pair.pair_indexes) > 0]
                 possible_pairs = main_valid_pairs + secondary_pairs
+                self.report_progress("primers", 2, 2)
 
             # Here we generate all combinations for 3' FW, RW and overlap temperature.
             temp_combinations = self.get_temp_combinations()
 
-            with timer.child("generate possible solutions"):
-                # Now we generate a separate solution for each temperature combination.
-                solutions = [self.get_best_primers_for_temp_ranges(possible_pairs,
-                                                                   forward_temp,
-                                                                   reverse_temp,
-                                                                   overlap_temp,
-                                                                   self.config,
-                                                                   flanks)
-                             for forward_temp, reverse_temp, overlap_temp in temp_combinations]
-
-            with timer.child("pick_best_solution"):
-                # And finally pick the 3' forward, reverse & overlap temperatures
-                # which have the best solution.
-                final_result = pick_best_solution(solutions)
+            with timer.child("score temperature combinations"):
+                final_result = self.find_best_temp_combination(possible_pairs, temp_combinations, flanks)
 
             pprint(possible_pairs)
 
@@ -412,45 +538,30 @@ is not needed and have severe negative impact on performance""")
         max_overlap_size = self.config.max_overlap_size
 
         for primer_options in all_primer_options:
-            fw_count = len(primer_options.fw_primers)
-            rw_count = len(primer_options.rw_primers)
-
-            filtered_indexes = []
-            overlap_temps = []
+            fw_starts, fw_ends = primer_options.fw_primers.normal_starts, primer_options.fw_primers.normal_ends
+            rw_starts, rw_ends = primer_options.rw_primers.normal_starts, primer_options.rw_primers.normal_ends
 
-            for i in range(fw_count):
-                for j in range(rw_count):
-                    fw = primer_options.fw_primers[i]
-                    rw = primer_options.rw_primers[j]
+            # Overlaps of all forward (rows) and reverse (columns) primers
+            starts = np.maximum(fw_starts[:, np.newaxis], rw_starts[np.newaxis, :])
+            ends = np.minimum(fw_ends[:, np.newaxis], rw_ends[np.newaxis, :])
+            overlap_lengths = ends - starts
 
-                    start = max(fw.normal_start, rw.normal_start)
-                    end = min(fw.normal_end, rw.normal_end)
-
-                    overlap_len = end - start
-
-                    if min_overlap_size <= overlap_len <= max_overlap_size:
-                        filtered_indexes.append((i, j))
-
-                        start_offset = start - fw.normal_start
-                        end_offset = end - fw.normal_start
-
-                        overlap = fw.normal_order_sequence[start_offset:end_offset]
-                        overlap_temp = self.temp_calculator(overlap)
-
-                        overlap_temps.append(overlap_temp)
+            valid = (min_overlap_size <= overlap_lengths) & (overlap_lengths <= max_overlap_size)
+            fw_indexes, rw_indexes = np.nonzero(valid)
 
+            # Primers are substrings of the solver sequence, and so are their overlaps
             possibilities = SSMPrimerPairPossibilities(
                 primer_options,
-                np.array(filtered_indexes),
-                np.array(overlap_temps),
+                np.stack((fw_indexes, rw_indexes), axis=1),
+                self.temp_calculator.many((starts[valid], ends[valid]), self.sequence, dtype=np.float64),
                 is_main)
 
             list_of_pairs.append(possibilities)
 
         return list_of_pairs
 
-    def filter_by_three_end_size(self, mutation: AminoMutation, primers: List[Primer]) \
-                                 -> Tuple[List[Primer], np.ndarray, np.ndarray]:
+    def filter_by_three_end_size(self, mutation: AminoMutation, primers: Sequence[Primer]) \
+                                 -> Tuple[PrimerTable, np.ndarray, np.ndarray]:
         """
         Filters givne primers by minimum three and five and size.
         """
@@ -460,24 +571,17 @@ is not needed and have severe negative impact on performance""")
         min_five_size = self.config.min_five_end_size
         max_five_size = self.config.max_five_end_size
 
-        filtered_primers = []
-        three_end_sizes = []
-        gc_contents = []
-
-        for primer in primers:
-            three_end_size = primer.get_three_end_size_from_mutation(mutation)
-            five_end_size = primer.get_five_end_size_from_mutation(mutation)
+        table = PrimerTable.from_primers(self.sequence, primers)
+        three_end_sizes = table.get_three_end_sizes_from_mutation(mutation)
+        five_end_sizes = table.get_five_end_sizes_from_mutation(mutation)
 
-            three_in_range = min_three_size <= three_end_size <= max_three_size
-            five_in_range = min_five_size <= five_end_size <= max_five_size
+        in_range = (min_three_size <= three_end_sizes) & (three_end_sizes <= max_three_size) & \
+                   (min_five_size <= five_end_sizes) & (five_end_sizes <= max_five_size)
 
-            if three_in_range and five_in_range:
-                filtered_primers.append(primer)
-                three_end_sizes.append(three_end_size)
-                gc_contents.append(calc_GC_content(primer.normal_order_sequence))
-                # gc_contents.append(0)
+        filtered_primers = table.select(in_range)
+        gc_contents = calc_GC_contents(self.sequence, filtered_primers.normal_starts, filtered_primers.normal_ends)
 
-        return filtered_primers, np.array(three_end_sizes), np.array(gc_contents)
+        return filtered_primers, three_end_sizes[in_range], gc_contents
 
     def get_best_primers_for_temp_ranges(self,
                                          possible_pairs: List[SSMPrimerPairPossibilities],
@@ -486,96 +590,337 @@ is not needed and have severe negative impact on performance""")
                                          overlap_temp: float,
                                          config: SSMConfig,
                                          flanks: SSMFlankingSequences) -> SSMSolution:
+        temp_combination = (forward_temp_opt, reverse_temp_opt, overlap_temp)
+        scores = self.score_temp_combinations(possible_pairs, [temp_combination], config)
+
+        best_solution = self.create_solution(possible_pairs, temp_combination, scores.best_indexes[:, 0],
+                                             scores.best_scores[:, 0], config,
+                                             scores.alternative_indexes[:, 0], scores.alternative_scores[:, 0])
+        # Due to high number of possible combinations and given that primer-dimer penalty would be very costly regarding
+        # computing for all combinations, we just introduce ad-hoc penalty
+        # for the best solution for given reaction temperature
+        if config.compute_hairpin_homodimer:
+            penalize_solution(best_solution, config, forward_temp_opt, reverse_temp_opt, flanks)
+            penalize_alternatives(best_solution, config, flanks)
+        return best_solution
+
+    def find_best_temp_combination(self, possible_pairs: List[SSMPrimerPairPossibilities],
+                                   temp_combinations: List[Tuple[float, float, float]],
+                                   flanks: SSMFlankingSequences) -> SSMSolution:
+        """
+        Returns the solution of the temperature combination with the lowest sum of non-optimality,
+        the first one of those with the same sum.
+        When `prune_temp_combinations` is set, combinations are scored in batches in order of lower bounds
+        of their sums, the remaining ones are pruned when their bounds exceed the best sum found.
+        """
+        if self.config.prune_temp_combinations:
+            lower_bounds = self.get_temp_combinations_lower_bounds(possible_pairs, temp_combinations, self.config)
+            order = np.argsort(lower_bounds, kind="stable")
+            batch_size = PRUNING_BATCH_SIZE
+        else:
+            lower_bounds = None
+            order = np.arange(len(temp_combinations))
+            batch_size = max(1, len(temp_combinations))
+
+        best_key: Optional[Tuple[np.float32, int]] = None
+        best_solution: Optional[SSMSolution] = None
+        scored = 0
+
+        for batch_start in range(0, len(order), batch_size):
+            if best_key is not None and lower_bounds is not None and \
+                    lower_bounds[order[batch_start]] * (1 - PRUNING_TOLERANCE) > best_key[0]:
+                break
+
+            batch = order[batch_start:batch_start + batch_size].tolist()
+            batch_combinations = [temp_combinations[combination_idx] for combination_idx in batch]
+            scores = self.score_all_temp_combinations(possible_pairs, batch_combinations)
+            scored += len(batch)
+            self.report_progress("temperatures", scored, len(order))
+
+            if self.config.compute_hairpin_homodimer:
+                # Due to high number of possible combinations and given that primer-dimer penalty would be very
+                # costly regarding computing for all combinations, we just introduce ad-hoc penalty
+                # for the best solution for given reaction temperature
+                for column, combination_idx in enumerate(batch):
+                    forward_temp, reverse_temp, overlap_temp = temp_combinations[combination_idx]
+                    solution = self.create_solution(possible_pairs, temp_combinations[combination_idx],
+                                                    scores.best_indexes[:, column], scores.best_scores[:, column],
+                                                    self.config, scores.alternative_indexes[:, column],
+                                                    scores.alternative_scores[:, column])
+                    penalize_solution(solution, self.config, forward_temp, reverse_temp, flanks)
+
+                    key = (np.float32(solution.sum_of_non_optimality()), combination_idx)
+                    if best_key is None or key < best_key:
+                        best_key, best_solution = key, solution
+            else:
+                sums = sum_of_non_optimalities(scores.best_scores).astype(np.float32)
+
+                for column, combination_idx in enumerate(batch):
+                    key = (sums[column], combination_idx)
+                    if best_key is None or key < best_key:
+                        best_key = key
+                        best_solution = self.create_solution(possible_pairs, temp_combinations[combination_idx],
+                                                             scores.best_indexes[:, column],
+                                                             scores.best_scores[:, column], self.config,
+                                                             scores.alternative_indexes[:, column],
+                                                             scores.alternative_scores[:, column])
+
+        assert best_solution is not None
+        if self.config.compute_hairpin_homodimer:
+            # Only alternatives of the best solution are penalized
+            penalize_alternatives(best_solution, self.config, flanks)
+        best_solution.pruned_combinations = len(order) - scored
+        self.report_progress("temperatures", len(order), len(order))
+
+        return best_solution
+
+    @staticmethod
+    def get_temp_combinations_lower_bounds(possible_pairs: List[SSMPrimerPairPossibilities],
+                                           temp_combinations: List[Tuple[float, float, float]],
+                                           config: SSMConfig) -> np.ndarray:
+        """
+        Returns lower bounds of sums of non-optimality of temperature combinations (without primer-dimer penalties,
+        which only increase them). Each term of the score of a mutation is bounded by its minimum over all pairs,
+        a temperature term depends on a single temperature of the combination only.
+        """
+        temps = np.array(temp_combinations, dtype=np.float64).reshape(-1, 3)
+        lower_bounds = np.zeros(len(temps), dtype=np.float64)
+
         half_temp_interval = config.three_end_temp_range / 2
+
+        for pairs in possible_pairs:
+            fw_temps, rw_temps, overlap_temps, fw_extra_sizes, rw_extra_sizes, fw_gc_contetns, rw_gc_contetns = \
+                SSMSolver.get_pair_terms(pairs, config)
+            temp_opts = SSMSolver.get_temp_opts(temps, fw_temps, rw_temps, overlap_temps)
+
+            min_diffs = []
+            for pair_temps, opts in zip([fw_temps, rw_temps, overlap_temps], temp_opts):
+                # Zeroing of differences below the interval keeps their order,
+                # so the minimum of zeroed differences is the zeroed minimum
+                diffs = np.abs(np.unique(pair_temps) - opts).min(axis=1)
+                diffs[diffs < half_temp_interval] = 0
+                min_diffs.append(diffs)
+            fw_temp_diff, rw_temp_diff, overlap_diff = min_diffs
+
+            min_size_gc_score = np.min(
+                config.three_end_size_weight * (fw_extra_sizes ** 2) +
+                config.three_end_size_weight * (rw_extra_sizes ** 2) +
+                config.gc_content_weight * (fw_gc_contetns ** 2) +
+                config.gc_content_weight * (rw_gc_contetns ** 2)
+            )
+
+            lower_bounds += np.sqrt(
+                config.three_end_temp_weight * (fw_temp_diff.astype(np.float64) ** 2) +
+                config.three_end_temp_weight * (rw_temp_diff.astype(np.float64) ** 2) +
+                config.overlap_temp_weight * (overlap_diff.astype(np.float64) ** 2) +
+                min_size_gc_score
+            )
+
+        return lower_bounds
+
+    def score_all_temp_combinations(self, possible_pairs: List[SSMPrimerPairPossibilities],
+                                    temp_combinations: List[Tuple[float, float, float]]) -> TempCombinationScores:
+        """
+        Same as `score_temp_combinations`, chunks of mutations are scored by a process pool
+        when `parallel_solve` is enabled.
+        """
+        executor = _get_ssm_executor(self.config)
+        if executor is None or len(possible_pairs) < 2:
+            return self.score_temp_combinations(possible_pairs, temp_combinations, self.config)
+
+        score_chunk = partial(_score_temp_combinations_chunk, temp_combinations=temp_combinations, config=self.config)
+        results = list(executor.map(score_chunk, split_into_chunks(possible_pairs, SSM_PROCESSES)))
+        return TempCombinationScores(*(np.concatenate(arrays) for arrays in zip(*results)))
+
+    @staticmethod
+    def get_pair_terms(pairs: SSMPrimerPairPossibilities, config: SSMConfig) -> Tuple[np.ndarray, ...]:
+        """
+        Returns arrays of forward, reverse and overlap temperatures, forward and reverse extra 3' end sizes
+        and forward and reverse GC content overflows of all pairs of a mutation.
+        """
+        idx_arry = pairs.pair_indexes
         min_three_end_size = config.min_three_end_size
 
-        best = []
+        fw_sizes = pairs.options.fw_sizes[idx_arry[:, 0]]
+        fw_gc_contetns = pairs.options.fw_gc_contents[idx_arry[:, 0]]
+        rw_sizes = pairs.options.rw_sizes[idx_arry[:, 1]]
+        rw_gc_contetns = pairs.options.rw_gc_contents[idx_arry[:, 1]]
 
-        for pairs in possible_pairs:
+        fw_temps = pairs.options.fw_temps[idx_arry[:, 0]]
+        rw_temps = pairs.options.rw_temps[idx_arry[:, 1]]
+        overlap_temps = pairs.overlap_temps
+
+        # compute overflow of GC content which are below min to negative values
+        # 1st param -> array of constants, 2nd param -> what we want to substract, 3rd param -> where to store output
+        # 4th param condition where to do operation
+        np.subtract(config.min_gc_content,fw_gc_contetns, out=fw_gc_contetns, where=config.min_gc_content > fw_gc_contetns)
+        np.subtract(config.min_gc_content,rw_gc_contetns, out=rw_gc_contetns, where=config.min_gc_content > rw_gc_contetns)
+
+
+        # subtract those above max
+        np.subtract(fw_gc_contetns, config.max_gc_content, out=fw_gc_contetns, where=config.max_gc_content < fw_gc_contetns)
+        np.subtract(rw_gc_contetns, config.max_gc_content, out=rw_gc_contetns, where=config.max_gc_content < rw_gc_contetns)
+
+        # set to zero those which are inside interval, () are necessary
+        fw_gc_contetns[(config.min_gc_content <= fw_gc_contetns) & (fw_gc_contetns <= config.max_gc_content)] = 0
+        rw_gc_contetns[(config.min_gc_content <= rw_gc_contetns) & (rw_gc_contetns <= config.max_gc_content)] = 0
+
+        fw_extra_sizes = fw_sizes - min_three_end_size
+        rw_extra_sizes = rw_sizes - min_three_end_size
+
+        return fw_temps, rw_temps, overlap_temps, fw_extra_sizes, rw_extra_sizes, fw_gc_contetns, rw_gc_contetns
+
+    @staticmethod
+    def get_temp_opts(temps: np.ndarray, fw_temps: np.ndarray, rw_temps: np.ndarray,
+                      overlap_temps: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns columns of optimal forward, reverse and overlap temperatures of combinations, converted to the dtype
+        a scalar of them would be converted to, so that scores are the same as when scoring each combination separately.
+        """
+        return (temps[:, 0].astype(np.result_type(fw_temps, 0.0))[:, np.newaxis],
+                temps[:, 1].astype(np.result_type(rw_temps, 0.0))[:, np.newaxis],
+                temps[:, 2].astype(np.result_type(overlap_temps, 0.0))[:, np.newaxis])
+
+    @staticmethod
+    def score_temp_combinations(possible_pairs: List[SSMPrimerPairPossibilities],
+                                temp_combinations: List[Tuple[float, float, float]], config: SSMConfig,
+                                max_chunk_elements: int = MAX_SCORED_ELEMENTS) -> TempCombinationScores:
+        """
+        Scores the primer pairs of each mutation for all (forward, reverse, overlap) temperature combinations.
+        Scores of a mutation are computed as a matrix of combinations (rows) and pairs (columns),
+        in chunks of combinations with at most `max_chunk_elements` scores to bound memory.
+        The next best pairs are selected from the same matrix when `alternative_primer_pairs` is set.
+        """
+        temps = np.array(temp_combinations, dtype=np.float64).reshape(-1, 3)
+        best_indexes = np.zeros((len(possible_pairs), len(temps)), dtype=np.int64)
+        best_scores = np.zeros((len(possible_pairs), len(temps)), dtype=np.float64)
+        alternatives_shape = (len(possible_pairs), len(temps), config.alternative_primer_pairs)
+        alternative_indexes = np.full(alternatives_shape, -1, dtype=np.int64)
+        alternative_scores = np.full(alternatives_shape, np.inf, dtype=np.float64)
+
+        half_temp_interval = config.three_end_temp_range / 2
+
+        for mutation_idx, pairs in enumerate(possible_pairs):
             idx_arry = pairs.pair_indexes
+            fw_temps, rw_temps, overlap_temps, fw_extra_sizes, rw_extra_sizes, fw_gc_contetns, rw_gc_contetns = \
+                SSMSolver.get_pair_terms(pairs, config)
 
-            fw_sizes = pairs.options.fw_sizes[idx_arry[:, 0]]
-            fw_gc_contetns = pairs.options.fw_gc_contents[idx_arry[:, 0]]
-            rw_sizes = pairs.options.rw_sizes[idx_arry[:, 1]]
-            rw_gc_contetns = pairs.options.rw_gc_contents[idx_arry[:, 1]]
+            fw_opts, rw_opts, overlap_opts = SSMSolver.get_temp_opts(temps, fw_temps, rw_temps, overlap_temps)
 
+            chunk_size = max(1, max_chunk_elements // max(1, len(idx_arry)))
 
-            fw_temps = pairs.options.fw_temps[idx_arry[:, 0]]
-            rw_temps = pairs.options.rw_temps[idx_arry[:, 1]]
-            overlap_temps = pairs.overlap_temps
+            for chunk_start in range(0, len(temps), chunk_size):
+                chunk = slice(chunk_start, chunk_start + chunk_size)
 
-            overlap_diff = np.abs(overlap_temps - overlap_temp)
-            overlap_diff[overlap_diff < half_temp_interval] = 0
+                overlap_diff = np.abs(overlap_temps - overlap_opts[chunk])
+                overlap_diff[overlap_diff < half_temp_interval] = 0
 
-            fw_temp_diff = np.abs(fw_temps - forward_temp_opt)
-            fw_temp_diff[fw_temp_diff < half_temp_interval] = 0
+                fw_temp_diff = np.abs(fw_temps - fw_opts[chunk])
+                fw_temp_diff[fw_temp_diff < half_temp_interval] = 0
 
-            rw_temp_diff = np.abs(rw_temps - reverse_temp_opt)
-            rw_temp_diff[rw_temp_diff < half_temp_interval] = 0
+                rw_temp_diff = np.abs(rw_temps - rw_opts[chunk])
+                rw_temp_diff[rw_temp_diff < half_temp_interval] = 0
 
-            # compute overflow of GC content which are below min to negative values
-            # 1st param -> array of constants, 2nd param -> what we want to substract, 3rd param -> where to store output
-            # 4th param condition where to do operation
-            np.subtract(config.min_gc_content,fw_gc_contetns, out=fw_gc_contetns, where=config.min_gc_content > fw_gc_contetns)
-            np.subtract(config.min_gc_content,rw_gc_contetns, out=rw_gc_contetns, where=config.min_gc_content > rw_gc_contetns)
+                scores = np.sqrt(
+                    config.three_end_temp_weight * (fw_temp_diff ** 2) +
+                    config.three_end_temp_weight * (rw_temp_diff ** 2) +
+                    config.overlap_temp_weight * (overlap_diff ** 2) +
+                    config.three_end_size_weight * (fw_extra_sizes ** 2) +
+                    config.three_end_size_weight * (rw_extra_sizes ** 2) +
+                    config.gc_content_weight * (fw_gc_contetns ** 2) +
+                    config.gc_content_weight * (rw_gc_contetns ** 2)
+                )
 
+                minimal_pair_idxs = np.argmin(scores, axis=1)
+                best_indexes[mutation_idx, chunk] = minimal_pair_idxs
+                best_scores[mutation_idx, chunk] = np.take_along_axis(
+                    scores, minimal_pair_idxs[:, np.newaxis], axis=1)[:, 0]
 
-            # subtract those above max
-            np.subtract(fw_gc_contetns, config.max_gc_content, out=fw_gc_contetns, where=config.max_gc_content < fw_gc_contetns)
-            np.subtract(rw_gc_contetns, config.max_gc_content, out=rw_gc_contetns, where=config.max_gc_content < rw_gc_contetns)
+                if config.alternative_primer_pairs > 0:
+                    alternative_indexes[mutation_idx, chunk], alternative_scores[mutation_idx, chunk] = \
+                        SSMSolver.get_alternative_pairs(scores, minimal_pair_idxs, config.alternative_primer_pairs)
 
-            # set to zero those which are inside interval, () are necessary
-            fw_gc_contetns[(config.min_gc_content <= fw_gc_contetns) & (fw_gc_contetns <= config.max_gc_content)] = 0
-            rw_gc_contetns[(config.min_gc_content <= rw_gc_contetns) & (rw_gc_contetns <= config.max_gc_content)] = 0
+        return TempCombinationScores(best_indexes, best_scores, alternative_indexes, alternative_scores)
 
-            fw_extra_sizes = fw_sizes - min_three_end_size
-            rw_extra_sizes = rw_sizes - min_three_end_size
+    @staticmethod
+    def get_alternative_pairs(scores: np.ndarray, minimal_pair_idxs: np.ndarray, count: int) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns indexes and scores of up to `count` pairs with the lowest scores in each row except the minimal pair,
+        ordered by score, -1 and infinity where there are fewer pairs. Pairs are selected by partitioning the scores
+        instead of sorting whole rows.
+        """
+        indexes = np.full((len(scores), count), -1, dtype=np.int64)
+        alternative_scores = np.full((len(scores), count), np.inf, dtype=np.float64)
+
+        width = min(count, scores.shape[1] - 1)
+        if width <= 0:
+            return indexes, alternative_scores
+
+        candidates = np.argpartition(scores, width, axis=1)[:, :width + 1]
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        candidates = np.take_along_axis(candidates, np.lexsort((candidates, candidate_scores), axis=1), axis=1)
+
+        # The minimal pair is moved to the end, rows without it (more pairs with the minimal score) keep the first ones
+        is_minimal = candidates == minimal_pair_idxs[:, np.newaxis]
+        candidates = np.take_along_axis(candidates, np.argsort(is_minimal, axis=1, kind="stable"), axis=1)[:, :width]
+
+        indexes[:, :width] = candidates
+        alternative_scores[:, :width] = np.take_along_axis(scores, candidates, axis=1)
+        return indexes, alternative_scores
+
+    @staticmethod
+    def create_solution(possible_pairs: List[SSMPrimerPairPossibilities],
+                        temp_combination: Tuple[float, float, float],
+                        minimal_pair_idxs: np.ndarray, scores: np.ndarray, config: SSMConfig,
+                        alternative_idxs: Optional[np.ndarray] = None,
+                        alternative_scores: Optional[np.ndarray] = None) -> SSMSolution:
+        """
+        Creates the solution of a temperature combination from the index of the best pair
+        of each mutation into its `pair_indexes` and the score of that pair,
+        and optionally from indexes (-1 for none) and scores of the next best pairs of each mutation.
+        """
+        forward_temp_opt, reverse_temp_opt, overlap_temp = temp_combination
 
-            scores = np.sqrt(
-                config.three_end_temp_weight * (fw_temp_diff ** 2) +
-                config.three_end_temp_weight * (rw_temp_diff ** 2) +
-                config.overlap_temp_weight * (overlap_diff ** 2) +
-                config.three_end_size_weight * (fw_extra_sizes ** 2) +
-                config.three_end_size_weight * (rw_extra_sizes ** 2) +
-                config.gc_content_weight * (fw_gc_contetns ** 2) +
-                config.gc_content_weight * (rw_gc_contetns ** 2)
-            )
+        best = [SSMSolver.create_primer_pair(pairs, minimal_pair_idx, score)
+                for pairs, minimal_pair_idx, score in zip(possible_pairs, minimal_pair_idxs.tolist(), scores.tolist())]
 
-            minimal_pair_idx = np.argmin(scores).item()
-            minimal_pair_idx_tup = idx_arry[minimal_pair_idx]
+        solution = SSMSolution(forward_temp_opt, reverse_temp_opt, overlap_temp, best, config.three_end_temp_range)
 
-            min_fw_idx, min_rw_idx = minimal_pair_idx_tup
+        if alternative_idxs is not None and alternative_scores is not None:
+            solution.alternatives = [[SSMSolver.create_primer_pair(pairs, pair_idx, score)
+                                      for pair_idx, score in zip(pair_idxs, pair_scores) if pair_idx >= 0]
+                                     for pairs, pair_idxs, pair_scores in zip(possible_pairs,
+                                                                              alternative_idxs.tolist(),
+                                                                              alternative_scores.tolist())]
 
-            options = pairs.options
+        return solution
 
-            fw_primer = options.fw_primers[min_fw_idx]
-            rw_primer = options.rw_primers[min_rw_idx]
+    @staticmethod
+    def create_primer_pair(pairs: SSMPrimerPairPossibilities, pair_idx: int, score: float) -> SSMPrimerPair:
+        fw_idx, rw_idx = pairs.pair_indexes[pair_idx]
 
-            _, overlap_len = fw_primer.get_overlap(rw_primer)
+        options = pairs.options
 
-            minimal_pair = SSMPrimerPair(
-                pairs.mutation,
-                fw_primer,
-                options.fw_sizes[min_fw_idx].item(),
-                options.fw_temps[min_fw_idx].item(),
+        fw_primer = options.fw_primers[fw_idx]
+        rw_primer = options.rw_primers[rw_idx]
 
-                rw_primer,
-                options.rw_sizes[min_rw_idx].item(),
-                options.rw_temps[min_rw_idx].item(),
+        _, overlap_len = fw_primer.get_overlap(rw_primer)
 
-                overlap_len,
-                pairs.overlap_temps[minimal_pair_idx].item(),
-                scores[minimal_pair_idx].item()
-            )
+        return SSMPrimerPair(
+            pairs.mutation,
+            fw_primer,
+            options.fw_sizes[fw_idx].item(),
+            options.fw_temps[fw_idx].item(),
 
-            best.append(minimal_pair)
-        best_solution = SSMSolution(forward_temp_opt, reverse_temp_opt, overlap_temp, best, config.three_end_temp_range)
-        # Due to high number of possible combinations and given that primer-dimer penalty would be very costly regarding
-        # computing for all combinations, we just introduce ad-hoc penalty
-        # for the best solution for given reaction temperature
-        if config.compute_hairpin_homodimer:
-            penalize_solution(best_solution, config,forward_temp_opt, reverse_temp_opt, flanks)
-        return best_solution
+            rw_primer,
+            options.rw_sizes[rw_idx].item(),
+            options.rw_temps[rw_idx].item(),
+
+            overlap_len,
+            pairs.overlap_temps[pair_idx].item(),
+            score
+        )
 
     def config_for_mutation(self, mutation, primer_direction) -> Primer3Config:
         start, length = calculate_mutagenic_primer_search_area(
@@ -605,44 +950,56 @@ is not needed and have severe negative impact on performance""")
         return primer3_config
 
 
+def create_grown_primer_pair(parent_sequence: str, mutation: AminoMutation,
+                             grown_pair: SSMGrownPrimerPair) -> SSMPrimerPair:
+    fw_primer_spec, rw_primer_spec = grown_pair.fw_primer, grown_pair.rw_primer
+
+    # Wrap primer specs in the standard Primer structure
+    fw_primer = Primer(parent_sequence, Primer.FORWARD, fw_primer_spec.offset, fw_primer_spec.length)
+    rw_primer = Primer(parent_sequence, Primer.REVERSE, rw_primer_spec.offset + rw_primer_spec.length - 1,
+                       rw_primer_spec.length)
+
+    # A simple check that we're converting between primer representations correctly
+    assert rw_primer.normal_order_sequence == parent_sequence[
+                                              rw_primer_spec.offset:rw_primer_spec.offset + rw_primer_spec.length]
+    assert fw_primer.normal_order_sequence == parent_sequence[
+                                              fw_primer_spec.offset:fw_primer_spec.offset + fw_primer_spec.length]
+
+    return SSMPrimerPair(mutation,
+                         fw_primer, fw_primer_spec.three_end_size, fw_primer_spec.three_end_temp,
+                         rw_primer, rw_primer_spec.three_end_size, rw_primer_spec.three_end_temp,
+                         grown_pair.overlap.length, grown_pair.overlap.three_end_temp, grown_pair.non_optimality)
+
+
 def format_fast_output(mutations: List[AminoMutation], solver, input_data: SSMInput,
                        solution: SSMGrownSolution, degenerate_codon: str):
+    return collect_output(stream_fast_output(mutations, solver, input_data, solution, degenerate_codon))
+
+
+def stream_fast_output(mutations: List[AminoMutation], solver, input_data: SSMInput,
+                       solution: SSMGrownSolution, degenerate_codon: str) \
+        -> Iterator[Union[SSMOutput, SSMMutationOutput]]:
+    """ Yields `SSMOutput` of the solution without results, then `SSMMutationOutput` of each mutation """
     all_primers = []
 
     parent_sequence = solver.sequence
     primer_pairs: List[SSMPrimerPair] = []
-    flanks = SSMFlankingSequences(input_data.sequences.forward_primer,
-                                  input_data.sequences.reverse_primer)
-    pdCalc = PrimerDimerCalculator(input_data.config.temperature_config.k,
-                                   input_data.config.temperature_config.mg,
-                                   input_data.config.temperature_config.dntp,
-                                   cached=True)
 
-    non_optimalities = compute_grown_solution_score(input_data.config, parent_sequence, solution, flanks, pdCalc)
+    # Scores of the solution were already computed when it was picked
+    non_optimalities = solver.grown_solution_scorer(solution)
 
     for mutation, overlap, fw_primer_spec, rw_primer_spec, score in \
             zip(mutations, solution.overlaps, solution.fw_primers, solution.rw_primers, non_optimalities):
-        # Wrap primer specs in the standard Primer structure
-        fw_primer = Primer(parent_sequence, Primer.FORWARD, fw_primer_spec.offset, fw_primer_spec.length)
-        rw_primer = Primer(parent_sequence, Primer.REVERSE, rw_primer_spec.offset + rw_primer_spec.length - 1,
-                           rw_primer_spec.length)
-
-        # A simple check that we're converting between primer representations correctly
-        assert rw_primer.normal_order_sequence == parent_sequence[
-                                                  rw_primer_spec.offset:rw_primer_spec.offset + rw_primer_spec.length]
-        assert fw_primer.normal_order_sequence == parent_sequence[
-                                                  fw_primer_spec.offset:fw_primer_spec.offset + fw_primer_spec.length]
-
-        all_primers.append(
-            SSMMutagenicPrimer(fw_primer, fw_primer_spec.three_end_size, fw_primer_spec.three_end_temp))
-        all_primers.append(
-            SSMMutagenicPrimer(rw_primer, rw_primer_spec.three_end_size, rw_primer_spec.three_end_temp))
-
-        primer_pairs.append(
-            SSMPrimerPair(mutation,
-                          fw_primer, fw_primer_spec.three_end_size, fw_primer_spec.three_end_temp,
-                          rw_primer, rw_primer_spec.three_end_size, rw_primer_spec.three_end_temp,
-                          overlap.length, overlap.three_end_temp, score))
+        primer_pair = create_grown_primer_pair(parent_sequence, mutation,
+                                               SSMGrownPrimerPair(overlap, fw_primer_spec, rw_primer_spec, score))
+
+        all_primers.append(SSMMutagenicPrimer(primer_pair.fw_primer, primer_pair.fw_size, primer_pair.fw_temp))
+        all_primers.append(SSMMutagenicPrimer(primer_pair.rw_primer, primer_pair.rw_size, primer_pair.rw_temp))
+
+        primer_pairs.append(primer_pair)
+
+    alternatives = ([create_grown_primer_pair(parent_sequence, mutation, alternative) for alternative in pairs]
+                    for mutation, pairs in zip(mutations, solution.alternatives))
 
     sequence, offset = create_output_sequence(solver.sequence,
                                               solver.goi_range,
@@ -650,13 +1007,15 @@ def format_fast_output(mutations: List[AminoMutation], solver, input_data: SSMIn
 
     new_sequence_start = solver.goi_range[0] - offset
 
-    mutation_outputs = [create_mutation_output(input_data.config,
+    mutation_outputs = (create_mutation_output(input_data.config,
                                                primer_pair,
                                                non_optimality,
                                                degenerate_codon,
                                                new_sequence_start,
-                                               solution)
-                        for primer_pair, non_optimality in zip(primer_pairs, non_optimalities)]
+                                               solution,
+                                               mutation_alternatives)
+                        for primer_pair, non_optimality, mutation_alternatives in
+                        zip(primer_pairs, non_optimalities, alternatives))
 
     # Here we use the solution to figure out the optimal temperatures of the reaction.
     opt_forward_temp, opt_reverse_temp, opt_overlap_temp = \
@@ -666,9 +1025,9 @@ def format_fast_output(mutations: List[AminoMutation], solver, input_data: SSMIn
     # interval on both sides of the reaction temperatures.
     half_temp_range = input_data.config.three_end_temp_range / 2
 
-    return SSMOutput(
+    yield SSMOutput(
         input_data=input_data,
-        results=mutation_outputs,
+        results=[],
         full_sequence=sequence,
         goi_offset=offset,
         new_sequence_start=new_sequence_start,
@@ -687,9 +1046,16 @@ def format_fast_output(mutations: List[AminoMutation], solver, input_data: SSMIn
         opt_overlap_temperature=opt_overlap_temp,
         max_overlap_temperature=(opt_overlap_temp + half_temp_range)
     )
+    yield from mutation_outputs
 
 
 def format_output(solver, input_data: SSMInput, result: SSMSolution, degenerate_codon: str):
+    return collect_output(stream_output(solver, input_data, result, degenerate_codon))
+
+
+def stream_output(solver, input_data: SSMInput, result: SSMSolution, degenerate_codon: str) \
+        -> Iterator[Union[SSMOutput, SSMMutationOutput]]:
+    """ Yields `SSMOutput` of the solution without results, then `SSMMutationOutput` of each mutation """
     all_primers = []
 
     for mutation_result in result.result:
@@ -708,17 +1074,19 @@ def format_output(solver, input_data: SSMInput, result: SSMSolution, degenerate_
     new_sequence_start = solver.goi_range[0] - offset
     non_optimalities = result.primer_non_optimalities()
 
-    mutation_outputs = [create_mutation_output(input_data.config,
+    mutation_outputs = (create_mutation_output(input_data.config,
                                                primer_pair,
                                                non_optimality,
                                                degenerate_codon,
                                                new_sequence_start,
-                                               result)
-                        for primer_pair, non_optimality in zip(result.result, non_optimalities)]
+                                               result,
+                                               alternatives)
+                        for primer_pair, non_optimality, alternatives in
+                        zip(result.result, non_optimalities, result.alternatives))
 
-    return SSMOutput(
+    yield SSMOutput(
         input_data=input_data,
-        results=mutation_outputs,
+        results=[],
         full_sequence=sequence,
         goi_offset=offset,
         new_sequence_start=new_sequence_start,
@@ -737,10 +1105,30 @@ def format_output(solver, input_data: SSMInput, result: SSMSolution, degenerate_
         opt_overlap_temperature=result.overlap_temp_range.opt,
         max_overlap_temperature=result.overlap_temp_range.max
     )
+    yield from mutation_outputs
 
 
 def create_mutation_output(config: SSMConfig, primer_pair: SSMPrimerPair, non_optimality: float,
-                           degenerate_codon: str, new_sequence_start, result):
+                           degenerate_codon: str, new_sequence_start, result,
+                           alternatives: Sequence[SSMPrimerPair] = ()):
+    pair_output = create_primer_pair_output(config, primer_pair, non_optimality, degenerate_codon,
+                                            new_sequence_start, result)
+
+    return SSMMutationOutput(
+        mutation=primer_pair.mutation.original_string,
+        result_found=True,
+        alternatives=[create_primer_pair_output(config, alternative, alternative.non_optimality, degenerate_codon,
+                                                new_sequence_start, result)
+                      for alternative in alternatives],
+        parameters_in_range=pair_output.parameters_in_range,
+        non_optimality=pair_output.non_optimality,
+        forward_primer=pair_output.forward_primer,
+        reverse_primer=pair_output.reverse_primer,
+        overlap=pair_output.overlap)
+
+
+def create_primer_pair_output(config: SSMConfig, primer_pair: SSMPrimerPair, non_optimality: float,
+                              degenerate_codon: str, new_sequence_start, result) -> SSMAlternativeOutput:
     fw_primer = SSMMutagenicPrimer(primer_pair.fw_primer, primer_pair.fw_size, primer_pair.fw_temp)
     rw_primer = SSMMutagenicPrimer(primer_pair.rw_primer, primer_pair.rw_size, primer_pair.rw_temp)
 
@@ -751,9 +1139,7 @@ def create_mutation_output(config: SSMConfig, primer_pair: SSMPrimerPair, non_op
 
     pair_in_range = fw_in_range and rw_in_range and overlap_in_range
 
-    return SSMMutationOutput(
-        mutation=primer_pair.mutation.original_string,
-        result_found=True,
+    return SSMAlternativeOutput(
         parameters_in_range=pair_in_range,
         non_optimality=round(non_optimality),
 
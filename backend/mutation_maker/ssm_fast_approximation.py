@@ -16,59 +16,122 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import math
-from typing import List, Tuple
+from typing import List, Tuple, NamedTuple, Dict, Optional
 
+import numpy as np
 
 from mutation_maker.mutation import AminoMutation
-from mutation_maker.ssm_types import SSMGrownSolution, SSMPrimerSpec, SSMConfig, SSMFlankingSequences
+from mutation_maker.ssm_types import SSMGrownSolution, SSMPrimerSpec, SSMConfig, SSMFlankingSequences, \
+    SSMGrownPrimerPair
 from mutation_maker.temperature_calculator import TemperatureCalculator, PrimerDimerCalculator
 
 
-def find_best_overlaps(sequence: str, min_five_end_size: int, min_overlap_size: int, max_overlap_size: int,
-                       mutations: List[AminoMutation], overlap_temp: float,
-                       temp_calculator: TemperatureCalculator, half_temp_range: float) \
-        -> List[SSMPrimerSpec]:
+class OverlapCandidates(NamedTuple):
     """
-    Takes a list of mutations and a target overlap temperature and finds one overlap at each site
-    such that they are all close to the given overlap temperature.
+    Overlaps of a mutation in the order they are scanned by `find_best_overlaps`, by increasing length
+    and offset. Overlaps of the same length are between consecutive `length_bounds`.
     """
-    results: List[SSMPrimerSpec] = []
+    offsets: np.ndarray
+    lengths: np.ndarray
+    temps: np.ndarray
+    length_bounds: np.ndarray
 
-    overlap_sizes = range(min_overlap_size, max_overlap_size - 1)
 
-    for mutation in mutations:
-        best_offset = None
-        best_length = None
-        best_tm = None
+def create_overlap_candidates(sequence: str, min_five_end_size: int, min_overlap_size: int, max_overlap_size: int,
+                              mutation: AminoMutation, temp_calculator: TemperatureCalculator) -> OverlapCandidates:
+    """
+    Returns all overlaps of a mutation with at least `min_five_end_size` bases on both sides of the mutation,
+    with their temperatures computed in one batch.
+    """
+    mutation_end = mutation.position + mutation.length
+    offsets = []
+    lengths = []
 
-        for length in overlap_sizes:
-            for offset in range((mutation.position + mutation.length) - length, mutation.position - 1):
-                right_padding = (offset + length) <= (mutation.position + mutation.length + min_five_end_size)
-                left_padding = (offset + min_five_end_size) >= mutation.position
+    for length in range(min_overlap_size, max_overlap_size - 1):
+        length_offsets = np.arange(max(mutation_end - length, mutation_end + min_five_end_size - length + 1),
+                                   min(mutation.position - 1, mutation.position - min_five_end_size))
+        if len(length_offsets) > 0:
+            offsets.append(length_offsets)
+            lengths.append(np.full(len(length_offsets), length))
 
-                if right_padding or left_padding:
-                    continue
+    if len(offsets) == 0:
+        raise RuntimeError("Primer parameters are too restrictive and resulted in no possible overlap." +
+                           "Consider lowering min 5' size.")
 
-                overlap = sequence[offset:(offset + length)]
-                tm = temp_calculator(overlap)
+    length_bounds = np.cumsum([0] + [len(length_offsets) for length_offsets in offsets])
+    offsets = np.concatenate(offsets)
+    lengths = np.concatenate(lengths)
+    temps = temp_calculator.many((offsets, offsets + lengths), sequence, dtype=np.float64)
 
-                if (best_tm is None) or (tm < best_tm):
-                    best_offset = offset
-                    best_length = length
-                    best_tm = tm
+    return OverlapCandidates(offsets, lengths, temps, length_bounds)
 
-                if abs(best_tm - overlap_temp) < half_temp_range:
-                    break
 
-        if best_offset is None:
-            raise RuntimeError("Primer parameters are too restrictive and resulted in no possible overlap." +
-                               "Consider lowering min 5' size.")
+def find_best_overlap_indexes(candidates: OverlapCandidates, overlap_temps: np.ndarray,
+                              half_temp_range: float) -> np.ndarray:
+    """
+    Returns index of the best candidate overlap for each of overlap temperatures.
+    Overlaps of each length are scanned, keeping the one with the lowest temperature,
+    until the lowest temperature is within `half_temp_range` of the overlap temperature.
+    All overlap temperatures are scanned at once, a length at a time.
+    """
+    overlap_temps = np.asarray(overlap_temps, dtype=np.float64)
+    best_temps = np.full(len(overlap_temps), np.inf)
+    best_indexes = np.zeros(len(overlap_temps), dtype=np.int64)
+
+    for start, end in zip(candidates.length_bounds[:-1].tolist(), candidates.length_bounds[1:].tolist()):
+        temps = candidates.temps[start:end]
+        min_temps = np.minimum.accumulate(temps)
+        # Index of the first overlap with the lowest temperature of each prefix of the scan
+        lower = np.ones(len(temps), dtype=bool)
+        lower[1:] = temps[1:] < min_temps[:-1]
+        min_indexes = np.maximum.accumulate(np.where(lower, np.arange(len(temps)), 0))
+
+        # Lowest temperatures found after each overlap of the length (rows are overlap temperatures)
+        found_temps = np.minimum(best_temps[:, np.newaxis], min_temps[np.newaxis, :])
+        in_range = np.abs(found_temps - overlap_temps[:, np.newaxis]) < half_temp_range
+        stops = np.where(in_range.any(axis=1), in_range.argmax(axis=1), len(temps) - 1)
+
+        improved = min_temps[stops] < best_temps
+        best_temps[improved] = min_temps[stops][improved]
+        best_indexes[improved] = start + min_indexes[stops][improved]
+
+    return best_indexes
+
+
+def find_best_overlaps_for_temps(sequence: str, min_five_end_size: int, min_overlap_size: int,
+                                 max_overlap_size: int, mutations: List[AminoMutation], overlap_temps: List[float],
+                                 temp_calculator: TemperatureCalculator, half_temp_range: float) \
+        -> List[List[SSMPrimerSpec]]:
+    """
+    Same as `find_best_overlaps` for each of overlap temperatures. Candidate overlaps of each mutation
+    and their temperatures are computed only once for all overlap temperatures.
+    """
+    results: List[List[SSMPrimerSpec]] = [[] for _ in overlap_temps]
 
-        results.append(SSMPrimerSpec(best_offset, best_length, 0, best_tm))
+    for mutation in mutations:
+        candidates = create_overlap_candidates(sequence, min_five_end_size, min_overlap_size, max_overlap_size,
+                                               mutation, temp_calculator)
+        best_indexes = find_best_overlap_indexes(candidates, overlap_temps, half_temp_range)
+
+        for overlaps, index in zip(results, best_indexes.tolist()):
+            overlaps.append(SSMPrimerSpec(candidates.offsets[index].item(), candidates.lengths[index].item(), 0,
+                                          candidates.temps[index].item()))
 
     return results
 
 
+def find_best_overlaps(sequence: str, min_five_end_size: int, min_overlap_size: int, max_overlap_size: int,
+                       mutations: List[AminoMutation], overlap_temp: float,
+                       temp_calculator: TemperatureCalculator, half_temp_range: float) \
+        -> List[SSMPrimerSpec]:
+    """
+    Takes a list of mutations and a target overlap temperature and finds one overlap at each site
+    such that they are all close to the given overlap temperature.
+    """
+    return find_best_overlaps_for_temps(sequence, min_five_end_size, min_overlap_size, max_overlap_size, mutations,
+                                        [overlap_temp], temp_calculator, half_temp_range)[0]
+
+
 def grow_forward_primer(max_primer_size: int, min_three_end_size: int, sequence: str, mutation: AminoMutation,
                         overlap: SSMPrimerSpec, temp_threshold: float,
                         temp_calculator: TemperatureCalculator) -> SSMPrimerSpec:
@@ -76,14 +139,22 @@ def grow_forward_primer(max_primer_size: int, min_three_end_size: int, sequence:
     Grows a forward primer from a given overlap, and returns the shortest primer which has
     3' Tm above the temperature threshold. The 3' is defined by the given mutation.
     """
-    for length in range(overlap.length + 1, max_primer_size):
-        mutation_end = mutation.position + mutation.length
-        fw_three_end_size = (overlap.offset + length) - mutation_end
-        fw_three_end_sequence = sequence[mutation_end:(mutation_end + fw_three_end_size)]
-        fw_three_end_temp = temp_calculator(fw_three_end_sequence)
+    sequence_temp = temp_calculator.for_sequence(sequence)
+    mutation_end = mutation.position + mutation.length
+
+    lengths = np.arange(overlap.length + 1, max_primer_size)
+    three_end_sizes = (overlap.offset + lengths) - mutation_end
+    # 3' end sizes grow with the length, skip the ones which are too short
+    first_valid = int(np.searchsorted(three_end_sizes, min_three_end_size))
+
+    index = sequence_temp.first_reaching(mutation_end, mutation_end + three_end_sizes[first_valid:],
+                                         temp_threshold, strict=True)
+    # If the threshold is not reached, the longest primer is used
+    index = len(lengths) - 1 if index is None else first_valid + index
 
-        if fw_three_end_temp > temp_threshold and fw_three_end_size >= min_three_end_size:
-            break
+    length = int(lengths[index])
+    fw_three_end_size = int(three_end_sizes[index])
+    fw_three_end_temp = sequence_temp(mutation_end, mutation_end + fw_three_end_size)
 
     return SSMPrimerSpec(overlap.offset, length, fw_three_end_size, fw_three_end_temp)
 
@@ -97,16 +168,21 @@ def grow_reverse_primer(max_primer_size: int, min_three_end_size: int, sequence:
     """
     overlap_end = overlap.offset + overlap.length
     min_offset = max(0, overlap_end - max_primer_size)
+    sequence_temp = temp_calculator.for_sequence(sequence)
 
-    for offset in reversed(range(min_offset, overlap.offset)):
-        rw_three_end_sequence = sequence[offset:mutation.position]
-        rw_three_end_temp = temp_calculator(rw_three_end_sequence)
+    offsets = np.arange(overlap.offset - 1, min_offset - 1, -1)
+    three_end_sizes = mutation.position - offsets
+    first_valid = int(np.searchsorted(three_end_sizes, min_three_end_size))
 
-        if rw_three_end_temp > temp_threshold and len(rw_three_end_sequence) >= min_three_end_size:
-            return SSMPrimerSpec(offset, overlap_end - offset, mutation.position - offset, rw_three_end_temp)
+    index = sequence_temp.first_reaching(offsets[first_valid:], mutation.position, temp_threshold, strict=True)
 
-    # If we get here, no suitable primer was found
-    raise RuntimeError("Could not find suitable reverse primer: parameters may be too restrictive.")
+    if index is None:
+        raise RuntimeError("Could not find suitable reverse primer: parameters may be too restrictive.")
+
+    offset = int(offsets[first_valid + index])
+    rw_three_end_temp = sequence_temp(offset, mutation.position)
+
+    return SSMPrimerSpec(offset, overlap_end - offset, mutation.position - offset, rw_three_end_temp)
 
 
 def grow_primers(max_primer_size: int, min_three_end_size: int, sequence: str, mutations: List[AminoMutation],
@@ -129,24 +205,25 @@ def grow_primers(max_primer_size: int, min_three_end_size: int, sequence: str, m
     return fw_primers, rw_primers
 
 
-def compute_heterodimer_err(fw_sequence: str, rw_sequence: str,
-                            solution: SSMGrownSolution, flanks: SSMFlankingSequences,
-                            pd_calc: PrimerDimerCalculator):
+def compute_heterodimer_errs(fw_sequences: List[str], rw_sequences: List[str],
+                             fw_temp: float, rw_temp: float, flanks: SSMFlankingSequences,
+                             pd_calc: PrimerDimerCalculator) -> np.ndarray:
     """
-    Computes error of hetrodimer temperature for forward and reverse primers
-    :param fw_sequence: forward primer sequence
-    :param rw_sequence:  reverse primer sequence
-    :param solution: current solution -> needed for solution temperature
+    Computes errors of hetrodimer temperature for forward and reverse primers
+    :param fw_sequences: forward primer sequences
+    :param rw_sequences:  reverse primer sequences
+    :param fw_temp: forward reaction temperature of the solution
+    :param rw_temp: reverse reaction temperature of the solution
     :param flanks: flanking primers
     :param pd_calc: primer dimer calculator
-    :return:
+    :return: array of errors, one for each pair of forward and reverse primer
     """
 
     if flanks.forward_flank is None or flanks.reverse_flank is None:
-        return 0
+        return np.zeros(len(fw_sequences))
 
-    return (pd_calc.heterodimer(fw_sequence, flanks.reverse_flank) - solution.fw_temp) ** 2 + \
-           (pd_calc.heterodimer(rw_sequence, flanks.forward_flank) - solution.rw_temp) ** 2
+    return (pd_calc.heterodimers(fw_sequences, [flanks.reverse_flank] * len(fw_sequences)) - fw_temp) ** 2 + \
+           (pd_calc.heterodimers(rw_sequences, [flanks.forward_flank] * len(rw_sequences)) - rw_temp) ** 2
 
 
 def calc_GC_content(sequence):
@@ -158,6 +235,16 @@ def calc_GC_content(sequence):
     return (sequence.upper().count('G') + sequence.upper().count('G')) / len(sequence) * 100
 
 
+def calc_GC_contents(sequence: str, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Calculates calc_GC_content of substrings sequence[starts[i]:ends[i]] from prefix sums of the sequence
+    """
+    counts = np.zeros(len(sequence) + 1, dtype=np.int64)
+    np.cumsum(np.frombuffer(sequence.upper().encode(), dtype=np.uint8) == ord('G'), out=counts[1:])
+    g_counts = counts[ends] - counts[starts]
+    return (g_counts + g_counts) / (ends - starts) * 100
+
+
 def get_GC_overflow(sequence, min_gc, max_gc):
     """
     Function returns how much is GC content outside of desired boundaries
@@ -176,19 +263,43 @@ def compute_grown_solution_score(config: SSMConfig, sequence: str, solution: SSM
     """
     Calculates the scores for a given grown solution.
     """
+    return compute_primer_pair_scores(config, sequence, solution.fw_primers, solution.rw_primers, solution.overlaps,
+                                      solution.fw_temp, solution.rw_temp, solution.overlap_temp, flanks, pd_calc)
+
+
+def compute_primer_pair_scores(config: SSMConfig, sequence: str, fw_primers: List[SSMPrimerSpec],
+                               rw_primers: List[SSMPrimerSpec], overlaps: List[SSMPrimerSpec],
+                               fw_temp: float, rw_temp: float, overlap_temp: float,
+                               flanks: SSMFlankingSequences, pd_calc: PrimerDimerCalculator) -> List[float]:
+    """
+    Calculates the scores of primer pairs for given reaction temperatures of a grown solution.
+    """
     scores = []
     min_primer_size = config.min_primer_size
     max_temp_range = config.three_end_temp_range / 2
 
-    for fw, rw, overlap in zip(solution.fw_primers, solution.rw_primers, solution.overlaps):
-        fw_sequence = sequence[fw.offset:(fw.offset + fw.length)]
-        rw_sequence = sequence[rw.offset:(rw.offset + rw.length)]
+    fw_sequences = [sequence[fw.offset:(fw.offset + fw.length)] for fw in fw_primers]
+    rw_sequences = [sequence[rw.offset:(rw.offset + rw.length)] for rw in rw_primers]
+
+    if config.compute_hairpin_homodimer:
+        # Temperatures of all primers are computed in a batch
+        fw_hairpin_errs = (fw_temp - pd_calc.hairpins(fw_sequences)) ** 2
+        rw_hairpin_errs = (rw_temp - pd_calc.hairpins(rw_sequences)) ** 2
+
+        fw_homodimer_errs = (fw_temp - pd_calc.homodimers(fw_sequences)) ** 2
+        rw_homodimer_errs = (rw_temp - pd_calc.homodimers(rw_sequences)) ** 2
 
-        fw_temp_err = abs(fw.three_end_temp - solution.fw_temp)
+        heterodimer_errs = compute_heterodimer_errs(fw_sequences, rw_sequences, fw_temp, rw_temp, flanks, pd_calc)
+
+    for i, (fw, rw, overlap) in enumerate(zip(fw_primers, rw_primers, overlaps)):
+        fw_sequence = fw_sequences[i]
+        rw_sequence = rw_sequences[i]
+
+        fw_temp_err = abs(fw.three_end_temp - fw_temp)
         fw_temp_err = 0 if fw_temp_err < max_temp_range else fw_temp_err ** 2
-        rw_temp_err = abs(rw.three_end_temp - solution.rw_temp)
+        rw_temp_err = abs(rw.three_end_temp - rw_temp)
         rw_temp_err = 0 if rw_temp_err < max_temp_range else rw_temp_err ** 2
-        overlap_temp_err = abs(overlap.three_end_temp - solution.overlap_temp)
+        overlap_temp_err = abs(overlap.three_end_temp - overlap_temp)
         overlap_temp_err = 0 if overlap_temp_err < max_temp_range else overlap_temp_err**2
 
         fw_size_err = (fw.length - min_primer_size) ** 2
@@ -208,15 +319,13 @@ def compute_grown_solution_score(config: SSMConfig, sequence: str, solution: SSM
         )
 
         if config.compute_hairpin_homodimer:
+            fw_hairpin_err = fw_hairpin_errs[i].item()
+            rw_hairpin_err = rw_hairpin_errs[i].item()
 
-            fw_hairpin_err = (solution.fw_temp - pd_calc.hairpin(fw_sequence)) ** 2
-            rw_hairpin_err = (solution.rw_temp - pd_calc.hairpin(rw_sequence)) ** 2
+            fw_homodimer_err = fw_homodimer_errs[i].item()
+            rw_homodimer_err = rw_homodimer_errs[i].item()
 
-            fw_homodimer_err = (solution.fw_temp - pd_calc.homodimer(fw_sequence)) ** 2
-            rw_homodimer_err = (solution.rw_temp - pd_calc.homodimer(rw_sequence)) ** 2
-
-            heterodimer_err = compute_heterodimer_err(fw_sequence, rw_sequence,
-                                                      solution, flanks, pd_calc)
+            heterodimer_err = heterodimer_errs[i].item()
             # we need to do square root here because we want to keep consistent score computation to
             # primer3 workflow in ssm.py at line 530 -> we cannot do it together therefore we separate it here too
             score += math.sqrt(
@@ -231,21 +340,100 @@ def compute_grown_solution_score(config: SSMConfig, sequence: str, solution: SSM
     return scores
 
 
+class GrownSolutionScorer:
+    """
+    Calculates the scores of grown solutions like `compute_grown_solution_score`. Solutions of different
+    temperature combinations share many primer pairs with the same reaction temperatures, so scores
+    are memoized by overlap, forward and reverse primer specs and the reaction temperatures.
+    """
+
+    def __init__(self, config: SSMConfig, sequence: str, flanks: SSMFlankingSequences) -> None:
+        self.config = config
+        self.sequence = sequence
+        self.flanks = flanks
+        # we create calculator here because it contains cache of precomputed temperatures
+        self.pd_calc = PrimerDimerCalculator(config.temperature_config.k,
+                                             config.temperature_config.mg,
+                                             config.temperature_config.dntp,
+                                             cached=True)
+        self.scores: Dict[Tuple, float] = {}
+
+    def __call__(self, solution: SSMGrownSolution) -> List[float]:
+        return self.score_pairs(solution.overlaps, solution.fw_primers, solution.rw_primers,
+                                solution.fw_temp, solution.rw_temp, solution.overlap_temp)
+
+    def score_pairs(self, overlaps: List[SSMPrimerSpec], fw_primers: List[SSMPrimerSpec],
+                    rw_primers: List[SSMPrimerSpec], fw_temp: float, rw_temp: float, overlap_temp: float) \
+            -> List[float]:
+        reaction_temps = (fw_temp, rw_temp, overlap_temp)
+        keys = [(overlap, fw, rw) + reaction_temps for overlap, fw, rw in zip(overlaps, fw_primers, rw_primers)]
+
+        missing = list(dict.fromkeys(key for key in keys if key not in self.scores))
+        if len(missing) > 0:
+            scores = compute_primer_pair_scores(self.config, self.sequence,
+                                                [key[1] for key in missing],
+                                                [key[2] for key in missing],
+                                                [key[0] for key in missing],
+                                                *reaction_temps, self.flanks, self.pd_calc)
+            self.scores.update(zip(missing, scores))
+
+        return [self.scores[key] for key in keys]
+
+
 def pick_best_grown_solution(config: SSMConfig, sequence: str, solutions: List[SSMGrownSolution],
-                             flanks: SSMFlankingSequences) -> SSMGrownSolution:
+                             flanks: SSMFlankingSequences,
+                             scorer: Optional[GrownSolutionScorer] = None) -> SSMGrownSolution:
+    if scorer is None:
+        scorer = GrownSolutionScorer(config, sequence, flanks)
+
     best_solution = solutions[0]
-    # we create calculator here because it contains cache of precomputed temperatures
-    pd_calc = PrimerDimerCalculator(config.temperature_config.k,
-                                    config.temperature_config.mg,
-                                    config.temperature_config.dntp,
-                                    cached=True)
-    best_score = sum(compute_grown_solution_score(config, sequence, best_solution, flanks, pd_calc))
+    best_score = sum(scorer(best_solution))
 
     for current_solution in solutions:
-        current_score = sum(compute_grown_solution_score(config, sequence, current_solution, flanks, pd_calc))
+        current_score = sum(scorer(current_solution))
 
         if current_score < best_score:
             best_solution = current_solution
             best_score = current_score
 
     return best_solution
+
+
+def find_alternative_pairs(solutions: List[SSMGrownSolution], best_solution: SSMGrownSolution,
+                           scorer: GrownSolutionScorer, count: int) -> List[List[SSMGrownPrimerPair]]:
+    """
+    Returns up to `count` next best primer pairs of each mutation, ordered by non-optimality. Candidates are
+    the distinct pairs grown for all temperature combinations, scored at the reaction temperatures
+    of the best solution.
+    """
+    candidates: List[List[Tuple[SSMPrimerSpec, SSMPrimerSpec, SSMPrimerSpec]]] = []
+    for i, best_pair in enumerate(zip(best_solution.overlaps, best_solution.fw_primers, best_solution.rw_primers)):
+        pairs = dict.fromkeys((solution.overlaps[i], solution.fw_primers[i], solution.rw_primers[i])
+                              for solution in solutions)
+        pairs.pop(best_pair, None)
+        candidates.append(list(pairs))
+
+    # Candidates of all mutations are scored in a batch
+    all_candidates = [pair for pairs in candidates for pair in pairs]
+    all_scores = np.array(scorer.score_pairs([pair[0] for pair in all_candidates],
+                                             [pair[1] for pair in all_candidates],
+                                             [pair[2] for pair in all_candidates],
+                                             best_solution.fw_temp, best_solution.rw_temp,
+                                             best_solution.overlap_temp), dtype=np.float64)
+
+    alternatives = []
+    start = 0
+    for pairs in candidates:
+        scores = all_scores[start:start + len(pairs)]
+        start += len(pairs)
+
+        width = min(count, len(pairs))
+        if width <= 0:
+            alternatives.append([])
+            continue
+
+        best_idxs = np.argpartition(scores, width - 1)[:width]
+        best_idxs = best_idxs[np.lexsort((best_idxs, scores[best_idxs]))]
+        alternatives.append([SSMGrownPrimerPair(*pairs[idx], scores[idx].item()) for idx in best_idxs.tolist()])
+
+    return alternatives
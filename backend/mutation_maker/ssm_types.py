@@ -25,7 +25,7 @@ from jsonobject import (BooleanProperty, FloatProperty,
                         ObjectProperty, StringProperty)
 
 from mutation_maker.mutation import parse_codon_mutation, AminoMutation
-from mutation_maker.primer import Primer
+from mutation_maker.primer import Primer, PrimerTable
 from mutation_maker.temperature_calculator import TemperatureConfig
 
 
@@ -192,6 +192,18 @@ class SSMConfig(JsonObject):
     # (ref. https://github.com/matteoferla/mutational_scanning)
     use_fast_approximation_algorithm = BooleanProperty(default=True)
 
+    # When set to true, temperature combinations (fast approximation) or mutations are solved
+    # by a pool of processes, its size is capped by the SSM_PROCESSES environment variable.
+    parallel_solve = BooleanProperty(default=False)
+
+    # When set to true, temperature combinations of the full search which cannot have a better solution
+    # than the best one found are not scored. The solution is the same as without pruning.
+    prune_temp_combinations = BooleanProperty(default=True)
+
+    # Number of next best primer pairs of each mutation returned along with the best one,
+    # as alternatives for primers which fail in the lab.
+    alternative_primer_pairs = IntegerProperty(default=0)
+
     # This option determins if we use flanking primers for computing 3' Tm,
     # or if we use the user specified 3' Tm range.
     exclude_flanking_primers = BooleanProperty(default=False)
@@ -232,6 +244,15 @@ class PrimerOutput(JsonObject):
     parameters_in_range = BooleanProperty(required=True)
 
 
+class SSMAlternativeOutput(JsonObject):
+    non_optimality = FloatProperty(required=True)
+    parameters_in_range = BooleanProperty(required=True)
+
+    forward_primer = ObjectProperty(PrimerOutput)
+    reverse_primer = ObjectProperty(PrimerOutput)
+    overlap = ObjectProperty(OverlapOutput)
+
+
 class SSMMutationOutput(JsonObject):
     mutation = StringProperty(required=True)
     non_optimality = FloatProperty(required=True)
@@ -243,11 +264,14 @@ class SSMMutationOutput(JsonObject):
     forward_primer = ObjectProperty(PrimerOutput)
     reverse_primer = ObjectProperty(PrimerOutput)
     overlap = ObjectProperty(OverlapOutput)
+    # Next best primer pairs, at most `alternative_primer_pairs`, ordered by non-optimality
+    alternatives = ListProperty(SSMAlternativeOutput)
 
 
 class SSMOutput(JsonObject):
     input_data = ObjectProperty(SSMInput, required=True)
-    results = ListProperty(SSMMutationOutput, required=True)
+    # Empty in the first output yielded by `ssm_solve_stream`, results of mutations follow it
+    results = ListProperty(SSMMutationOutput)
     full_sequence = StringProperty(required=True)
     goi_offset = IntegerProperty(required=True)
     new_sequence_start = IntegerProperty(required=True)
@@ -314,8 +338,8 @@ class SSMPrimerPair:
 
 class SSMPrimerPossibilities:
     def __init__(self, mutation,
-                 forward_primers: List[Primer], fw_sizes: np.ndarray, fw_temps: np.ndarray, fw_gc_contents: np.ndarray,
-                 reverse_primers: List[Primer], rw_sizes: np.ndarray, rw_temps: np.ndarray, rw_gc_contents: np.ndarray,) \
+                 forward_primers: PrimerTable, fw_sizes: np.ndarray, fw_temps: np.ndarray, fw_gc_contents: np.ndarray,
+                 reverse_primers: PrimerTable, rw_sizes: np.ndarray, rw_temps: np.ndarray, rw_gc_contents: np.ndarray,) \
                  -> None:
         self.mutation = mutation
 
@@ -356,6 +380,10 @@ class SSMSolution:
         self.reverse_temp = reverse_temp_opt
         self.overlap_temp = overlap_temp
         self.result = result
+        # Next best primer pairs of each mutation, ordered by non-optimality
+        self.alternatives: List[List[SSMPrimerPair]] = [[] for _ in result]
+        # Number of temperature combinations which were not scored when searching for this solution
+        self.pruned_combinations = 0
 
         half_temp_range = temp_range / 2
 
@@ -385,6 +413,13 @@ class SSMPrimerSpec(NamedTuple):
     three_end_temp: float
 
 
+class SSMGrownPrimerPair(NamedTuple):
+    overlap: SSMPrimerSpec
+    fw_primer: SSMPrimerSpec
+    rw_primer: SSMPrimerSpec
+    non_optimality: float
+
+
 class SSMGrownSolution:
     overlaps: List[SSMPrimerSpec]
     fw_primers: List[SSMPrimerSpec]
@@ -400,6 +435,8 @@ class SSMGrownSolution:
         self.overlaps = overlaps
         self.fw_primers = fw_primers
         self.rw_primers = rw_primers
+        # Next best primer pairs of each mutation, ordered by non-optimality
+        self.alternatives: List[List[SSMGrownPrimerPair]] = [[] for _ in overlaps]
 
         half_temp_range = 2.5
 
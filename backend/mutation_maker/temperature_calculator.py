@@ -15,13 +15,22 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import math
+import os
+import sqlite3
+from collections import OrderedDict
 from functools import partial
-from typing import List, Tuple, NamedTuple
+from typing import List, Tuple, NamedTuple, Optional, Dict, Sequence, Union, Iterable
 
+import numpy as np
+from Bio.Seq import Seq
 from Bio.SeqUtils import MeltingTemp
 from jsonobject import (StringProperty, IntegerProperty, FloatProperty, JsonObject)
 from primer3 import calcHairpin, calcHomodimer, calcTm, calcHeterodimer
 
+from .process_pool import create_process_pool, in_pool_worker
+
 gc_value_sets = ["Chester_1993", "QuickChange", "Schildkraut_1965", "Wetmur_Melting_1991",
                  "Wetmur_RNA_1991", "Wetmur_DNA_RNA_1991", "Primer3", "Ahsen_2001"]
 nn_tables = ["SantaLucia_1997", "SantaLucia_2004", "Breselauer_1986", "Sugimoto_1996"]
@@ -73,23 +82,269 @@ def get_all_temp_ranges_between(minimum, maximum, range_size, increment) -> List
     return ranges
 
 
+# Default maximum number of entries of a shared temperature cache
+DEFAULT_CACHE_SIZE = 200000
+# Sequence calculators hold prefix arrays of whole genes/plasmids, only a few are kept
+SEQUENCE_CACHE_SIZE = 32
+
+
+class TemperatureStore:
+    """
+    Persistent cache of computed temperatures in an SQLite database, shared by all processes
+    using the same file. Each process opens its own connection (also after fork) and writes
+    in batches. Database runs in WAL mode, so readers do not block the writer.
+    Store is best effort, database errors only cause values to be recomputed.
+    """
+    # Number of pending values written in one transaction
+    BATCH_SIZE = 1000
+
+    def __init__(self, path: str, timeout: float = 10.0):
+        self.path = path
+        self.timeout = timeout
+        self.connection = None
+        self.pid = None
+        self.pending = []
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self.pid != os.getpid():
+            # Connections must not be shared with forked children
+            self.connection = None
+            self.pending = []
+            self.pid = os.getpid()
+            try:
+                connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS temperatures ("
+                                   "cache TEXT NOT NULL, sequence TEXT NOT NULL, temperature REAL NOT NULL, "
+                                   "PRIMARY KEY (cache, sequence)) WITHOUT ROWID")
+                connection.commit()
+                self.connection = connection
+            except sqlite3.Error as e:
+                print("Cannot open temperature store {}: {}".format(self.path, e))
+        return self.connection
+
+    def get(self, cache: str, sequence: str) -> Optional[float]:
+        connection = self._connect()
+        if connection is None:
+            return None
+        try:
+            row = connection.execute("SELECT temperature FROM temperatures WHERE cache = ? AND sequence = ?",
+                                     (cache, sequence)).fetchone()
+        except sqlite3.Error:
+            return None
+        return None if row is None else row[0]
+
+    def put(self, cache: str, sequence: str, temperature: float):
+        if self._connect() is None:
+            return
+        self.pending.append((cache, sequence, float(temperature)))
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """ Writes pending values to the database """
+        connection = self._connect()
+        if connection is None or not self.pending:
+            return
+        try:
+            with connection:
+                connection.executemany("INSERT OR IGNORE INTO temperatures VALUES (?, ?, ?)", self.pending)
+        except sqlite3.Error as e:
+            print("Cannot write to temperature store {}: {}".format(self.path, e))
+        self.pending = []
+
+
+class TemperatureCache:
+    """
+    Least recently used cache of computed temperatures with a maximum number of entries.
+    Counts hits and misses, so that the effectiveness of the cache can be reported.
+    Values missing in memory are looked up in the persistent store, if there is one.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE, store: Optional[TemperatureStore] = None,
+                 name: str = None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+        self.store = store
+        # Name of the cache in the persistent store
+        self.name = name
+
+    def get(self, key):
+        """ Returns cached value or None if the key is not cached """
+        value = self.entries.get(key)
+        if value is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+        if self.store is not None:
+            value = self.store.get(self.name, key)
+            if value is not None:
+                self.store_hits += 1
+                self._insert(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._insert(key, value)
+        if self.store is not None:
+            self.store.put(self.name, key, value)
+
+    def _insert(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def resize(self, max_size: int):
+        self.max_size = max_size
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "store_hits": self.store_hits, "misses": self.misses,
+                "size": len(self.entries)}
+
+
+# Caches shared by all calculators in the process, keyed by what they compute
+_temperature_caches: Dict[Tuple, TemperatureCache] = {}
+# Persistent store of the caches, None if disabled
+_temperature_store: Optional[TemperatureStore] = None
+
+
+def _persistent(key: Tuple) -> bool:
+    # Sequence calculators are objects, not values
+    return key[0] != "sequence"
+
+
+def _store_name(key: Tuple) -> str:
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def get_temperature_cache(key: Tuple, max_size: int = None) -> TemperatureCache:
+    """
+    Returns process wide cache for the given key, e.g. ("tm",) + TemperatureConfig.cache_key().
+    Calculators with the same key compute the same values, so they can share cached results.
+    """
+    cache = _temperature_caches.get(key)
+    if cache is None:
+        cache = TemperatureCache(DEFAULT_CACHE_SIZE if max_size is None else max_size)
+        if _temperature_store is not None and _persistent(key):
+            cache.store = _temperature_store
+            cache.name = _store_name(key)
+        _temperature_caches[key] = cache
+    return cache
+
+
+def configure_temperature_caches(max_size: int):
+    """ Sets maximum number of entries of all temperature caches, except the sequence calculator ones """
+    global DEFAULT_CACHE_SIZE
+    DEFAULT_CACHE_SIZE = max_size
+    for key, cache in _temperature_caches.items():
+        if _persistent(key):
+            cache.resize(max_size)
+
+
+def enable_persistent_temperature_caches(path: Optional[str]):
+    """
+    Backs temperature caches with an SQLite database at the given path, which is shared
+    by all processes using it and survives restarts. None disables the persistent store.
+    """
+    global _temperature_store
+    flush_temperature_caches()
+    _temperature_store = None if path is None else TemperatureStore(path)
+    for key, cache in _temperature_caches.items():
+        if _persistent(key):
+            cache.store = _temperature_store
+            cache.name = _store_name(key)
+
+
+def flush_temperature_caches():
+    """ Writes values pending in memory to the persistent store """
+    if _temperature_store is not None:
+        _temperature_store.flush()
+
+
+def temperature_cache_stats() -> Dict[str, Dict[str, int]]:
+    return {" ".join(str(part) for part in key): cache.stats() for key, cache in _temperature_caches.items()}
+
+
+def reset_temperature_cache_stats():
+    for cache in _temperature_caches.values():
+        cache.reset_stats()
+
+
+def clear_temperature_caches():
+    _temperature_caches.clear()
+
+
 class TemperatureCalculator:
-    def __init__(self, calculation_method, precision: int, cached: bool = True):
+    def __init__(self, calculation_method, precision: int, cached: bool = True,
+                 config: Optional["TemperatureConfig"] = None):
         self.calculation_method = calculation_method
         self.precision = precision
         self.precision_increment = 1 / (10**precision)
         self.cached = cached
-        self.cache = {}
+        # Config the calculation method was created from, used to build sequence calculators
+        self.config = config
+        if config is None:
+            self.cache = TemperatureCache()
+            self.sequence_calculators = TemperatureCache(SEQUENCE_CACHE_SIZE)
+        else:
+            self.cache = get_temperature_cache(("tm",) + config.cache_key())
+            self.sequence_calculators = get_temperature_cache(("sequence",) + config.cache_key(),
+                                                              SEQUENCE_CACHE_SIZE)
+
+    def for_sequence(self, sequence: str) -> "SequenceTemperatureCalculator":
+        """
+        Returns calculator of melting temperatures of substrings of the given sequence,
+        which is created only once per sequence.
+        """
+        sequence_calculator = self.sequence_calculators.get(sequence)
+        if sequence_calculator is None:
+            sequence_calculator = SequenceTemperatureCalculator(sequence, self)
+            self.sequence_calculators.put(sequence, sequence_calculator)
+        return sequence_calculator
+
+    def many(self, primers: Union[Sequence[str], Tuple[np.ndarray, np.ndarray]],
+             sequence: Optional[str] = None, dtype=np.float32,
+             mismatches: Optional[Iterable[int]] = None) -> np.ndarray:
+        """
+        Melting temperatures of many primers as a float32 (or dtype) array. Primers are either a list
+        of sequences, or a tuple of start and end index arrays of substrings of the sequence.
+        Substrings can have mismatches at the given offsets of the sequence, which are treated
+        as "X" bases without building the mismatch sequences.
+        """
+        if sequence is not None:
+            starts, ends = primers
+            if mismatches is not None:
+                return self.for_sequence(sequence).many_mismatched(starts, ends, mismatches, dtype)
+            return self.for_sequence(sequence).many(starts, ends, dtype)
+        primers_calculator, starts, ends = SequenceTemperatureCalculator.for_primers(primers, self)
+        return primers_calculator.many(starts, ends, dtype)
 
     def __call__(self, primer: str) -> float:
         if len(primer) > 0:
             if self.cached:
-                if primer in self.cache:
-                    return self.cache[primer]
+                temp = self.cache.get(primer)
+                if temp is not None:
+                    return temp
             temp = self.calculation_method(primer)
             temp = round(temp, self.precision)
             if self.cached:
-                self.cache[primer] = temp
+                self.cache.put(primer, temp)
             return temp
         else:
             # TODO remove and let raise exception
@@ -97,15 +352,83 @@ class TemperatureCalculator:
         raise ValueError("Cannot calculate temperature of empty primer")
 
 
+# Number of sequences evaluated by one task of the thermodynamics process pool
+THERMO_CHUNK_SIZE = 256
+# Number of processes evaluating primer3 thermodynamics of large batches of each worker process,
+# 1 evaluates them in-process. Celery starts a worker process per CPU by default, so the default is 1.
+THERMO_PROCESSES = int(os.environ.get("THERMO_PROCESSES", 1))
+
+_thermo_executor = None
+_thermo_executor_pid: Optional[int] = None
+
+
+class ThermoResults(NamedTuple):
+    """ Results of a batch of primer3 thermodynamic computations """
+    tm: np.ndarray
+    structure_found: np.ndarray
+
+
+def _thermo_chunk(kind: str, sequences: Sequence, monovalent: float, divalent: float,
+                  dntp: float) -> List[Tuple[float, bool]]:
+    results = []
+    for sequence in sequences:
+        if kind == "hairpin":
+            result = calcHairpin(sequence, monovalent, divalent, dntp)
+        elif kind == "homodimer":
+            result = calcHomodimer(sequence, monovalent, divalent, dntp)
+        elif kind == "heterodimer":
+            result = calcHeterodimer(sequence[0], sequence[1], monovalent, divalent, dntp)
+        else:
+            raise ValueError("Unknown kind of thermodynamic computation " + kind)
+        results.append((result.tm, result.structure_found))
+    return results
+
+
+def _get_thermo_executor():
+    global _thermo_executor, _thermo_executor_pid
+    if THERMO_PROCESSES <= 1 or in_pool_worker():
+        return None
+    if _thermo_executor_pid != os.getpid():
+        # Executor of the parent process cannot be used after fork
+        _thermo_executor = create_process_pool(THERMO_PROCESSES)
+        _thermo_executor_pid = os.getpid()
+    return _thermo_executor
+
+
+def calc_thermo_batch(kind: str, sequences: Sequence, monovalent: float, divalent: float,
+                      dntp: float) -> ThermoResults:
+    """
+    Computes "hairpin", "homodimer" or "heterodimer" melting temperatures of many sequences
+    (pairs of sequences for heterodimers) with Primer3 library. Every distinct sequence is
+    evaluated only once, batches larger than a chunk are evaluated in chunks by a process pool.
+    Arguments monovalent, divalent and dntp have the same meaning as in the primer3 library.
+    """
+    unique = list(dict.fromkeys(sequences))
+    executor = _get_thermo_executor() if len(unique) > THERMO_CHUNK_SIZE else None
+    if executor is None:
+        results = _thermo_chunk(kind, unique, monovalent, divalent, dntp)
+    else:
+        chunks = [unique[i:i + THERMO_CHUNK_SIZE] for i in range(0, len(unique), THERMO_CHUNK_SIZE)]
+        compute_chunk = partial(_thermo_chunk, kind, monovalent=monovalent, divalent=divalent, dntp=dntp)
+        results = [result for chunk_results in executor.map(compute_chunk, chunks) for result in chunk_results]
+
+    index = {sequence: i for i, sequence in enumerate(unique)}
+    positions = np.fromiter((index[sequence] for sequence in sequences), dtype=np.intp, count=len(sequences))
+    tm = np.array([result[0] for result in results], dtype=np.float64)
+    structure_found = np.array([result[1] for result in results], dtype=bool)
+    return ThermoResults(tm[positions], structure_found[positions])
+
+
 class PrimerDimerCalculator():
     def __init__(self,monovalent: float, divalent: float, dntp: float, cached: bool = True):
         self.cached = cached
-        self.cache_homo = {}
-        self.cache_hairpin = {}
-        self.cache_hetero = {}
         self.mv = monovalent
         self.dv = divalent
         self.dntp = dntp
+        conditions = (float(monovalent), float(divalent), float(dntp))
+        self.cache_homo = get_temperature_cache(("homodimer",) + conditions)
+        self.cache_hairpin = get_temperature_cache(("hairpin",) + conditions)
+        self.cache_hetero = get_temperature_cache(("heterodimer",) + conditions)
 
     def homodimer(self, primer: str) -> float:
         """
@@ -115,11 +438,12 @@ class PrimerDimerCalculator():
         """
         if len(primer) > 0:
             if self.cached:
-                if primer in self.cache_homo:
-                    return self.cache_homo[primer]
+                temp = self.cache_homo.get(primer)
+                if temp is not None:
+                    return temp
             temp = calcHomodimer(primer, self.mv, self.dv, self.dntp).tm
             if self.cached:
-                self.cache_homo[primer] = temp
+                self.cache_homo.put(primer, temp)
             return temp
         else:
             return 0
@@ -132,11 +456,12 @@ class PrimerDimerCalculator():
         """
         if len(primer) > 0:
             if self.cached:
-                if primer in self.cache_hairpin:
-                    return self.cache_hairpin[primer]
+                temp = self.cache_hairpin.get(primer)
+                if temp is not None:
+                    return temp
             temp = calcHairpin(primer, self.mv, self.dv, self.dntp).tm
             if self.cached:
-                self.cache_hairpin[primer] = temp
+                self.cache_hairpin.put(primer, temp)
             return temp
         else:
             return 0
@@ -151,24 +476,87 @@ class PrimerDimerCalculator():
         if len(primer) > 0:
             key = primer + '_' + other_primer
             if self.cached:
-                if key in self.cache_hetero:
-                    return self.cache_hetero[key]
+                temp = self.cache_hetero.get(key)
+                if temp is not None:
+                    return temp
             temp = calcHeterodimer(primer, other_primer, self.mv, self.dv, self.dntp).tm
             if self.cached:
-                self.cache_hetero[key] = temp
+                self.cache_hetero.put(key, temp)
             return temp
         else:
             return 0
 
 
+    def hairpins(self, primers: Sequence[str]) -> np.ndarray:
+        """ Cached hair pin temperatures of many primers computed in a batch """
+        return self._many("hairpin", self.cache_hairpin, primers, primers, primers)
+
+    def homodimers(self, primers: Sequence[str]) -> np.ndarray:
+        """ Cached homodimer temperatures of many primers computed in a batch """
+        return self._many("homodimer", self.cache_homo, primers, primers, primers)
+
+    def heterodimers(self, primers: Sequence[str], other_primers: Sequence[str]) -> np.ndarray:
+        """ Cached heterodimer temperatures of many pairs of primers computed in a batch """
+        keys = [primer + '_' + other_primer for primer, other_primer in zip(primers, other_primers)]
+        return self._many("heterodimer", self.cache_hetero, keys, list(zip(primers, other_primers)), primers)
+
+    def _many(self, kind: str, cache: TemperatureCache, keys: Sequence[str], sequences: Sequence,
+              primers: Sequence[str]) -> np.ndarray:
+        temps = np.zeros(len(keys), dtype=np.float64)
+        missing = []
+        for i, (key, primer) in enumerate(zip(keys, primers)):
+            # Empty primers have zero temperature as in the single primer methods
+            if len(primer) > 0:
+                temp = cache.get(key) if self.cached else None
+                if temp is None:
+                    missing.append(i)
+                else:
+                    temps[i] = temp
+        if missing:
+            missing_temps = calc_thermo_batch(kind, [sequences[i] for i in missing],
+                                              self.mv, self.dv, self.dntp).tm
+            temps[missing] = missing_temps
+            if self.cached:
+                for i, temp in zip(missing, missing_temps.tolist()):
+                    cache.put(keys[i], temp)
+        return temps
+
+
 class NEB_like_calculator():
     def __init__(self, calculation_method="", precision: int = 0, cached: bool = True):
         self.calculation_method = calculation_method
         self.precision = precision
         self.precision_increment = 1 / (10**precision)
         self.cached = cached
-        self.cache = {}
+        self.cache = get_temperature_cache(("tm", "NEB_like", precision))
+        # There is no closed form model for primer3 calcTm, sequence calculators only delegate to it
+        self.config = None
+        self.sequence_calculators = get_temperature_cache(("sequence", "NEB_like", precision),
+                                                          SEQUENCE_CACHE_SIZE)
 
+    def for_sequence(self, sequence: str) -> "SequenceTemperatureCalculator":
+        sequence_calculator = self.sequence_calculators.get(sequence)
+        if sequence_calculator is None:
+            sequence_calculator = SequenceTemperatureCalculator(sequence, self)
+            self.sequence_calculators.put(sequence, sequence_calculator)
+        return sequence_calculator
+
+    def many(self, primers: Union[Sequence[str], Tuple[np.ndarray, np.ndarray]],
+             sequence: Optional[str] = None, dtype=np.float32,
+             mismatches: Optional[Iterable[int]] = None) -> np.ndarray:
+        """
+        Melting temperatures of many primers as a float32 (or dtype) array. Primers are either a list
+        of sequences, or a tuple of start and end index arrays of substrings of the sequence.
+        Substrings can have mismatches at the given offsets of the sequence, which are treated
+        as "X" bases without building the mismatch sequences.
+        """
+        if sequence is not None:
+            starts, ends = primers
+            if mismatches is not None:
+                return self.for_sequence(sequence).many_mismatched(starts, ends, mismatches, dtype)
+            return self.for_sequence(sequence).many(starts, ends, dtype)
+        primers_calculator, starts, ends = SequenceTemperatureCalculator.for_primers(primers, self)
+        return primers_calculator.many(starts, ends, dtype)
 
     def __call__(self, primer: str) -> float:
         """
@@ -182,8 +570,9 @@ class NEB_like_calculator():
         """
         if len(primer) > 0:
             if self.cached:
-                if primer in self.cache:
-                    return self.cache[primer]
+                temp = self.cache.get(primer)
+                if temp is not None:
+                    return temp
             temp = calcTm(
                             primer,
                             dna_conc=(500 / 6) * 7,  # primer is assumed 6x template
@@ -193,7 +582,7 @@ class NEB_like_calculator():
                             salt_corrections_method='owczarzy') + 3 # +3 because NEB documentation recommends it and it is fairly close
             temp = round(temp, self.precision)
             if self.cached:
-                self.cache[primer] = temp
+                self.cache.put(primer, temp)
             return temp
         else:
             # TODO remove and let raise exception
@@ -213,6 +602,11 @@ class HeteroDimerCalculator:
     def __call__(self, primer_seq, other_primer_seq: str) -> float:
         return calcHeterodimer(primer_seq, other_primer_seq, self.mv, self.dv, self.dntp).tm
 
+    def many(self, primer_seqs: Sequence[str], other_primer_seqs: Sequence[str]) -> np.ndarray:
+        """ Temperatures of many pairs of primers computed in a batch """
+        return calc_thermo_batch("heterodimer", list(zip(primer_seqs, other_primer_seqs)),
+                                 self.mv, self.dv, self.dntp).tm
+
 
 class SelfBindingTemps(NamedTuple):
     """ Melting temperatures for forming a hairpin or homodimer """
@@ -234,6 +628,585 @@ class SelfBindingCalculator:
         homodimer_tm = calcHomodimer(primer_seq, self.mv, self.dv, self.dntp).tm
         return SelfBindingTemps(hairpin_tm, homodimer_tm)
 
+    def many(self, primer_seqs: Sequence[str]) -> List[SelfBindingTemps]:
+        """ Temperatures of many primers computed in a batch """
+        hairpin_tms = calc_thermo_batch("hairpin", primer_seqs, self.mv, self.dv, self.dntp).tm
+        homodimer_tms = calc_thermo_batch("homodimer", primer_seqs, self.mv, self.dv, self.dntp).tm
+        return [SelfBindingTemps(hairpin_tm, homodimer_tm)
+                for hairpin_tm, homodimer_tm in zip(hairpin_tms.tolist(), homodimer_tms.tolist())]
+
+
+# Lookup from ASCII code to index of a base in "ACGT", anything else is 4
+_BASE_INDEX = np.full(256, 4, dtype=np.int64)
+for _index, _base in enumerate("ACGT"):
+    _BASE_INDEX[ord(_base)] = _index
+_IS_GC = np.array([0, 1, 1, 0, 0], dtype=np.int64)
+
+
+# Models of melting temperature keyed by TemperatureConfig.cache_key()
+_models: Dict[Tuple, Optional["MeltingTemperatureModel"]] = {}
+
+
+class MeltingTemperatureModel:
+    """
+    Sequence independent part of the Biopython melting temperature methods for a TemperatureConfig.
+
+    Table lookups and salt corrections are resolved once, the temperature is then computed
+    only from the length, the GC count and (for NN) the summed enthalpy and entropy of a
+    perfectly complementary A/C/G/T duplex, in the same way as Tm_Wallace, Tm_GC and Tm_NN do.
+    """
+
+    def __init__(self, config: "TemperatureConfig"):
+        self.calculation_type = config.calculation_type
+        self.saltcorr = config.get_salt_correction_id()
+        self.salt_correction = 0
+        if self.calculation_type == "GC":
+            self._init_gc(config)
+        elif self.calculation_type == "NN":
+            self._init_nn(config)
+        elif self.calculation_type != "Wallace":
+            raise ValueError(f"Calculation type {self.calculation_type} has no closed form model")
+
+    @staticmethod
+    def from_config(config: Optional["TemperatureConfig"]) -> Optional["MeltingTemperatureModel"]:
+        """
+        Returns None for configurations which can't be modeled, this includes the NEB like
+        calculation and salt settings for which Biopython raises an exception.
+        Models are created once for equal configurations.
+        """
+        if config is None:
+            return None
+        key = config.cache_key()
+        if key not in _models:
+            try:
+                _models[key] = MeltingTemperatureModel(config)
+            except (ValueError, ZeroDivisionError):
+                _models[key] = None
+        return _models[key]
+
+    def _init_gc(self, config: "TemperatureConfig"):
+        if self.saltcorr == 5:
+            raise ValueError("Tm_GC does not support salt correction method 5")
+        # Every value set overrides the salt correction with a sequence independent method
+        self.a, self.b, self.c, self.saltcorr = {
+            1: (69.3, 0.41, 650, 0),
+            2: (81.5, 0.41, 675, 0),
+            3: (81.5, 0.41, 675, 1),
+            4: (81.5, 0.41, 500, 2),
+            5: (78.0, 0.7, 500, 2),
+            6: (67.0, 0.8, 500, 2),
+            7: (81.5, 0.41, 600, 1),
+            8: (77.1, 0.41, 528, 4),
+        }[config.get_gc_valueset_id()]
+        if self.saltcorr:
+            self.salt_correction = MeltingTemp.salt_correction(
+                Na=config.na, K=config.k, Tris=config.tris, Mg=config.mg, dNTPs=config.dntp,
+                method=self.saltcorr)
+
+    def _init_nn(self, config: "TemperatureConfig"):
+        table = config.get_nn_table()
+        self.r_log_k = 1.987 * math.log((config.dnac1 - (config.dnac2 / 2.0)) * 1e-9)
+
+        self.init_all_at = self._add(table["init"], table["init_allA/T"])
+        self.init_one_gc = self._add(table["init"], table["init_oneG/C"])
+        # Terminal penalties of the 5' (first) and 3' (last) base, indexed as "ACGT" + invalid
+        self.first_h, self.first_s = [0.0] * 5, [0.0] * 5
+        self.last_h, self.last_s = [0.0] * 5, [0.0] * 5
+        for index, base in enumerate("ACGT"):
+            terminal = table["init_A/T"] if base in "AT" else table["init_G/C"]
+            first = self._add(terminal, table["init_5T/A"]) if base == "T" else terminal
+            last = self._add(terminal, table["init_5T/A"]) if base == "A" else terminal
+            self.first_h[index], self.first_s[index] = first
+            self.last_h[index], self.last_s[index] = last
+
+        # Nearest neighbor stacks indexed by 5 * first + second, with the lookup order of Tm_NN
+        self.stack_h, self.stack_s = [0.0] * 25, [0.0] * 25
+        for first_index, first in enumerate("ACGT"):
+            for second_index, second in enumerate("ACGT"):
+                neighbors = first + second + "/" + str(Seq(first + second).complement())
+                for lookup_table, key in ((MeltingTemp.DNA_IMM1, neighbors),
+                                          (MeltingTemp.DNA_IMM1, neighbors[::-1]),
+                                          (table, neighbors), (table, neighbors[::-1])):
+                    if key in lookup_table:
+                        stack_index = 5 * first_index + second_index
+                        self.stack_h[stack_index], self.stack_s[stack_index] = lookup_table[key][:2]
+                        break
+                else:
+                    raise ValueError(f"Missing nearest neighbor values for {neighbors}")
+
+        if self.saltcorr:
+            self._init_nn_salt_correction(config)
+
+    def _init_nn_salt_correction(self, config: "TemperatureConfig"):
+        # Ion concentrations as in MeltingTemp.salt_correction
+        monovalent = config.na + config.k + config.tris / 2.0
+        self.mg = config.mg * 1e-3
+        if sum((config.k, config.mg, config.tris, config.dntp)) > 0 and self.saltcorr != 7 \
+                and config.dntp < config.mg:
+            monovalent += 120 * math.sqrt(config.mg - config.dntp)
+        mon = monovalent * 1e-3
+        if self.saltcorr in range(1, 7) and not mon:
+            raise ValueError("Total ion concentration of zero is not allowed in this method.")
+
+        if self.saltcorr in (1, 2, 3, 4):
+            self.salt_correction = MeltingTemp.salt_correction(
+                Na=config.na, K=config.k, Tris=config.tris, Mg=config.mg, dNTPs=config.dntp,
+                method=self.saltcorr)
+        elif self.saltcorr in (5, 6):
+            self.log_mon = math.log(mon)
+        elif self.saltcorr == 7:
+            a, b, c, d = 3.92, -0.911, 6.26, 1.42
+            e, f, g = -48.2, 52.5, 8.31
+            if config.dntp > 0:
+                dntps = config.dntp * 1e-3
+                ka = 3e4
+                self.mg = (-(ka * dntps - ka * self.mg + 1.0)
+                           + math.sqrt((ka * dntps - ka * self.mg + 1.0) ** 2
+                                       + 4.0 * ka * self.mg)) / (2.0 * ka)
+            if monovalent > 0:
+                if math.sqrt(self.mg) / mon < 0.22:
+                    # Low magnesium to monovalent ratio falls back to method 6
+                    self.saltcorr = 6
+                    self.log_mon = math.log(mon)
+                    return
+                elif math.sqrt(self.mg) / mon < 6.0:
+                    a = 3.92 * (0.843 - 0.352 * math.sqrt(mon) * math.log(mon))
+                    d = 1.42 * (1.279 - 4.03e-3 * math.log(mon) - 8.03e-3 * math.log(mon) ** 2)
+                    g = 8.31 * (0.486 - 0.258 * math.log(mon) + 5.25e-3 * math.log(mon) ** 3)
+            log_mg = math.log(self.mg)
+            self.owczarzy_constant = a + b * log_mg
+            self.owczarzy_gc = c + d * log_mg
+            self.owczarzy_length = e + f * log_mg + g * log_mg ** 2
+
+    @staticmethod
+    def _add(first, second) -> Tuple[float, float]:
+        return first[0] + second[0], first[1] + second[1]
+
+    def temperature(self, length, gc, delta_h=0.0, delta_s=0.0):
+        """
+        Melting temperature of a duplex with given length, GC count and (for NN) summed
+        nearest neighbor and initiation values. Works for numbers as well as numpy arrays.
+        """
+        if self.calculation_type == "Wallace":
+            return 2.0 * (length - gc) + 4.0 * gc
+        if self.calculation_type == "GC":
+            return self.a + self.b * ((gc / length) * 100) - self.c / length + self.salt_correction
+
+        if self.saltcorr == 5:
+            delta_s = delta_s + 0.368 * (length - 1) * self.log_mon
+        melting_temp = (1000 * delta_h) / (delta_s + self.r_log_k) - 273.15
+        if self.saltcorr in (1, 2, 3, 4):
+            melting_temp = melting_temp + self.salt_correction
+        elif self.saltcorr == 6:
+            correction = ((4.29 * (gc / length) - 3.95) * 1e-5 * self.log_mon) + 9.40e-6 * self.log_mon ** 2
+            melting_temp = 1 / (1 / (melting_temp + 273.15) + correction) - 273.15
+        elif self.saltcorr == 7:
+            correction = (self.owczarzy_constant + (gc / length) * self.owczarzy_gc
+                          + (1 / (2.0 * (length - 1))) * self.owczarzy_length) * 1e-5
+            melting_temp = 1 / (1 / (melting_temp + 273.15) + correction) - 273.15
+        return melting_temp
+
+    def mismatch_temperature(self, length, gc, mismatches, delta_h=0.0, delta_s=0.0):
+        """
+        Melting temperature of a primer with mismatched bases replaced by "X", as computed
+        by Biopython. Tm_GC counts mismatches into the length and subtracts a mismatch penalty
+        (factor D is 1 for all value sets), Tm_NN and Tm_Wallace skip the mismatched bases.
+        Length is the length of the primer, gc and (for NN) nearest neighbor values are those
+        of the bases which are not mismatched.
+        """
+        if self.calculation_type != "GC":
+            return self.temperature(length - mismatches, gc, delta_h, delta_s)
+        percent_gc = ((gc + mismatches * 0.5) / length) * 100 - mismatches * 50.0 / length
+        melting_temp = self.a + self.b * percent_gc - self.c / length + self.salt_correction
+        return melting_temp - mismatches * 100.0 / length
+
+
+# Characters which are removed from a primer to find out whether the model can compute its temperature
+_MODELED_CHARACTERS = str.maketrans("", "", "ACGTX")
+
+
+class CompiledMeltingTemperature:
+    """
+    Melting temperature method of a TemperatureConfig compiled from its model, so that a call
+    does only the sequence dependent arithmetic. Primers made of A, C, G, T and mismatched "X"
+    bases are computed by the model, the other ones by the Biopython method.
+    """
+
+    def __init__(self, model: MeltingTemperatureModel, method):
+        self.model = model
+        self.method = method
+        # Nearest neighbor values of pairs of bases
+        self.stacks = {first + second: (model.stack_h[5 * i + j], model.stack_s[5 * i + j])
+                       for i, first in enumerate("ACGT") for j, second in enumerate("ACGT")} \
+            if model.calculation_type == "NN" else None
+
+    def __call__(self, primer: str) -> float:
+        if primer.translate(_MODELED_CHARACTERS):
+            return self.method(primer)
+        mismatches = primer.count("X")
+        bases = primer.replace("X", "") if mismatches else primer
+        if len(bases) < 2:
+            return self.method(primer)
+
+        model = self.model
+        gc = bases.count("G") + bases.count("C")
+        if model.calculation_type != "NN":
+            return model.mismatch_temperature(len(primer), gc, mismatches)
+
+        init_h, init_s = model.init_one_gc if gc else model.init_all_at
+        first = "ACGT".index(bases[0])
+        last = "ACGT".index(bases[-1])
+        delta_h = init_h + model.first_h[first] + model.last_h[last]
+        delta_s = init_s + model.first_s[first] + model.last_s[last]
+        stacks = self.stacks
+        for i in range(len(bases) - 1):
+            stack_h, stack_s = stacks[bases[i:i + 2]]
+            delta_h += stack_h
+            delta_s += stack_s
+        return model.mismatch_temperature(len(primer), gc, mismatches, delta_h, delta_s)
+
+
+class PrimerTemperatureState:
+    """
+    Melting temperature of a primer sequence[start:end] with mismatches at given offsets
+    (treated as "X" bases), which can be extended by one base to the left or right and
+    updated in constant time. Temperatures are the same as the ones computed by the
+    temperature calculator on the primer sequence with "X" mismatches, primers which
+    can't be modeled are passed to the calculator.
+    """
+
+    def __init__(self, calculator, sequence: str, start: int, end: int, mismatches: Iterable[int] = ()):
+        self.calculator = calculator
+        self.model = MeltingTemperatureModel.from_config(calculator.config)
+        self.sequence = sequence
+        self.mismatches = set(mismatches)
+        self.start = start
+        self.end = start
+        # Counts of mismatched, invalid (other than A, C, G, T) and GC bases
+        self.mismatch_count = 0
+        self.invalid_count = 0
+        self.gc = 0
+        # Nearest neighbor values of the bases which are not mismatched
+        self.first = None
+        self.last = None
+        self.stack_h = 0.0
+        self.stack_s = 0.0
+        for _ in range(start, end):
+            self.extend_right()
+
+    def extend_right(self):
+        """ Adds base sequence[end] to the primer """
+        code = self._add(self.end)
+        if code is not None:
+            if self.last is None:
+                self.first = code
+            elif self.model is not None and self.model.calculation_type == "NN":
+                self.stack_h += self.model.stack_h[5 * self.last + code]
+                self.stack_s += self.model.stack_s[5 * self.last + code]
+            self.last = code
+        self.end += 1
+
+    def extend_left(self):
+        """ Adds base sequence[start - 1] to the primer """
+        self.start -= 1
+        code = self._add(self.start)
+        if code is not None:
+            if self.first is None:
+                self.last = code
+            elif self.model is not None and self.model.calculation_type == "NN":
+                self.stack_h += self.model.stack_h[5 * code + self.first]
+                self.stack_s += self.model.stack_s[5 * code + self.first]
+            self.first = code
+
+    def _add(self, position: int) -> Optional[int]:
+        """ Counts the base at the position, returns its code if it is a valid base, which is not mismatched """
+        if position in self.mismatches:
+            self.mismatch_count += 1
+            return None
+        code = "ACGT".find(self.sequence[position])
+        if code < 0:
+            self.invalid_count += 1
+            return None
+        if code == 1 or code == 2:
+            self.gc += 1
+        return code
+
+    def get_mismatch_sequence(self) -> str:
+        return "".join("X" if position in self.mismatches else self.sequence[position]
+                       for position in range(self.start, self.end))
+
+    def temperature(self) -> float:
+        length = self.end - self.start
+        model = self.model
+        if model is None or self.invalid_count > 0 or length - self.mismatch_count < 2:
+            return self.calculator(self.get_mismatch_sequence())
+        if model.calculation_type != "NN":
+            temp = model.mismatch_temperature(length, self.gc, self.mismatch_count)
+        else:
+            init_h, init_s = model.init_one_gc if self.gc else model.init_all_at
+            delta_h = init_h + model.first_h[self.first] + model.last_h[self.last] + self.stack_h
+            delta_s = init_s + model.first_s[self.first] + model.last_s[self.last] + self.stack_s
+            temp = model.mismatch_temperature(length, self.gc, self.mismatch_count, delta_h, delta_s)
+        return round(temp, self.calculator.precision)
+
+
+class SequenceTemperatureCalculator:
+    """
+    Computes melting temperatures of substrings of one (gene or plasmid) sequence.
+
+    GC counts and nearest neighbor values are stored as prefix sums, so the temperature
+    of sequence[start:end] is computed in constant time. The result is the same as
+    calling the temperature calculator on the substring. Substrings which can't be modeled
+    (ambiguous bases, NEB like calculation, ...) are passed to the temperature calculator.
+    """
+
+    def __init__(self, sequence: str, calculator):
+        self.sequence = sequence
+        self.calculator = calculator
+        self.precision = calculator.precision
+        self.model = MeltingTemperatureModel.from_config(calculator.config)
+        self.length = len(sequence)
+
+        codes = _BASE_INDEX[np.frombuffer(sequence.encode("ascii", "replace"), dtype=np.uint8)]
+        # Prefix arrays have length + 1 items, the value for sequence[start:end] is prefix[end] - prefix[start]
+        self.codes_array = codes
+        self.gc_prefix_array = np.concatenate(([0], np.cumsum(_IS_GC[codes])))
+        self.invalid_prefix_array = np.concatenate(([0], np.cumsum(codes == 4)))
+
+        if self.model is not None and self.model.calculation_type == "NN":
+            # Stack i is formed by bases i and i + 1, stacks of sequence[start:end] are start, ..., end - 2
+            stacks = 5 * codes[:-1] + codes[1:]
+            self.stack_h_prefix_array = np.concatenate(([0.0], np.cumsum(np.asarray(self.model.stack_h)[stacks])))
+            self.stack_s_prefix_array = np.concatenate(([0.0], np.cumsum(np.asarray(self.model.stack_s)[stacks])))
+
+        # Indexing numpy arrays is slow for single ranges, those use list copies created on the first call
+        self.codes = None
+
+    def _create_lists(self):
+        self.codes = self.codes_array.tolist()
+        self.gc_prefix = self.gc_prefix_array.tolist()
+        self.invalid_prefix = self.invalid_prefix_array.tolist()
+        if self.model is not None and self.model.calculation_type == "NN":
+            self.stack_h_prefix = self.stack_h_prefix_array.tolist()
+            self.stack_s_prefix = self.stack_s_prefix_array.tolist()
+
+    @staticmethod
+    def for_primers(primers: Sequence[str], calculator) \
+            -> Tuple["SequenceTemperatureCalculator", np.ndarray, np.ndarray]:
+        """
+        Creates calculator for concatenation of the given primers, together with start and end
+        index of each of the primers in it.
+        """
+        lengths = np.fromiter((len(primer) for primer in primers), dtype=np.int64, count=len(primers))
+        ends = np.cumsum(lengths)
+        return SequenceTemperatureCalculator("".join(primers), calculator), ends - lengths, ends
+
+    def __call__(self, start: int, end: int) -> float:
+        """
+        Melting temperature of sequence[start:end] rounded to the precision of the calculator.
+        """
+        if self.codes is None:
+            self._create_lists()
+        if self.model is None or start < 0 or end > self.length or end - start < 2 \
+                or self.invalid_prefix[end] != self.invalid_prefix[start]:
+            return self.calculator(self.sequence[start:end])
+
+        length = end - start
+        gc = self.gc_prefix[end] - self.gc_prefix[start]
+        if self.model.calculation_type != "NN":
+            return round(self.model.temperature(length, gc), self.precision)
+
+        model = self.model
+        first = self.codes[start]
+        last = self.codes[end - 1]
+        init_h, init_s = model.init_one_gc if gc else model.init_all_at
+        delta_h = init_h + model.first_h[first] + model.last_h[last] + \
+            self.stack_h_prefix[end - 1] - self.stack_h_prefix[start]
+        delta_s = init_s + model.first_s[first] + model.last_s[last] + \
+            self.stack_s_prefix[end - 1] - self.stack_s_prefix[start]
+        return round(model.temperature(length, gc, delta_h, delta_s), self.precision)
+
+    def many(self, starts, ends, dtype=np.float32) -> np.ndarray:
+        """
+        Melting temperatures of sequence[starts[i]:ends[i]] for all i as a float32 (or dtype) array.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        temps = np.empty(len(starts), dtype=np.float64)
+
+        modeled = self.modeled(starts, ends)
+        if self.model is not None:
+            modeled_starts = starts[modeled]
+            modeled_ends = ends[modeled]
+            lengths = modeled_ends - modeled_starts
+            gc = self.gc_prefix_array[modeled_ends] - self.gc_prefix_array[modeled_starts]
+
+            if self.model.calculation_type != "NN":
+                modeled_temps = self.model.temperature(lengths, gc)
+            else:
+                model = self.model
+                first = self.codes_array[modeled_starts]
+                last = self.codes_array[modeled_ends - 1]
+                has_gc = gc > 0
+                delta_h = np.where(has_gc, model.init_one_gc[0], model.init_all_at[0]) + \
+                    np.asarray(model.first_h)[first] + np.asarray(model.last_h)[last] + \
+                    self.stack_h_prefix_array[modeled_ends - 1] - self.stack_h_prefix_array[modeled_starts]
+                delta_s = np.where(has_gc, model.init_one_gc[1], model.init_all_at[1]) + \
+                    np.asarray(model.first_s)[first] + np.asarray(model.last_s)[last] + \
+                    self.stack_s_prefix_array[modeled_ends - 1] - self.stack_s_prefix_array[modeled_starts]
+                modeled_temps = model.temperature(lengths, gc, delta_h, delta_s)
+
+            temps[modeled] = self._round(modeled_temps)
+
+        for index in np.flatnonzero(~modeled):
+            temps[index] = self.calculator(self.sequence[starts[index]:ends[index]])
+
+        return temps.astype(dtype, copy=False)
+
+    def many_mismatched(self, starts, ends, mismatches: Iterable[int], dtype=np.float32) -> np.ndarray:
+        """
+        Melting temperatures of sequence[starts[i]:ends[i]] with bases at the mismatch offsets replaced
+        by "X", as a float32 (or dtype) array. The result is the same as calling the temperature calculator
+        on the mismatch sequences, which are built only for the ranges the model can't handle.
+
+        Mismatched bases are dropped from the prefix sums of the covered part of the sequence, so the
+        nearest neighbors of a range are the neighboring bases which are not mismatched, as in Tm_NN.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        temps = np.empty(len(starts), dtype=np.float64)
+        if len(starts) == 0:
+            return temps.astype(dtype, copy=False)
+
+        # Only the part of the sequence covered by the ranges is encoded
+        low = int(np.clip(starts.min(), 0, self.length))
+        high = int(np.clip(ends.max(), low, self.length))
+        is_mismatch = np.zeros(high - low, dtype=bool)
+        offsets = np.fromiter(mismatches, dtype=np.int64)
+        offsets = offsets[(offsets >= low) & (offsets < high)]
+        is_mismatch[offsets - low] = True
+
+        # Positions of the bases which are not mismatched and prefix sums of their values
+        kept = np.flatnonzero(~is_mismatch) + low
+        kept_codes = self.codes_array[kept]
+        mismatch_prefix = np.concatenate(([0], np.cumsum(is_mismatch)))
+        gc_prefix = np.concatenate(([0], np.cumsum(_IS_GC[kept_codes])))
+        invalid_prefix = np.concatenate(([0], np.cumsum(kept_codes == 4)))
+
+        clipped_starts = np.clip(starts, low, high)
+        clipped_ends = np.clip(ends, low, high)
+        # Range i keeps the bases kept[first_kept[i]:end_kept[i]]
+        first_kept = np.searchsorted(kept, clipped_starts)
+        end_kept = np.searchsorted(kept, clipped_ends)
+
+        modeled = (starts >= 0) & (ends <= self.length) & (end_kept - first_kept >= 2)
+        if self.model is None:
+            modeled[:] = False
+        modeled &= invalid_prefix[end_kept] == invalid_prefix[first_kept]
+
+        if modeled.any():
+            model = self.model
+            first_kept = first_kept[modeled]
+            end_kept = end_kept[modeled]
+            lengths = ends[modeled] - starts[modeled]
+            mismatch_counts = mismatch_prefix[clipped_ends[modeled] - low] - mismatch_prefix[clipped_starts[modeled] - low]
+            gc = gc_prefix[end_kept] - gc_prefix[first_kept]
+
+            if model.calculation_type != "NN":
+                modeled_temps = model.mismatch_temperature(lengths, gc, mismatch_counts)
+            else:
+                # Stack j is formed by kept bases j and j + 1
+                stacks = 5 * kept_codes[:-1] + kept_codes[1:]
+                stack_h_prefix = np.concatenate(([0.0], np.cumsum(np.asarray(model.stack_h)[stacks])))
+                stack_s_prefix = np.concatenate(([0.0], np.cumsum(np.asarray(model.stack_s)[stacks])))
+                first = kept_codes[first_kept]
+                last = kept_codes[end_kept - 1]
+                has_gc = gc > 0
+                delta_h = np.where(has_gc, model.init_one_gc[0], model.init_all_at[0]) + \
+                    np.asarray(model.first_h)[first] + np.asarray(model.last_h)[last] + \
+                    stack_h_prefix[end_kept - 1] - stack_h_prefix[first_kept]
+                delta_s = np.where(has_gc, model.init_one_gc[1], model.init_all_at[1]) + \
+                    np.asarray(model.first_s)[first] + np.asarray(model.last_s)[last] + \
+                    stack_s_prefix[end_kept - 1] - stack_s_prefix[first_kept]
+                modeled_temps = model.mismatch_temperature(lengths, gc, mismatch_counts, delta_h, delta_s)
+
+            temps[modeled] = self._round(modeled_temps)
+
+        mismatch_set = set(offsets.tolist())
+        for index in np.flatnonzero(~modeled):
+            start = int(starts[index])
+            temps[index] = self.calculator("".join(
+                "X" if start + i in mismatch_set else base
+                for i, base in enumerate(self.sequence[start:int(ends[index])])))
+
+        return temps.astype(dtype, copy=False)
+
+    def modeled(self, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        """
+        Mask of ranges which are computed by the model rather than passed to the calculator.
+        """
+        if self.model is None:
+            return np.zeros(len(starts), dtype=bool)
+        modeled = (starts >= 0) & (ends <= self.length) & (ends - starts >= 2)
+        clipped_starts = np.clip(starts, 0, self.length)
+        clipped_ends = np.clip(ends, 0, self.length)
+        return modeled & (self.invalid_prefix_array[clipped_ends] == self.invalid_prefix_array[clipped_starts])
+
+    def first_reaching(self, starts, ends, threshold: float, strict: bool = False) -> Optional[int]:
+        """
+        Returns index of the first range sequence[starts[i]:ends[i]] with melting temperature reaching
+        the threshold (or exceeding it when strict), None if there is no such range. Starts or ends
+        may be a single number. Ranges are expected to grow, each one containing the previous one,
+        as when a primer is extended one base at a time.
+
+        The result is the same as checking the ranges one by one. Wallace temperature only grows
+        with the length and is bisected, other methods are not monotone and are checked in blocks
+        of doubling size.
+        """
+        starts, ends = np.broadcast_arrays(np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64))
+        count = len(starts)
+        reaches = (lambda temp: temp > threshold) if strict else (lambda temp: temp >= threshold)
+
+        if self.model is not None and self.model.calculation_type == "Wallace" and self.modeled(starts, ends).all():
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if reaches(self(int(starts[middle]), int(ends[middle]))):
+                    high = middle
+                else:
+                    low = middle + 1
+            return low if low < count else None
+
+        position = 0
+        block_size = 8
+        while position < count:
+            block_end = min(count, position + block_size)
+            block_starts = starts[position:block_end]
+            block_ends = ends[position:block_end]
+            if self.modeled(block_starts, block_ends).all():
+                hits = np.flatnonzero(reaches(self.many(block_starts, block_ends, np.float64)))
+                if len(hits) > 0:
+                    return position + int(hits[0])
+            else:
+                # The calculator may raise for some ranges, so evaluate only until the first hit
+                for index in range(position, block_end):
+                    if reaches(self(int(starts[index]), int(ends[index]))):
+                        return index
+            position = block_end
+            block_size *= 2
+        return None
+
+    def _round(self, temps: np.ndarray) -> np.ndarray:
+        """
+        Same as the built-in round to precision. np.round scales by a power of ten first,
+        so values close to a half are rounded by the built-in round instead.
+        """
+        rounded = np.round(temps, self.precision)
+        scaled = temps * (10 ** self.precision)
+        halves = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+        rounded[halves] = [round(temp, self.precision) for temp in temps[halves].tolist()]
+        return rounded
+
 
 class TemperatureConfig(JsonObject):
     calculation_type = StringProperty(required=True, choices=["Wallace", "GC", "NN", "NEB_like"], default="NN")
@@ -260,8 +1233,24 @@ class TemperatureConfig(JsonObject):
         if self.calculation_type == "NEB_like":
             return self.create_neb_calculator(cached)
 
+    def cache_key(self) -> Tuple:
+        """
+        Normalized tuple of the settings the computed temperatures depend on. Configs which differ
+        only in settings unused by their calculation type have the same key and share caches.
+        """
+        if self.calculation_type == "Wallace":
+            return "Wallace", self.precision
+        if self.calculation_type == "GC":
+            return ("GC", self.gc_value_set, self.salt_correction, float(self.na), float(self.k),
+                    float(self.tris), float(self.mg), float(self.dntp), self.precision)
+        if self.calculation_type == "NN":
+            return ("NN", self.nn_table, self.salt_correction, float(self.na), float(self.k),
+                    float(self.tris), float(self.mg), float(self.dnac1), float(self.dnac2),
+                    float(self.dntp), self.precision)
+        return (self.calculation_type,)
+
     def create_wallace_calculator(self, cached):
-        return TemperatureCalculator(MeltingTemp.Tm_Wallace, self.precision, cached)
+        return TemperatureCalculator(self.compile(MeltingTemp.Tm_Wallace), self.precision, cached, self)
 
     def create_gc_calculator(self, cached):
         valueset_id = self.get_gc_valueset_id()
@@ -269,7 +1258,7 @@ class TemperatureConfig(JsonObject):
         calc_func = partial(MeltingTemp.Tm_GC, valueset=valueset_id, saltcorr=saltcorrection_id,
                             Na=self.na, K=self.k, Tris=self.tris, Mg=self.mg, dNTPs=self.dntp,
                             strict=False)
-        return TemperatureCalculator(calc_func, self.precision, cached)
+        return TemperatureCalculator(self.compile(calc_func), self.precision, cached, self)
 
     def create_nn_calculator(self, cached):
         table = self.get_nn_table()
@@ -277,7 +1266,15 @@ class TemperatureConfig(JsonObject):
         calc_func = partial(MeltingTemp.Tm_NN, nn_table=table, saltcorr=saltcorrection_id,
                             Na=self.na, K=self.k, Tris=self.tris, Mg=self.mg, dnac1=self.dnac1,
                             dnac2=self.dnac2, dNTPs=self.dntp)
-        return TemperatureCalculator(calc_func, self.precision, cached)
+        return TemperatureCalculator(self.compile(calc_func), self.precision, cached, self)
+
+    def compile(self, calc_func):
+        """
+        Returns the Biopython calculation method compiled with the table lookups and salt correction
+        of this config resolved once, or the method itself if the config can't be modeled.
+        """
+        model = MeltingTemperatureModel.from_config(self)
+        return calc_func if model is None else CompiledMeltingTemperature(model, calc_func)
 
     def create_neb_calculator(self, cached):
         return NEB_like_calculator(cached)
@@ -17,30 +17,84 @@
 
 import os
 import json
+import time
 
 from celery import Celery
+from celery.backends.redis import RedisBackend
+from celery.signals import task_prerun, task_postrun
+from redis import RedisError
 
 from mutation_maker.codon_usage_table import get_organism_names, get_organism_names_with_ids
-from mutation_maker.ssm import ssm_solve
+from mutation_maker.ssm import ssm_solve_stream, collect_output
 from mutation_maker.qclm import qclm_solve, QCLMInput, QCLMOutput
-from mutation_maker.primer3_interoperability import Primer3, AllPrimerGenerator, NullPrimerGenerator
+from mutation_maker.primer3_interoperability import Primer3, Primer3InProcess, Primer3Pool, AllPrimerGenerator, \
+    NullPrimerGenerator
+from mutation_maker.primer3_cache import CachedPrimerGenerator, Primer3ResultCache, Primer3DiskStore, \
+    Primer3RedisStore, DEFAULT_PRIMER3_CACHE_SIZE
 from mutation_maker.ssm_types import SSMInput, SSMOutput
 from mutation_maker.pas import pas_solve
 from mutation_maker.pas_types import PASInput
+from mutation_maker.temperature_calculator import configure_temperature_caches, \
+    temperature_cache_stats, reset_temperature_cache_stats, enable_persistent_temperature_caches, \
+    flush_temperature_caches
 
 print("Mutation Maker version: 1.0.0")
 
 PRIMER3_PATH = os.environ.get('PRIMER3HOME')
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379'),
 CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379')
+# Maximum number of entries of each temperature cache shared by tasks of a worker process
+TEMPERATURE_CACHE_SIZE = os.environ.get('TEMPERATURE_CACHE_SIZE')
+# SQLite file shared by all worker processes to persist computed temperatures, disabled if not set
+TEMPERATURE_CACHE_PATH = os.environ.get('TEMPERATURE_CACHE_PATH')
+
+# Designer of primer3 primers of all mutations: "lambda" invokes AWS Lambda, "in_process" uses primer3-py
+# (and primer3_core for primers primer3-py can't design), "local_pool" uses long-lived primer3_core processes
+PRIMER3_BACKEND = os.environ.get('PRIMER3_BACKEND', 'lambda')
+# Maximum number of designed primer3 records cached in memory of a worker process, 0 disables the cache
+PRIMER3_CACHE_SIZE = int(os.environ.get('PRIMER3_CACHE_SIZE', DEFAULT_PRIMER3_CACHE_SIZE))
+# SQLite file shared by all worker processes to persist designed primer3 records, disabled if not set
+PRIMER3_CACHE_PATH = os.environ.get('PRIMER3_CACHE_PATH')
+# Redis shared by all workers to cache designed primer3 records (e.g. redis://localhost:6379/1), disabled if not set
+PRIMER3_CACHE_REDIS_URL = os.environ.get('PRIMER3_CACHE_REDIS_URL')
+# Seconds after which records cached in Redis expire, never if not set
+PRIMER3_CACHE_TTL = os.environ.get('PRIMER3_CACHE_TTL')
+# Custom state of the SSM task. Its meta contains the stage of the solve ("primers", "temperatures" or "results")
+# and its "done" and "total" steps.
+SSM_SOLVING_STATE = 'SOLVING'
+# Minimal number of seconds between updates of the state (and of the stream lines) of the SSM task
+SSM_STATE_UPDATE_INTERVAL = float(os.environ.get('SSM_STATE_UPDATE_INTERVAL', 1))
+# Redis list of the Redis result backend the SSM task appends lines of its output to while it is running
+# (an "output" line with the output without results, then a "result" line of each mutation), read by the API
+SSM_STREAM_KEY = 'mutation_maker:ssm:stream:{}'
+
+if TEMPERATURE_CACHE_SIZE is not None:
+    configure_temperature_caches(int(TEMPERATURE_CACHE_SIZE))
+if TEMPERATURE_CACHE_PATH:
+    enable_persistent_temperature_caches(TEMPERATURE_CACHE_PATH)
 
 celery = Celery('tasks', broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
 primer3 = Primer3(primer3_path=PRIMER3_PATH)
+if PRIMER3_BACKEND == 'in_process':
+    primer3 = Primer3InProcess(fallback=primer3)
+elif PRIMER3_BACKEND == 'local_pool':
+    primer3 = Primer3Pool(primer3_path=PRIMER3_PATH)
+
+primer3_cache_stores = []
+if PRIMER3_CACHE_PATH:
+    primer3_cache_stores.append(Primer3DiskStore(PRIMER3_CACHE_PATH))
+if PRIMER3_CACHE_REDIS_URL:
+    primer3_cache_stores.append(Primer3RedisStore(PRIMER3_CACHE_REDIS_URL,
+                                                  int(PRIMER3_CACHE_TTL) if PRIMER3_CACHE_TTL else None))
+primer3_cache = None
+if PRIMER3_CACHE_SIZE > 0 or primer3_cache_stores:
+    primer3_cache = Primer3ResultCache(PRIMER3_CACHE_SIZE, primer3_cache_stores)
+    primer3 = CachedPrimerGenerator(primer3, primer3_cache)
 secondary_generator = AllPrimerGenerator()
 
 
-@celery.task(name='tasks.ssm')
-def ssm(ssm_input):
+@celery.task(name='tasks.ssm', bind=True)
+def ssm(self, ssm_input):
     data = parse_body(ssm_input)
     input = SSMInput(data)
 
@@ -49,7 +103,84 @@ def ssm(ssm_input):
     else:
         main_generator = NullPrimerGenerator()
 
-    return ssm_solve(input, main_generator, secondary_generator)
+    state_updates = SSMStateUpdates(self)
+    stream_lines = SSMStreamLines(self)
+    stream = ssm_solve_stream(input, main_generator, secondary_generator, state_updates.solving)
+
+    output = collect_output(stream_lines.append_all(stream))
+    return output.to_json()
+
+
+class SSMStateUpdates:
+    """ Updates custom states of a running SSM task, at most once per SSM_STATE_UPDATE_INTERVAL """
+
+    def __init__(self, task):
+        self.task = task
+        self.last_update = None
+
+    def solving(self, stage, done, total):
+        # Task is finished right after its last result
+        if stage != "results" or done < total:
+            self.update(SSM_SOLVING_STATE, {"stage": stage, "done": done, "total": total}, done == total)
+
+    def update(self, state, meta, force):
+        # Tasks called directly (not by a worker) have no state
+        if self.task.request.id is None:
+            return
+        now = time.monotonic()
+        if force or self.last_update is None or now - self.last_update >= SSM_STATE_UPDATE_INTERVAL:
+            self.task.update_state(state=state, meta=meta)
+            self.last_update = now
+
+
+class SSMStreamLines:
+    """
+    Appends lines of the output of a running SSM task to its SSM_STREAM_KEY list, at most once per
+    SSM_STATE_UPDATE_INTERVAL. Lines are only appended, each line is written once. The list expires
+    with the result of the task, nothing is appended without a Redis result backend.
+    """
+
+    def __init__(self, task, client=None):
+        self.task = task
+        self.client = client
+        if client is None and task.request.id is not None and isinstance(task.backend, RedisBackend):
+            self.client = task.backend.client
+        self.pending = []
+        self.last_flush = None
+
+    def append_all(self, stream):
+        """ Passes through the items of `ssm_solve_stream`, appending their lines """
+        for index, item in enumerate(stream):
+            if index == 0:
+                self.append({"type": "output", "output": item.to_json()})
+            else:
+                self.append({"type": "result", "result": item.to_json()})
+            yield item
+        self.flush()
+
+    def append(self, line):
+        if self.client is None:
+            return
+        self.pending.append(json.dumps(line))
+        if self.last_flush is None or time.monotonic() - self.last_flush >= SSM_STATE_UPDATE_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.client is None or not self.pending:
+            return
+        key = SSM_STREAM_KEY.format(self.task.request.id)
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.rpush(key, *self.pending)
+            if self.task.backend.expires:
+                pipeline.expire(key, int(self.task.backend.expires))
+            pipeline.execute()
+        except RedisError as e:
+            # Lines are best effort, the result of the task contains all of them
+            print("Cannot append stream lines of task {}: {}".format(self.task.request.id, e))
+            self.client = None
+        self.pending = []
+        self.last_flush = time.monotonic()
 
 
 @celery.task(name='tasks.qclm')
@@ -72,6 +203,27 @@ def pas(pas_input):
     output = pas_solve(input)
     return output
 
+@task_prerun.connect
+def reset_cache_stats(task_id=None, task=None, **kwargs):
+    reset_temperature_cache_stats()
+    if primer3_cache is not None:
+        primer3_cache.reset_stats()
+
+
+@task_postrun.connect
+def print_cache_stats(task_id=None, task=None, **kwargs):
+    flush_temperature_caches()
+    for cache, stats in temperature_cache_stats().items():
+        if stats["hits"] or stats["store_hits"] or stats["misses"]:
+            print("Task {} {} cache: {hits} hits, {store_hits} store hits, {misses} misses, {size} entries"
+                  .format(task.name, cache, **stats))
+    if primer3_cache is not None:
+        stats = primer3_cache.stats()
+        if stats["hits"] or stats["store_hits"] or stats["misses"]:
+            print("Task {} primer3 cache: {hits} hits, {store_hits} store hits, {misses} misses, {size} entries"
+                  .format(task.name, **stats))
+
+
 def parse_body(body):
     if body is None:
         raise ValueError("Body must contain workflow input JSON data")
@@ -0,0 +1,235 @@
+#    Copyright (c) 2020 Merck Sharp & Dohme Corp. a subsidiary of Merck & Co., Inc., Kenilworth, NJ, USA.
+#
+#    This file is part of the Mutation Maker, An Open Source Oligo Design Software For Mutagenesis and De Novo Gene Synthesis Experiments.
+#
+#    Mutation Maker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Randomized equivalence tests of the optimized melting temperature engines.
+
+Every engine computes temperatures of the same ranges (with and without mismatches) of a corpus
+of random and sample sequences, and is compared with the calculator created by TemperatureConfig
+called on each primer. A table with the maximal deviation and the time of each engine and config
+is printed, so the tests double as a micro-benchmark. New engines are added to ENGINES.
+"""
+
+import random
+import time
+import unittest
+from typing import Callable, Dict, List, NamedTuple, Sequence
+
+import numpy as np
+
+from mutation_maker.temperature_calculator import TemperatureConfig, TemperatureCalculator, PrimerTemperatureState, \
+    CompiledMeltingTemperature, gc_value_sets, nn_tables, salt_corrections
+from tests.test_support import sample_ssm_sequence, sample_qclm_sequences, sample_pas_sequences
+
+
+class Ranges(NamedTuple):
+    """ Ranges sequence[starts[i]:ends[i]] of a corpus sequence with bases at mismatch offsets replaced by "X" """
+    sequence: str
+    starts: np.ndarray
+    ends: np.ndarray
+    mismatches: List[int]
+
+    def primers(self) -> List[str]:
+        mismatches = set(self.mismatches)
+        return ["".join("X" if i in mismatches else self.sequence[i] for i in range(start, end))
+                for start, end in zip(self.starts.tolist(), self.ends.tolist())]
+
+
+def create_corpus(seed: int = 0, count: int = 100) -> List[Ranges]:
+    """ Random ranges of primer lengths of random sequences and the sample sequences of the tests """
+    rng = random.Random(seed)
+    sequences = [sample_ssm_sequence().get_full_sequence_with_offset()[0],
+                 sample_qclm_sequences().gene_of_interest,
+                 sample_pas_sequences(6).gene_of_interest]
+    sequences += ["".join(rng.choice("ACGT") for _ in range(300)) for _ in range(2)]
+    # Low and high GC content, ambiguous bases
+    sequences += ["".join(rng.choice(bases) for _ in range(300)) for bases in ["AAATTTACG", "GGGCCCAT", "ACGTACGTN"]]
+
+    corpus = []
+    for sequence in sequences:
+        starts = np.array([rng.randrange(0, len(sequence) - 60) for _ in range(count)])
+        ends = starts + np.array([rng.randrange(2, 60) for _ in range(count)])
+        corpus.append(Ranges(sequence, starts, ends, []))
+        mismatches = sorted(rng.sample(range(len(sequence)), len(sequence) // 10))
+        corpus.append(Ranges(sequence, starts, ends, mismatches))
+    return corpus
+
+
+def biopython_engine(calculator: TemperatureCalculator, ranges: Ranges) -> np.ndarray:
+    if not isinstance(calculator.calculation_method, CompiledMeltingTemperature):
+        # Nothing is compiled, the calculator calls Biopython (or primer3) itself
+        return np.array([calculator(primer) for primer in ranges.primers()])
+    method = calculator.calculation_method.method
+    return np.array([round(method(primer), calculator.precision) if primer else -float("inf")
+                     for primer in ranges.primers()])
+
+
+def sequence_engine(calculator: TemperatureCalculator, ranges: Ranges) -> np.ndarray:
+    if ranges.mismatches:
+        return calculator.many((ranges.starts, ranges.ends), ranges.sequence, np.float64, ranges.mismatches)
+    sequence_temp = calculator.for_sequence(ranges.sequence)
+    return np.array([sequence_temp(start, end) for start, end in zip(ranges.starts.tolist(), ranges.ends.tolist())])
+
+
+def many_engine(calculator: TemperatureCalculator, ranges: Ranges) -> np.ndarray:
+    if ranges.mismatches:
+        return calculator.many((ranges.starts, ranges.ends), ranges.sequence, np.float64, ranges.mismatches)
+    return calculator.many((ranges.starts, ranges.ends), ranges.sequence, np.float64)
+
+
+def state_engine(calculator: TemperatureCalculator, ranges: Ranges) -> np.ndarray:
+    temps = []
+    for start, end in zip(ranges.starts.tolist(), ranges.ends.tolist()):
+        # Primers are grown by one base at a time from their two middle bases
+        middle = (start + end) // 2
+        state = PrimerTemperatureState(calculator, ranges.sequence, middle - 1, middle + 1, ranges.mismatches)
+        while state.start > start:
+            state.extend_left()
+        while state.end < end:
+            state.extend_right()
+        temps.append(state.temperature())
+    return np.array(temps)
+
+
+# Engines computing temperatures of ranges, compared with the calculator called on each primer
+ENGINES: Dict[str, Callable[[TemperatureCalculator, Ranges], np.ndarray]] = {
+    "biopython": biopython_engine,
+    "sequence": sequence_engine,
+    "many": many_engine,
+    "state": state_engine,
+}
+
+
+def all_configs(precision: int) -> List[TemperatureConfig]:
+    """ Configs of every calculation type with every value set, nearest neighbor table and salt correction """
+    configs = [TemperatureConfig(calculation_type="Wallace", precision=precision)]
+    configs += [TemperatureConfig(calculation_type="GC", gc_value_set=gc_value_set, salt_correction=salt_correction,
+                                  precision=precision)
+                for gc_value_set in gc_value_sets for salt_correction in salt_corrections]
+    configs += [TemperatureConfig(nn_table=nn_table, salt_correction=salt_correction, precision=precision)
+                for nn_table in nn_tables for salt_correction in salt_corrections]
+    configs += [TemperatureConfig(salt_correction=salt_correction, na=0, precision=precision)
+                for salt_correction in salt_corrections]
+    configs += [TemperatureConfig(calculation_type="NEB_like", precision=precision)]
+    return configs
+
+
+def config_name(config: TemperatureConfig) -> str:
+    if config.calculation_type == "GC":
+        return f"GC {config.gc_value_set} {config.salt_correction}"
+    if config.calculation_type == "NN":
+        return f"NN {config.nn_table} {config.salt_correction} Na={config.na:g}"
+    return config.calculation_type
+
+
+class EngineResult(NamedTuple):
+    engine: str
+    config: str
+    max_deviation: float
+    # Number of ranges with different temperature at the precision of the config
+    different: int
+    seconds: float
+    reference_seconds: float
+
+
+# Errors Biopython raises for primers it can't compute
+CALCULATOR_ERRORS = (ValueError, IndexError, ZeroDivisionError)
+
+
+def compare_engine(engine: str, config: TemperatureConfig, corpus: Sequence[Ranges]) -> EngineResult:
+    """
+    Compares temperatures computed by the engine with the calculator of the config called on each primer.
+    Primers for which the calculator raises are expected to raise in the engine too.
+    """
+    max_deviation = 0.0
+    different = 0
+    seconds = 0.0
+    reference_seconds = 0.0
+    half_unit = 0.5 / 10 ** config.precision
+
+    for ranges in corpus:
+        calculator = config.create_calculator(cached=False)
+        expected = []
+        start_time = time.perf_counter()
+        for primer in ranges.primers():
+            try:
+                expected.append(calculator(primer))
+            except CALCULATOR_ERRORS:
+                expected.append(None)
+        reference_seconds += time.perf_counter() - start_time
+
+        valid = np.array([temp is not None for temp in expected], dtype=bool)
+        for index in np.flatnonzero(~valid):
+            try:
+                ENGINES[engine](calculator, Ranges(ranges.sequence, ranges.starts[index:index + 1],
+                                                   ranges.ends[index:index + 1], ranges.mismatches))
+            except CALCULATOR_ERRORS:
+                continue
+            raise AssertionError(f"{engine} computed temperature the calculator rejects with {config_name(config)}")
+
+        expected = np.array([temp for temp in expected if temp is not None], dtype=np.float64)
+        calculator = config.create_calculator(cached=False)
+        start_time = time.perf_counter()
+        temps = ENGINES[engine](calculator, Ranges(ranges.sequence, ranges.starts[valid], ranges.ends[valid],
+                                                   ranges.mismatches))
+        seconds += time.perf_counter() - start_time
+
+        finite = np.isfinite(expected)
+        if not np.array_equal(finite, np.isfinite(temps)):
+            raise AssertionError(f"{engine} and calculator disagree on empty primers with {config_name(config)}")
+        deviations = np.abs(temps[finite] - expected[finite])
+        if len(deviations) > 0:
+            max_deviation = max(max_deviation, float(deviations.max()))
+            different += int(np.count_nonzero(deviations >= half_unit))
+
+    return EngineResult(engine, config_name(config), max_deviation, different, seconds, reference_seconds)
+
+
+def format_results(results: Sequence[EngineResult]) -> str:
+    lines = ["{:<10} {:<46} {:>13} {:>9} {:>10} {:>13}".format(
+        "engine", "config", "max deviation", "different", "time [ms]", "calculator [ms]")]
+    for result in results:
+        lines.append("{:<10} {:<46} {:>13.2e} {:>9} {:>10.1f} {:>13.1f}".format(
+            result.engine, result.config, result.max_deviation, result.different,
+            result.seconds * 1000, result.reference_seconds * 1000))
+    return "\n".join(lines)
+
+
+class CalculatorEquivalenceTest(unittest.TestCase):
+    corpus = create_corpus()
+
+    def assert_equivalent(self, engine: str, precision: int):
+        results = [compare_engine(engine, config, self.corpus) for config in all_configs(precision)]
+        print(format_results(results))
+        for result in results:
+            self.assertEqual(0, result.different, f"{result.engine} {result.config}: "
+                                                  f"max deviation {result.max_deviation}")
+
+    def test_biopython(self):
+        self.assert_equivalent("biopython", 2)
+
+    def test_sequence(self):
+        self.assert_equivalent("sequence", 2)
+
+    def test_many(self):
+        self.assert_equivalent("many", 2)
+
+    def test_many_precision_0(self):
+        self.assert_equivalent("many", 0)
+
+    def test_state(self):
+        self.assert_equivalent("state", 2)
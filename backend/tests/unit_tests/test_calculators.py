@@ -15,9 +15,21 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
+import os
+import random
+import tempfile
 import unittest
 
-from mutation_maker.temperature_calculator import get_all_temp_ranges_between, TemperatureConfig
+import numpy as np
+
+from mutation_maker.temperature_calculator import get_all_temp_ranges_between, TemperatureConfig, \
+    gc_value_sets, nn_tables, salt_corrections, TemperatureCache, PrimerDimerCalculator, \
+    get_temperature_cache, reset_temperature_cache_stats, temperature_cache_stats, TemperatureStore, \
+    enable_persistent_temperature_caches, flush_temperature_caches, clear_temperature_caches, calc_thermo_batch, \
+    HeteroDimerCalculator, SelfBindingCalculator, PrimerTemperatureState, CompiledMeltingTemperature
+from mutation_maker import temperature_calculator
+from primer3 import calcHairpin, calcHomodimer, calcHeterodimer
 
 
 class CalculatorTest(unittest.TestCase):
@@ -125,3 +137,336 @@ class CalculatorTest(unittest.TestCase):
                 sequence, min_temp, max_temp, calculated_temp))
             self.assertTrue(min_temp <= calculated_temp <= max_temp,
                           f"Temperature {calculated_temp} not in expected range [{min_temp}, {max_temp}] for sequence {sequence}")
+
+
+class SequenceTemperatureCalculatorTest(unittest.TestCase):
+    sequence = "ATGGCTAGCAAAGGAGAAGAACTTTTCACTGGAGTTGTCCCAATTCTTGTTGAATTAGATGGTGATGTTAATGGGCACAAATTTTCT" \
+               "GTCAGTGGAGAGGGTGAAGGTGATGCAACATACGGAAAACTTACCCTTAAATTTATTTGCACTACTGGAAAACTACCTGTTCCNTGG"
+
+    def assert_same_as_calculator(self, config: TemperatureConfig):
+        calculator = config.create_calculator()
+        sequence_temp = calculator.for_sequence(self.sequence)
+        rng = random.Random(0)
+        for _ in range(50):
+            start = rng.randrange(-3, len(self.sequence))
+            end = start + rng.randrange(0, 40)
+            try:
+                expected = calculator(self.sequence[start:end])
+            except ValueError:
+                with self.assertRaises(ValueError):
+                    sequence_temp(start, end)
+                continue
+            self.assertAlmostEqual(expected, sequence_temp(start, end), delta=1e-6,
+                                   msg=f"{config.to_json()} [{start}:{end}]")
+
+    def test_wallace(self):
+        self.assert_same_as_calculator(TemperatureConfig(calculation_type="Wallace", precision=8))
+
+    def test_gc_value_sets(self):
+        for gc_value_set in gc_value_sets:
+            self.assert_same_as_calculator(TemperatureConfig(calculation_type="GC", gc_value_set=gc_value_set,
+                                                             precision=8))
+
+    def test_nn_tables_and_salt_corrections(self):
+        for nn_table in nn_tables:
+            for salt_correction in salt_corrections:
+                self.assert_same_as_calculator(TemperatureConfig(nn_table=nn_table, salt_correction=salt_correction,
+                                                                 precision=8))
+
+    def test_nn_without_sodium(self):
+        for salt_correction in salt_corrections:
+            self.assert_same_as_calculator(TemperatureConfig(salt_correction=salt_correction, na=0, precision=8))
+
+    def test_rounding_to_precision(self):
+        calculator = TemperatureConfig(precision=1).create_calculator()
+        sequence_temp = calculator.for_sequence(self.sequence)
+        self.assertEqual(calculator(self.sequence[10:30]), sequence_temp(10, 30))
+        self.assertIs(sequence_temp, calculator.for_sequence(self.sequence))
+
+    def test_neb_like_uses_calculator(self):
+        calculator = TemperatureConfig(calculation_type="NEB_like").create_calculator()
+        self.assertEqual(calculator(self.sequence[5:30]), calculator.for_sequence(self.sequence)(5, 30))
+
+    def test_empty_range(self):
+        sequence_temp = TemperatureConfig().create_calculator().for_sequence(self.sequence)
+        self.assertEqual(-float("inf"), sequence_temp(10, 10))
+
+    def test_many_ranges(self):
+        for config in [TemperatureConfig(precision=1), TemperatureConfig(calculation_type="GC", precision=1)]:
+            calculator = config.create_calculator()
+            starts = np.arange(-2, len(self.sequence), 3)
+            ends = starts + 20
+            temps = calculator.many((starts, ends), self.sequence)
+            self.assertEqual(np.float32, temps.dtype)
+            expected = [calculator(self.sequence[start:end]) for start, end in zip(starts, ends)]
+            np.testing.assert_array_equal(np.array(expected, dtype=np.float32), temps)
+
+    def test_many_sequences(self):
+        calculator = TemperatureConfig(precision=1).create_calculator()
+        primers = ["CTCTCTCTCTCTCTCTCTCT", "", "ACGTNACGTACGTTGCA", "GAGAGAGAGAGAGAGAGAGA"]
+        temps = calculator.many(primers, dtype=np.float64)
+        self.assertEqual([calculator(primer) for primer in primers], temps.tolist())
+        self.assertEqual(0, len(calculator.many([])))
+
+    def test_many_mismatched(self):
+        mismatches = [20, 21, 30, 33, 34, 35, 90, 170]
+        configs = [TemperatureConfig(calculation_type="GC", gc_value_set=gc_value_set, precision=8)
+                   for gc_value_set in gc_value_sets]
+        configs += [TemperatureConfig(nn_table=nn_table, precision=8) for nn_table in nn_tables]
+        configs += [TemperatureConfig(calculation_type="Wallace", precision=8)]
+        for config in configs:
+            calculator = config.create_calculator()
+            starts = np.arange(0, len(self.sequence) - 30, 4)
+            ends = starts + 24
+            temps = calculator.many((starts, ends), self.sequence, np.float64, mismatches)
+            expected = [calculator("".join("X" if i in mismatches else self.sequence[i] for i in range(start, end)))
+                        for start, end in zip(starts, ends)]
+            np.testing.assert_allclose(expected, temps, atol=1e-6, err_msg=config.to_json())
+
+    def assert_same_as_linear_search(self, config: TemperatureConfig):
+        sequence_temp = config.create_calculator().for_sequence(self.sequence)
+        for threshold in [20, 45, 60, 75, 100]:
+            for strict in [False, True]:
+                ends = np.arange(12, 70)
+                expected = next((index for index, end in enumerate(ends)
+                                 if sequence_temp(10, end) > threshold
+                                 or (not strict and sequence_temp(10, end) == threshold)), None)
+                self.assertEqual(expected, sequence_temp.first_reaching(10, ends, threshold, strict))
+
+                starts = np.arange(160, 100, -1)
+                expected = next((index for index, start in enumerate(starts)
+                                 if sequence_temp(start, 170) > threshold
+                                 or (not strict and sequence_temp(start, 170) == threshold)), None)
+                self.assertEqual(expected, sequence_temp.first_reaching(starts, 170, threshold, strict))
+
+    def test_first_reaching(self):
+        self.assert_same_as_linear_search(TemperatureConfig(precision=1))
+        self.assert_same_as_linear_search(TemperatureConfig(calculation_type="GC"))
+        self.assert_same_as_linear_search(TemperatureConfig(calculation_type="Wallace"))
+
+    def test_first_reaching_unmodeled_ranges(self):
+        # Wallace raises for the ambiguous base near the end, ranges are checked only until the first hit
+        calculator = TemperatureConfig(calculation_type="Wallace").create_calculator()
+        sequence_temp = calculator.for_sequence(self.sequence)
+        start = len(self.sequence) - 30
+        ends = np.arange(len(self.sequence) - 8, len(self.sequence))
+        threshold = calculator(self.sequence[start:ends[3]])
+        self.assertEqual(3, sequence_temp.first_reaching(start, ends, threshold))
+        with self.assertRaises(ValueError):
+            sequence_temp.first_reaching(start, ends, threshold + 100)
+
+
+class CompiledMeltingTemperatureTest(unittest.TestCase):
+    primers = ["CTCTCTCTCTCTCTCTCTCT", "ATGGCTAGCAAAGGAGAAGAACTTTTC", "ATATATAT", "GCGCXXGCATTAXC", "AXT",
+               "ACGTNACGTACGTTGCA", "acgtgcatgcatgac", "X", "GC"]
+
+    def assert_same_as_biopython(self, config: TemperatureConfig):
+        calculator = config.create_calculator(cached=False)
+        compiled = calculator.calculation_method
+        self.assertIsInstance(compiled, CompiledMeltingTemperature)
+        for primer in self.primers:
+            try:
+                expected = compiled.method(primer)
+            except (ValueError, IndexError) as error:
+                with self.assertRaises(type(error)):
+                    compiled(primer)
+                continue
+            self.assertAlmostEqual(expected, compiled(primer), delta=1e-9, msg=f"{config.to_json()} {primer}")
+
+    def test_gc_value_sets_and_salt_corrections(self):
+        for gc_value_set in gc_value_sets:
+            for salt_correction in salt_corrections:
+                config = TemperatureConfig(calculation_type="GC", gc_value_set=gc_value_set,
+                                           salt_correction=salt_correction)
+                if salt_correction == "SantaLucia_DeltaS_1998":
+                    # Biopython doesn't support it for Tm_GC, the calculator is not compiled
+                    self.assertNotIsInstance(config.create_calculator().calculation_method,
+                                             CompiledMeltingTemperature)
+                    continue
+                self.assert_same_as_biopython(config)
+
+    def test_nn_tables_and_salt_corrections(self):
+        for nn_table in nn_tables:
+            for salt_correction in salt_corrections:
+                for na in [0, 50]:
+                    self.assert_same_as_biopython(TemperatureConfig(nn_table=nn_table, salt_correction=salt_correction,
+                                                                    na=na))
+
+    def test_wallace(self):
+        self.assert_same_as_biopython(TemperatureConfig(calculation_type="Wallace"))
+
+    def test_neb_like_not_compiled(self):
+        calculator = TemperatureConfig(calculation_type="NEB_like").create_calculator()
+        self.assertNotIsInstance(calculator.calculation_method, CompiledMeltingTemperature)
+
+
+class PrimerTemperatureStateTest(unittest.TestCase):
+    sequence = SequenceTemperatureCalculatorTest.sequence
+    mismatches = [40, 41, 44, 52, 60]
+
+    def assert_same_as_calculator(self, config: TemperatureConfig):
+        calculator = config.create_calculator()
+        state = PrimerTemperatureState(calculator, self.sequence, 42, 46, self.mismatches)
+        for step in range(30):
+            if step % 3 == 0:
+                state.extend_left()
+            else:
+                state.extend_right()
+            mismatch_sequence = "".join("X" if i in self.mismatches else self.sequence[i]
+                                        for i in range(state.start, state.end))
+            self.assertEqual(mismatch_sequence, state.get_mismatch_sequence())
+            self.assertAlmostEqual(calculator(mismatch_sequence), state.temperature(), delta=1e-6,
+                                   msg=f"{config.to_json()} {mismatch_sequence}")
+
+    def test_gc_value_sets(self):
+        for gc_value_set in gc_value_sets:
+            self.assert_same_as_calculator(TemperatureConfig(calculation_type="GC", gc_value_set=gc_value_set,
+                                                             precision=8))
+
+    def test_nn_tables(self):
+        for nn_table in nn_tables:
+            self.assert_same_as_calculator(TemperatureConfig(nn_table=nn_table, precision=8))
+
+    def test_wallace(self):
+        self.assert_same_as_calculator(TemperatureConfig(calculation_type="Wallace", precision=8))
+
+
+class TemperatureCacheTest(unittest.TestCase):
+    def test_least_recently_used_evicted(self):
+        cache = TemperatureCache(max_size=2)
+        cache.put("A", 1.0)
+        cache.put("C", 2.0)
+        self.assertEqual(1.0, cache.get("A"))
+        cache.put("G", 3.0)
+
+        self.assertIsNone(cache.get("C"))
+        self.assertEqual(1.0, cache.get("A"))
+        self.assertEqual(3.0, cache.get("G"))
+        self.assertEqual({"hits": 3, "store_hits": 0, "misses": 1, "size": 2}, cache.stats())
+
+    def test_resize(self):
+        cache = TemperatureCache(max_size=3)
+        for i, primer in enumerate(["A", "C", "G"]):
+            cache.put(primer, float(i))
+        cache.resize(1)
+
+        self.assertEqual({"G": 2.0}, dict(cache.entries))
+
+    def test_same_config_shares_cache(self):
+        first = TemperatureConfig(calculation_type="NN", na=48).create_calculator()
+        second = TemperatureConfig(calculation_type="NN", na=48, gc_value_set="Chester_1993").create_calculator()
+        other = TemperatureConfig(calculation_type="NN", na=49).create_calculator()
+
+        self.assertIs(first.cache, second.cache)
+        self.assertIsNot(first.cache, other.cache)
+
+        reset_temperature_cache_stats()
+        first("ACGTACGTTTGACCA")
+        second("ACGTACGTTTGACCA")
+        self.assertEqual(1, first.cache.hits)
+        self.assertEqual(1, first.cache.misses)
+        self.assertIn({"hits": 1, "store_hits": 0, "misses": 1, "size": first.cache.stats()["size"]},
+                      temperature_cache_stats().values())
+
+    def test_same_conditions_share_dimer_cache(self):
+        first = PrimerDimerCalculator(50, 2, 0.8)
+        second = PrimerDimerCalculator(50.0, 2.0, 0.8)
+
+        self.assertIs(first.cache_hairpin, second.cache_hairpin)
+        self.assertIs(get_temperature_cache(("homodimer", 50.0, 2.0, 0.8)), second.cache_homo)
+        self.assertEqual(first.hairpin("GGGGCCCCTTTTGGGGCCCC"), second.hairpin("GGGGCCCCTTTTGGGGCCCC"))
+
+
+def _write_to_store(path, offset):
+    store = TemperatureStore(path)
+    for i in range(offset, offset + 2000):
+        store.put("test", str(i), float(i))
+    store.flush()
+
+
+class TemperatureStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "temperatures.sqlite")
+
+    def tearDown(self):
+        enable_persistent_temperature_caches(None)
+        clear_temperature_caches()
+        self.directory.cleanup()
+
+    def test_values_survive_restart(self):
+        enable_persistent_temperature_caches(self.path)
+        config = TemperatureConfig(calculation_type="NN")
+        temp = config.create_calculator()("ACGTACGTTTGACCA")
+        flush_temperature_caches()
+
+        # Simulate new worker process with empty memory caches
+        clear_temperature_caches()
+        enable_persistent_temperature_caches(self.path)
+        calculator = config.create_calculator()
+
+        self.assertEqual(temp, calculator("ACGTACGTTTGACCA"))
+        self.assertEqual(1, calculator.cache.store_hits)
+        self.assertEqual(0, calculator.cache.misses)
+
+    def test_concurrent_writers(self):
+        processes = [multiprocessing.Process(target=_write_to_store, args=(self.path, 1000 * i))
+                     for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(0, process.exitcode)
+
+        store = TemperatureStore(self.path)
+        for i in range(0, 5000, 250):
+            self.assertEqual(float(i), store.get("test", str(i)))
+        self.assertIsNone(store.get("test", "5000"))
+
+
+class ThermoBatchTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(7)
+        self.sequences = ["".join(rng.choice("ACGT") for _ in range(rng.randint(8, 40))) for _ in range(300)]
+        # Duplicates are evaluated only once, but returned for every occurrence
+        self.sequences += self.sequences[:50]
+
+    def assert_same_as_primer3(self, results):
+        for sequence, tm, structure_found in zip(self.sequences, results.tm, results.structure_found):
+            expected = calcHairpin(sequence, 50, 2, 0.8)
+            self.assertEqual(expected.tm, tm)
+            self.assertEqual(expected.structure_found, structure_found)
+
+    def test_hairpins(self):
+        results = calc_thermo_batch("hairpin", self.sequences, 50, 2, 0.8)
+        self.assertEqual((len(self.sequences),), results.tm.shape)
+        self.assert_same_as_primer3(results)
+
+    def test_process_pool(self):
+        processes = temperature_calculator.THERMO_PROCESSES
+        temperature_calculator.THERMO_PROCESSES = 2
+        try:
+            self.assert_same_as_primer3(calc_thermo_batch("hairpin", self.sequences, 50, 2, 0.8))
+        finally:
+            temperature_calculator.THERMO_PROCESSES = processes
+
+    def test_calculators(self):
+        pd_calc = PrimerDimerCalculator(50, 2, 0.8, cached=False)
+        others = list(reversed(self.sequences))
+        heterodimers = HeteroDimerCalculator(50, 2, 0.8).many(self.sequences[:20], others[:20])
+        self_binding = SelfBindingCalculator(50, 2, 0.8).many(self.sequences[:20])
+
+        for i, sequence in enumerate(self.sequences[:20]):
+            self.assertEqual(calcHomodimer(sequence, 50, 2, 0.8).tm, pd_calc.homodimers(self.sequences[:20])[i])
+            self.assertEqual(calcHeterodimer(sequence, others[i], 50, 2, 0.8).tm, heterodimers[i])
+            self.assertEqual(pd_calc.heterodimer(sequence, others[i]),
+                             pd_calc.heterodimers(self.sequences[:20], others[:20])[i])
+            self.assertEqual(SelfBindingCalculator(50, 2, 0.8)(sequence), self_binding[i])
+
+    def test_cached_batch(self):
+        pd_calc = PrimerDimerCalculator(51, 2, 0.8)
+        single = pd_calc.hairpin(self.sequences[0])
+        temps = pd_calc.hairpins(["", self.sequences[0], self.sequences[1]])
+
+        self.assertEqual([0, single, calcHairpin(self.sequences[1], 51, 2, 0.8).tm], temps.tolist())
+        self.assertEqual(temps[2], pd_calc.cache_hairpin.get(self.sequences[1]))
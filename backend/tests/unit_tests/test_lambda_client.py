@@ -0,0 +1,263 @@
+#    Copyright (c) 2020 Merck Sharp & Dohme Corp. a subsidiary of Merck & Co., Inc., Kenilworth, NJ, USA.
+#
+#    This file is part of the Mutation Maker, An Open Source Oligo Design Software For Mutagenesis and De Novo Gene Synthesis Experiments.
+#
+#    Mutation Maker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mutation_maker.lambda_client import LambdaInvoker, CircuitBreaker, LambdaFunctionError, \
+    LambdaInvocationError, LambdaUnavailableError, create_client, create_payload_batches
+from mutation_maker.primer import Primer
+from mutation_maker.primer3_interoperability import Primer3, Primer3Config, NullPrimerGenerator, _parseBoulderIO
+
+
+def design_stand_in_primers(record):
+    # Forward primer of 10 bases at the position of SEQUENCE_ID
+    start = _parseBoulderIO(record)["SEQUENCE_ID"]
+    return f"PRIMER_LEFT_NUM_RETURNED=1\nPRIMER_LEFT_0={int(start) + 1},10\nPRIMER_RIGHT_NUM_RETURNED=0\n"
+
+
+class StandInLambda(BaseHTTPRequestHandler):
+    """
+    Local stand-in of the Invoke API of AWS Lambda, answers the scripted responses before echoing payloads
+    """
+    responses = []
+    invocations = 0
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            type(self).invocations += 1
+            response = self.responses.pop(0) if self.responses else "ok"
+
+        if response == "throttle":
+            self.send_error_response(429, "TooManyRequestsException", "Rate Exceeded.")
+        elif response == "server_error":
+            self.send_error_response(500, "ServiceException", "Internal error")
+        elif response == "invalid":
+            self.send_error_response(400, "InvalidRequestContentException", "Could not parse request body")
+        elif response == "function_error":
+            self.send_json(200, {"errorMessage": "Task timed out"}, {"X-Amz-Function-Error": "Unhandled"})
+        elif response == "out_of_memory":
+            self.send_json(200, {"errorType": "Runtime.ExitError",
+                                 "errorMessage": "Runtime exited with error: signal: killed"},
+                           {"X-Amz-Function-Error": "Unhandled"})
+        elif response == "handler_error":
+            self.send_json(200, {"errorType": "RuntimeError", "errorMessage": "primer3_core output 1 records of 2",
+                                 "stackTrace": []}, {"X-Amz-Function-Error": "Unhandled"})
+        elif isinstance(payload, list):
+            self.send_json(200, [design_stand_in_primers(record) for record in payload])
+        else:
+            self.send_json(200, "ECHO=" + payload)
+
+    def send_error_response(self, status, error_type, message):
+        self.send_json(status, {"Type": "User", "message": message}, {"x-amzn-ErrorType": error_type})
+
+    def send_json(self, status, body, headers=None):
+        body = json.dumps(body).encode("ascii")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LambdaInvokerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInLambda)
+        cls.server.lock = threading.Lock()
+        cls.endpoint_url = "http://127.0.0.1:{}".format(cls.server.server_address[1])
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StandInLambda.responses = []
+        StandInLambda.invocations = 0
+        self.sleeps = []
+
+    def create_invoker(self, **kwargs):
+        return LambdaInvoker(client_factory=lambda: create_client(self.endpoint_url), concurrency=4,
+                             sleep=self.sleeps.append, **kwargs)
+
+    def test_results_in_order(self):
+        payloads = [f"SEQUENCE_ID={i}\n" for i in range(20)]
+        results = self.create_invoker().invoke_multiple(payloads)
+        self.assertEqual(["ECHO=" + payload for payload in payloads], results)
+
+    def test_retries_throttled_and_failed_invocations(self):
+        StandInLambda.responses = ["throttle", "server_error", "function_error"]
+        invoker = self.create_invoker(backoff_base=1, backoff_max=3)
+        self.assertEqual("ECHO=A", invoker.invoke("A"))
+        self.assertEqual(4, StandInLambda.invocations)
+        # Exponential backoff with full jitter
+        self.assertEqual(3, len(self.sleeps))
+        for sleep, maximum in zip(self.sleeps, [1, 2, 3]):
+            self.assertTrue(0 <= sleep <= maximum)
+        # Concurrency is halved on throttling and recovers with successful invocations
+        self.assertEqual(3, invoker.limit.limit)
+
+    def test_gives_up_after_max_attempts(self):
+        StandInLambda.responses = ["throttle"] * 3
+        invoker = self.create_invoker(max_attempts=3)
+        with self.assertRaises(LambdaInvocationError):
+            invoker.invoke("A")
+        self.assertEqual(3, StandInLambda.invocations)
+        self.assertEqual(1, invoker.limit.limit)
+
+        StandInLambda.responses = ["invalid"]
+        with self.assertRaises(LambdaInvocationError):
+            invoker.invoke("A")
+        # Client errors are not retried
+        self.assertEqual(4, StandInLambda.invocations)
+
+    def test_handler_errors_are_not_retried(self):
+        breaker = CircuitBreaker(threshold=1)
+        invoker = self.create_invoker(breaker=breaker)
+
+        StandInLambda.responses = ["out_of_memory", "handler_error"]
+        with self.assertRaises(LambdaFunctionError):
+            invoker.invoke("A")
+        # Runtime errors are retried, errors of the handler fail fast without opening the circuit
+        self.assertEqual(2, StandInLambda.invocations)
+        self.assertFalse(breaker.is_open())
+        self.assertEqual("ECHO=A", invoker.invoke("A"))
+
+    def test_circuit_breaker(self):
+        now = [0.0]
+        breaker = CircuitBreaker(threshold=2, reset_timeout=10, clock=lambda: now[0])
+        invoker = self.create_invoker(max_attempts=1, breaker=breaker)
+
+        StandInLambda.responses = ["server_error"] * 2
+        for payload in ["A", "B"]:
+            with self.assertRaises(LambdaInvocationError):
+                invoker.invoke(payload)
+        self.assertTrue(breaker.is_open())
+        # Invocations are not sent while the circuit is open
+        with self.assertRaises(LambdaUnavailableError):
+            invoker.invoke("A")
+        self.assertEqual([None, None], invoker.invoke_multiple(["A", "B"]))
+        self.assertEqual(2, StandInLambda.invocations)
+
+        now[0] = 10
+        self.assertEqual("ECHO=A", invoker.invoke("A"))
+        self.assertFalse(breaker.is_open())
+
+
+    def test_batches_of_records(self):
+        configs = []
+        for i in range(7):
+            config = Primer3Config()
+            config.template_sequence("ACGT" * 10)
+            config.config["SEQUENCE_ID"] = i
+            if i % 2:
+                config.pick_only_forward_primer()
+            configs.append(config)
+
+        invoker = self.create_invoker()
+        with mock.patch("mutation_maker.primer3_interoperability.get_lambda_invoker", lambda: invoker), \
+                mock.patch("mutation_maker.primer3_interoperability.LAMBDA_BATCH_SIZE", 3), \
+                mock.patch("mutation_maker.lambda_client.LAMBDA_BATCH_SIZE", 3):
+            designed = Primer3("/nonexistent").design_primers_for_all_mutations(configs)
+
+        self.assertEqual([[Primer("ACGT" * 10, Primer.FORWARD, i, 10)] for i in range(7)], designed)
+        # Records of different global tags are not packed together
+        self.assertEqual(3, StandInLambda.invocations)
+
+
+class PayloadBatchesTest(unittest.TestCase):
+
+    def test_batches_by_size(self):
+        records = ["A" * 10, "B" * 10, "C" * 10, "D" * 30, "E" * 10]
+        self.assertEqual([[0, 1, 2], [3, 4]], create_payload_batches(records, max_records=3, max_bytes=100))
+        self.assertEqual([[0, 1], [2], [3], [4]], create_payload_batches(records, max_records=5, max_bytes=25))
+        self.assertEqual([[0], [1], [2], [3], [4]], create_payload_batches(records, max_records=1, max_bytes=100))
+
+    def test_batches_by_group(self):
+        records = ["A", "B", "C", "D", "E"]
+        self.assertEqual([[0, 2, 4], [1, 3]],
+                         create_payload_batches(records, ["x", "y", "x", "y", "x"], max_records=5, max_bytes=100))
+        self.assertEqual([], create_payload_batches([]))
+
+
+class RecordingPrimerGenerator(NullPrimerGenerator):
+
+    def __init__(self):
+        self.designed = []
+
+    def design_primers_for_all_mutations(self, config_list):
+        self.designed.extend(config_list)
+        return super().design_primers_for_all_mutations(config_list)
+
+
+class Primer3LambdaFallbackTest(unittest.TestCase):
+
+    def test_failed_configs_are_designed_by_fallback(self):
+        class FailingInvoker:
+            def invoke_multiple(self, payloads):
+                return [None if "FAIL" in payload else
+                        "SEQUENCE_TEMPLATE=ACGT\nPRIMER_LEFT_NUM_RETURNED=0\nPRIMER_RIGHT_NUM_RETURNED=0\n"
+                        for payload in payloads]
+
+        def create_config(sequence_id):
+            config = Primer3Config()
+            config.template_sequence("ACGT")
+            config.config["SEQUENCE_ID"] = sequence_id
+            return config
+
+        fallback = RecordingPrimerGenerator()
+        primer3 = Primer3("/nonexistent", lambda_fallback=fallback)
+        configs = [create_config("OK"), create_config("FAIL"), create_config("OK")]
+        # Records are sent as single string payloads
+        with mock.patch("mutation_maker.primer3_interoperability.get_lambda_invoker", FailingInvoker), \
+                mock.patch("mutation_maker.primer3_interoperability.LAMBDA_BATCH_SIZE", 1), \
+                mock.patch("mutation_maker.lambda_client.LAMBDA_BATCH_SIZE", 1):
+            self.assertEqual([[], [], []], primer3.design_primers_for_all_mutations(configs))
+            self.assertEqual([configs[1]], fallback.designed)
+
+            with self.assertRaises(LambdaInvocationError):
+                Primer3("/nonexistent").design_primers_for_all_mutations(configs)
+
+    def test_results_of_other_protocol_are_designed_by_fallback(self):
+        class StringInvoker:
+            def invoke_multiple(self, payloads):
+                # Function accepting only single records
+                return ["SEQUENCE_TEMPLATE=ACGT\nPRIMER_LEFT_NUM_RETURNED=0\nPRIMER_RIGHT_NUM_RETURNED=0\n"
+                        for _ in payloads]
+
+        config = Primer3Config()
+        config.template_sequence("ACGT")
+        fallback = RecordingPrimerGenerator()
+        primer3 = Primer3("/nonexistent", lambda_fallback=fallback)
+        # Batch of a single record is sent as a list payload
+        with mock.patch("mutation_maker.primer3_interoperability.get_lambda_invoker", StringInvoker), \
+                mock.patch("mutation_maker.primer3_interoperability.LAMBDA_BATCH_SIZE", 25), \
+                mock.patch("mutation_maker.lambda_client.LAMBDA_BATCH_SIZE", 25):
+            self.assertEqual([[]], primer3.design_primers_for_all_mutations([config]))
+        self.assertEqual([config], fallback.designed)
@@ -15,10 +15,26 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
 import unittest
+from unittest import mock
 
-from mutation_maker.mutation import ConcreteTripletMutation
-from mutation_maker.primer import Primer
+import numpy as np
+import primer3
+
+from mutation_maker.mutation import ConcreteTripletMutation, AminoMutation
+from mutation_maker.primer import Primer, PrimerTable
+import mutation_maker.primer3_interoperability
+from mutation_maker.primer3_cache import CachedPrimerGenerator, Primer3ResultCache, Primer3DiskStore, \
+    primer3_record_key
+from mutation_maker.primer3_interoperability import AllPrimerGenerator, Primer3Config, Primer3, Primer3InProcess, \
+    NullPrimerGenerator, Primer3Pool, Primer3Process, Primer3ProcessPool, Primer3ProcessTimeout, create_primer3py_args, \
+    parse_primers, _parseBoulderIO
+from mutation_maker.ssm_fast_approximation import calc_GC_content, calc_GC_contents
 
 
 class SSMSequenceTest(unittest.TestCase):
@@ -312,4 +328,356 @@ class SSMSequenceTest(unittest.TestCase):
         self.assertEqual(2, Primer("AAAAAAAAA", Primer.REVERSE, 7, 6).get_five_end_size_from_mutation(
             ConcreteTripletMutation(3, "")))
 
-#TODO get overlap tests
\ No newline at end of file
+#TODO get overlap tests
+
+class PrimerTableTest(unittest.TestCase):
+    template = "ACGTTGCAGGCCATATGCGCAAATTTGGGCCCAGTCAGTC" * 3
+
+    def create_config(self, pick_left: int, pick_right: int, search_region: dict) -> Primer3Config:
+        config = Primer3Config()
+        config.template_sequence(self.template)
+        config.size_range(10, 15, 20)
+        config.search_region(**search_region)
+        config.config["PRIMER_PICK_LEFT_PRIMER"] = pick_left
+        config.config["PRIMER_PICK_RIGHT_PRIMER"] = pick_right
+        return config
+
+    def test_all_primer_candidates(self):
+        mutation = AminoMutation(60, "", "", "", 3)
+        for direction, config in [
+                (Primer.FORWARD, self.create_config(1, 0, dict(forward_from=30, forward_len=40))),
+                (Primer.REVERSE, self.create_config(0, 1, dict(reverse_from=50, reverse_len=40)))]:
+            search_start, search_len = config.get_search_area()
+            # Primers created one by one in the same order
+            expected = [Primer(self.template, direction,
+                               start if direction == Primer.FORWARD else start + length - 1, length)
+                        for length in range(10, 21)
+                        for start in range(search_start, search_start + search_len - length)]
+
+            candidates = AllPrimerGenerator().design_primers(config)
+
+            self.assertIsInstance(candidates, PrimerTable)
+            self.assertEqual(expected, list(candidates))
+            self.assertEqual([primer.get_normal_start() for primer in expected], candidates.normal_starts.tolist())
+            self.assertEqual([primer.get_normal_end() for primer in expected], candidates.normal_ends.tolist())
+            self.assertEqual([primer.get_three_end_size_from_mutation(mutation) for primer in expected],
+                             candidates.get_three_end_sizes_from_mutation(mutation).tolist())
+            self.assertEqual([primer.get_five_end_size_from_mutation(mutation) for primer in expected],
+                             candidates.get_five_end_sizes_from_mutation(mutation).tolist())
+
+            sizes = np.arange(len(candidates)) % 10 + 1
+            starts, ends = candidates.get_three_end_bounds_with_sizes(sizes)
+            self.assertEqual([primer.get_three_end_with_size(size) for primer, size in zip(expected, sizes.tolist())],
+                             [self.template[start:end] for start, end in zip(starts.tolist(), ends.tolist())])
+            self.assertEqual([calc_GC_content(primer.normal_order_sequence) for primer in expected],
+                             calc_GC_contents(self.template, candidates.normal_starts, candidates.normal_ends).tolist())
+
+            selected = candidates.select(sizes > 5)
+            self.assertEqual([primer for primer, size in zip(expected, sizes.tolist()) if size > 5], list(selected))
+
+    def test_primer_table_from_primers(self):
+        primers = [Primer(self.template, Primer.FORWARD, 3, 10), Primer(self.template, Primer.REVERSE, 30, 12),
+                   Primer(self.template, Primer.FORWARD, 7, 5)]
+        table = PrimerTable.from_primers(self.template, primers)
+        self.assertIs(primers[1], table[1])
+        self.assertIs(primers[2], table[-1])
+        self.assertEqual([3, 19, 7], table.normal_starts.tolist())
+        self.assertEqual([13, 31, 12], table.normal_ends.tolist())
+        self.assertIs(table, PrimerTable.from_primers(self.template, table))
+
+        selected = table.select(np.array([2, 1]))
+        self.assertIs(primers[2], selected[0])
+        self.assertIs(primers[1], selected[1])
+        with self.assertRaises(IndexError):
+            selected[2]
+        with self.assertRaises(AttributeError):
+            table.extra_column = np.zeros(3)
+
+    def test_candidates_out_of_sequence(self):
+        with self.assertRaises(ValueError):
+            AllPrimerGenerator().design_primers(self.create_config(1, 0, dict(forward_from=100, forward_len=40)))
+        with self.assertRaises(ValueError):
+            AllPrimerGenerator().design_primers(self.create_config(0, 1, dict(reverse_from=-5, reverse_len=40)))
+
+
+def _design_primers_in_executor(queue, configs):
+    primers = Primer3InProcess().design_primers_for_all_mutations(configs)
+    queue.put((mutation_maker.primer3_interoperability._primer3_executor is not None, primers))
+
+
+class Primer3InProcessTest(unittest.TestCase):
+    template = "ATGGAAAGGGTAAAGGGAAAAGTTGCTATAGTCACCGGTGCTGCTCGTGGTCAAGGTGCAGCGGAAGCGCGCTTGCTGGCCAAAGAAGGCGCGAAG" \
+               "GTGTGCCTGACTGACGTGTTGGTTGATGAGGGTCGTACCGTTGCAGAAGAACTGCAGAAAGAGGGCTACGACACTGTTTTTGAACGTCTGGATGTG"
+
+    def create_configs(self, max_size: int):
+        forward_config = Primer3Config()
+        forward_config.force_reverse_primer("CACATCCAGACGTTCAAAAACAGTG")
+        forward_config.search_region(forward_from=40, forward_len=50)
+        reverse_config = Primer3Config()
+        reverse_config.force_forward_primer("ATGGAAAGGGTAAAGGGAAAAGTTG")
+        reverse_config.search_region(reverse_from=90, reverse_len=50)
+        for config in [forward_config, reverse_config]:
+            config.template_sequence(self.template)
+            config.size_range(20, 25, max_size)
+            config.gc_content_range(0, None, 100)
+            config.temperature_range(0, None, 100)
+            config.gc_clamp(0)
+        return [forward_config, reverse_config]
+
+    def test_primer3py_args(self):
+        forward_config, reverse_config = self.create_configs(30)
+        seq_args, global_args = create_primer3py_args(forward_config.config)
+        self.assertEqual([[40, 50, -1, -1]], seq_args["SEQUENCE_PRIMER_PAIR_OK_REGION_LIST"])
+        self.assertEqual(self.template, seq_args["SEQUENCE_TEMPLATE"])
+        self.assertEqual(30, global_args["PRIMER_MAX_SIZE"])
+        self.assertNotIn("SEQUENCE_TEMPLATE", global_args)
+
+        reverse_config.set_thermodynamic_parameters_path("/primer3_config/")
+        seq_args, global_args = create_primer3py_args(reverse_config.config)
+        self.assertEqual([[-1, -1, 90, 50]], seq_args["SEQUENCE_PRIMER_PAIR_OK_REGION_LIST"])
+        self.assertNotIn("PRIMER_THERMODYNAMIC_PARAMETERS_PATH", global_args)
+
+    def test_design_primers(self):
+        configs = self.create_configs(30)
+        with mock.patch("mutation_maker.primer3_interoperability.PRIMER3_PROCESSES", 1):
+            serial = Primer3InProcess().design_primers_for_all_mutations(configs)
+
+        for config, primers in zip(configs, serial):
+            self.assertGreater(len(primers), 0)
+            self.assertTrue(all(primer.direction == config.get_direction() for primer in primers))
+            # Primers are parsed as the Boulder-IO output of primer3_core
+            output = primer3.bindings.design_primers(*create_primer3py_args(config.config))
+            boulder_output = "".join(f"{key}={value[0]},{value[1]}\n" if isinstance(value, list) else f"{key}={value}\n"
+                                     for key, value in output.items()
+                                     if re.fullmatch(r"PRIMER_(LEFT|RIGHT)_(\d+|NUM_RETURNED)", key))
+            self.assertEqual(parse_primers(_parseBoulderIO(boulder_output + f"SEQUENCE_TEMPLATE={self.template}\n")),
+                             primers)
+
+        with mock.patch("mutation_maker.primer3_interoperability.PRIMER3_PROCESSES", 2):
+            parallel = Primer3InProcess().design_primers_for_all_mutations(configs)
+            self.assertIsNotNone(mutation_maker.primer3_interoperability._primer3_executor)
+        self.assertEqual(serial, parallel)
+
+    def test_design_primers_in_daemonic_process(self):
+        # Prefork Celery workers are daemonic processes
+        queue = multiprocessing.Queue()
+        with mock.patch("mutation_maker.primer3_interoperability.PRIMER3_PROCESSES", 2):
+            process = multiprocessing.Process(target=_design_primers_in_executor, args=(queue, self.create_configs(30)),
+                                              daemon=True)
+            process.start()
+            executor_used, primers = queue.get(timeout=60)
+            process.join()
+        self.assertTrue(executor_used)
+        self.assertEqual(Primer3InProcess().design_primers_for_all_mutations(self.create_configs(30)), primers)
+
+    def test_fallback_for_long_primers(self):
+        # Released primer3-py is built for primers of at most 36 bases
+        configs = self.create_configs(60)
+        self.assertEqual([[], []], Primer3InProcess(NullPrimerGenerator()).design_primers_for_all_mutations(configs))
+        with self.assertRaises(ValueError):
+            Primer3InProcess().design_primers(configs[0])
+
+        # Long primers are not designed by primer3-py, rejected configs are designed by the fallback at once
+        fallback = CountingPrimerGenerator()
+        configs = [self.create_configs(30)[0], configs[0], self.create_configs(30)[1], configs[1]]
+        with mock.patch("mutation_maker.primer3_interoperability._design_primers_in_process",
+                        wraps=mutation_maker.primer3_interoperability._design_primers_in_process) as design:
+            designed = Primer3InProcess(fallback).design_primers_for_all_mutations(configs)
+        self.assertEqual(2, design.call_count)
+        self.assertEqual([configs[1], configs[3]], fallback.designed)
+        self.assertEqual(Primer3InProcess().design_primers_for_all_mutations([configs[0], configs[2]]),
+                         [designed[0], designed[2]])
+        self.assertEqual([list(fallback.design_primers(configs[1])), list(fallback.design_primers(configs[3]))],
+                         [designed[1], designed[3]])
+
+    @unittest.skipUnless(os.path.exists(os.path.join(os.environ.get("PRIMER3HOME", ""), "primer3_core")),
+                         "primer3_core is not installed")
+    def test_same_as_primer3_core(self):
+        primer3_core = Primer3()
+        for config in self.create_configs(30):
+            self.assertEqual(primer3_core.design_primers(config), Primer3InProcess().design_primers(config))
+
+
+# Echoes records as primer3_core, followed by the pid of the process and the number of records it designed
+FAKE_PRIMER3_CORE = f"""#!{sys.executable}
+import os
+import sys
+import time
+
+count = 0
+for line in sys.stdin:
+    if line.strip() == "SEQUENCE_ID=hang":
+        time.sleep(60)
+    if line.strip() == "=":
+        count += 1
+        print(f"PID={{os.getpid()}}\\nCOUNT={{count}}\\n=", flush=True)
+    else:
+        sys.stdout.write(line)
+"""
+
+
+class Primer3PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.binary = os.path.join(self.directory.name, "primer3_core")
+        with open(self.binary, "w") as binary:
+            binary.write(FAKE_PRIMER3_CORE)
+        os.chmod(self.binary, 0o755)
+        self.pool = Primer3ProcessPool(self.binary, 3)
+
+    def tearDown(self):
+        self.pool.close()
+        self.directory.cleanup()
+
+    def design(self, count, global_tags):
+        records = [f"SEQUENCE_ID={i}\n=\n" for i in range(count)]
+        outputs = [_parseBoulderIO(output) for output in self.pool.design(records, global_tags)]
+        self.assertEqual([str(i) for i in range(count)], [output["SEQUENCE_ID"] for output in outputs])
+        return outputs
+
+    def test_results_in_order_of_records(self):
+        forward, reverse = frozenset(["PRIMER_PICK_RIGHT_PRIMER"]), frozenset(["PRIMER_PICK_LEFT_PRIMER"])
+        outputs = self.design(10, [forward, reverse] * 5)
+
+        # Records of different global tags are not designed by the same process
+        forward_pids = {output["PID"] for output in outputs[::2]}
+        reverse_pids = {output["PID"] for output in outputs[1::2]}
+        self.assertFalse(forward_pids & reverse_pids)
+
+        self.assertEqual([], self.pool.design([], []))
+
+    @unittest.skipIf(mutation_maker.primer3_interoperability._LINE_BUFFERED_PREFIX is None, "stdbuf is not installed")
+    def test_processes_are_reused(self):
+        tags = [frozenset(["PRIMER_MAX_SIZE"])] * 6
+        first = self.design(6, tags)
+        second = self.design(6, tags)
+        # No process is started for the second batch
+        self.assertLessEqual({output["PID"] for output in second}, {output["PID"] for output in first})
+        self.assertTrue(all(int(output["COUNT"]) > 2 for output in second[::2]))
+
+    def test_restart_of_crashed_process(self):
+        tags = [frozenset(["PRIMER_MAX_SIZE"])] * 6
+        self.design(6, tags)
+        for process in self.pool.processes:
+            if process.is_alive():
+                process.process.kill()
+                process.process.wait()
+        outputs = self.design(6, tags)
+        self.assertEqual(["1", "2"], [output["COUNT"] for output in outputs[:2]])
+        self.assertTrue(all(process.is_alive() or not process.persistent for process in self.pool.processes))
+
+    def test_warning_without_stdbuf(self):
+        with mock.patch("mutation_maker.primer3_interoperability._LINE_BUFFERED_PREFIX", None):
+            with self.assertWarns(RuntimeWarning):
+                pool = Primer3ProcessPool(self.binary, 1)
+            try:
+                self.assertFalse(pool.processes[0].persistent)
+                self.assertEqual(["1"], [_parseBoulderIO(output)["SEQUENCE_ID"]
+                                         for output in pool.design(["SEQUENCE_ID=1\n=\n"], [frozenset()])])
+            finally:
+                pool.close()
+
+    def test_kill_of_hung_process(self):
+        process = Primer3Process(self.binary, timeout=0.5)
+        tags = frozenset(["PRIMER_MAX_SIZE"])
+        try:
+            with self.assertRaises(Primer3ProcessTimeout):
+                process.design(["SEQUENCE_ID=0\n=\n", "SEQUENCE_ID=hang\n=\n"], tags)
+            self.assertFalse(process.is_alive())
+
+            outputs = [_parseBoulderIO(output) for output in process.design(["SEQUENCE_ID=1\n=\n"], tags)]
+            self.assertEqual(["1"], [output["SEQUENCE_ID"] for output in outputs])
+        finally:
+            process.stop()
+
+    @unittest.skipUnless(os.path.exists(os.path.join(os.environ.get("PRIMER3HOME", ""), "primer3_core")),
+                         "primer3_core is not installed")
+    def test_same_as_primer3_core(self):
+        configs = Primer3InProcessTest().create_configs(30) * 3
+        primer3_core = Primer3()
+        pool = Primer3Pool(processes=2)
+        try:
+            self.assertEqual([primer3_core.design_primers(config) for config in configs],
+                             pool.design_primers_for_all_mutations(configs))
+        finally:
+            pool.close()
+
+
+class CountingPrimerGenerator(AllPrimerGenerator):
+
+    def __init__(self):
+        self.designed = []
+
+    def design_primers_for_all_mutations(self, config_list):
+        self.designed.extend(config_list)
+        return [list(self.design_primers(config)) for config in config_list]
+
+
+class CachedPrimerGeneratorTest(unittest.TestCase):
+    template = Primer3InProcessTest.template
+
+    def create_config(self, pick_left: int, pick_right: int, search_region: dict, max_temp=None) -> Primer3Config:
+        config = Primer3Config()
+        config.template_sequence(self.template)
+        config.size_range(10, 15, 20)
+        config.search_region(**search_region)
+        config.temperature_range(maximum=max_temp)
+        config.config["PRIMER_PICK_LEFT_PRIMER"] = pick_left
+        config.config["PRIMER_PICK_RIGHT_PRIMER"] = pick_right
+        return config
+
+    def create_configs(self, max_temp=None):
+        return [self.create_config(1, 0, dict(forward_from=30, forward_len=40), max_temp),
+                self.create_config(0, 1, dict(reverse_from=50, reverse_len=40), max_temp),
+                self.create_config(1, 0, dict(forward_from=30, forward_len=40), max_temp)]
+
+    def test_only_missing_records_are_designed(self):
+        generator = CountingPrimerGenerator()
+        cache = Primer3ResultCache(10)
+        cached_generator = CachedPrimerGenerator(generator, cache)
+        configs = self.create_configs()
+        expected = [list(AllPrimerGenerator().design_primers(config)) for config in configs]
+
+        self.assertEqual(expected, cached_generator.design_primers_for_all_mutations(configs))
+        # Same records of a batch are designed once
+        self.assertEqual(configs[:2], generator.designed)
+        self.assertEqual(expected, cached_generator.design_primers_for_all_mutations(configs))
+        self.assertEqual(2, len(generator.designed))
+        self.assertEqual({"hits": 2, "store_hits": 0, "misses": 2, "size": 2}, cache.stats())
+
+        changed_configs = self.create_configs(max_temp=70)
+        cached_generator.design_primers_for_all_mutations(changed_configs)
+        self.assertEqual(configs[:2] + changed_configs[:2], generator.designed)
+
+    def test_record_key(self):
+        config = self.create_config(1, 0, dict(forward_from=30, forward_len=40))
+        reordered = Primer3Config()
+        reordered.config = dict(reversed(list(config.config.items())))
+        self.assertEqual(primer3_record_key(config), primer3_record_key(reordered))
+        reordered.set_thermodynamic_parameters_path("/primer3_config/")
+        self.assertEqual(primer3_record_key(config), primer3_record_key(reordered))
+        reordered.gc_clamp(1)
+        self.assertNotEqual(primer3_record_key(config), primer3_record_key(reordered))
+
+    def test_least_recently_used_records_are_evicted(self):
+        cache = Primer3ResultCache(2)
+        cache.put_many({"a": "1", "b": "2"})
+        self.assertEqual({"a": "1"}, cache.get_many(["a"]))
+        cache.put_many({"c": "3"})
+        self.assertEqual({"a": "1", "c": "3"}, cache.get_many(["a", "b", "c"]))
+        self.assertEqual(1, cache.misses)
+
+    def test_disk_store(self):
+        configs = self.create_configs()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "primer3.sqlite")
+            first = CachedPrimerGenerator(CountingPrimerGenerator(), Primer3ResultCache(10, [Primer3DiskStore(path)]))
+            expected = first.design_primers_for_all_mutations(configs)
+
+            # Records designed by another process are read from the store
+            generator = CountingPrimerGenerator()
+            cache = Primer3ResultCache(10, [Primer3DiskStore(path)])
+            self.assertEqual(expected, CachedPrimerGenerator(generator, cache).design_primers_for_all_mutations(configs))
+            self.assertEqual([], generator.designed)
+            self.assertEqual(2, cache.store_hits)
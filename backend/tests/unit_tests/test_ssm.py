@@ -15,10 +15,14 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import multiprocessing
 import random
 import unittest
 from difflib import SequenceMatcher
+from unittest import mock
 
+import numpy as np
 from Bio.Seq import reverse_complement
 
 from mutation_maker.primer3_interoperability import (
@@ -26,9 +30,11 @@ from mutation_maker.primer3_interoperability import (
     Primer3,
     NullPrimerGenerator,
 )
-from mutation_maker.ssm import ssm_solve
+import mutation_maker.ssm
+from mutation_maker.ssm import ssm_solve, ssm_solve_stream, SSMSolver, pick_best_solution, sum_of_non_optimalities
+from mutation_maker.ssm_types import SSMFlankingSequences, SSMConfig
 from mutation_maker.temperature_calculator import TemperatureConfig
-from tasks import PRIMER3_PATH
+from tasks import PRIMER3_PATH, SSM_STREAM_KEY, SSMStreamLines
 from tests.test_support import (
     generate_SSM_input,
     generate_random_SSM_input,
@@ -848,6 +854,211 @@ class SsmSolveTestSpecificConfigsRandom16(SsmSolveTestConfigRange):
     hairpins = False
 
 
+class SsmTempCombinationsScoringTest(unittest.TestCase):
+    def test_scores_equal_to_single_combinations(self):
+        workflow_input = generate_SSM_input(6, primer_growth=False, separateTM=True)
+        workflow_input.config.separate_forward_reverse_temperatures = True
+        solver = SSMSolver(workflow_input.sequences, workflow_input.config,
+                           NullPrimerGenerator(), AllPrimerGenerator())
+        flanks = SSMFlankingSequences(workflow_input.sequences.forward_primer,
+                                      workflow_input.sequences.reverse_primer)
+        mutations = workflow_input.parse_mutations(solver.goi_range[0])
+        _, possible_pairs = solver.generate_primers(mutations, solver.secondary_primer_generator, "secondary")
+        temp_combinations = solver.get_temp_combinations()
+
+        # Chunks of a single combination and of all combinations
+        for max_chunk_elements in [1, len(temp_combinations) * max(len(pairs.pair_indexes)
+                                                                   for pairs in possible_pairs)]:
+            best_indexes, best_scores, _, _ = solver.score_temp_combinations(
+                possible_pairs, temp_combinations, workflow_input.config, max_chunk_elements)
+            self.assertEqual((len(possible_pairs), len(temp_combinations)), best_indexes.shape)
+
+            for combination_idx in range(0, len(temp_combinations), 7):
+                solution = solver.get_best_primers_for_temp_ranges(possible_pairs, *temp_combinations[combination_idx],
+                                                                   workflow_input.config, flanks)
+                self.assertEqual(solution.primer_non_optimalities(), best_scores[:, combination_idx].tolist())
+
+        best_idx = np.argmin(sum_of_non_optimalities(best_scores).astype(np.float32)).item()
+        solutions = [solver.create_solution(possible_pairs, temp_combination, best_indexes[:, combination_idx],
+                                            best_scores[:, combination_idx], workflow_input.config)
+                     for combination_idx, temp_combination in enumerate(temp_combinations)]
+        self.assertIs(pick_best_solution(solutions), solutions[best_idx])
+
+        lower_bounds = solver.get_temp_combinations_lower_bounds(possible_pairs, temp_combinations,
+                                                                 workflow_input.config)
+        self.assertTrue(np.all(lower_bounds <= sum_of_non_optimalities(best_scores) * (1 + 1e-9)))
+
+        for prune_temp_combinations in [False, True]:
+            workflow_input.config.prune_temp_combinations = prune_temp_combinations
+            solution = solver.find_best_temp_combination(possible_pairs, temp_combinations, flanks)
+            self.assertEqual(solutions[best_idx].primer_non_optimalities(), solution.primer_non_optimalities())
+            self.assertEqual((solutions[best_idx].forward_temp, solutions[best_idx].reverse_temp,
+                              solutions[best_idx].overlap_temp),
+                             (solution.forward_temp, solution.reverse_temp, solution.overlap_temp))
+            if prune_temp_combinations:
+                self.assertGreater(solution.pruned_combinations, 0)
+            else:
+                self.assertEqual(0, solution.pruned_combinations)
+
+    def test_alternative_pairs(self):
+        rng = np.random.RandomState(0)
+        for scores in [rng.rand(20, 30), rng.randint(0, 5, (20, 30)).astype(np.float64), rng.rand(20, 3)]:
+            minimal_pair_idxs = np.argmin(scores, axis=1)
+            indexes, alternative_scores = SSMSolver.get_alternative_pairs(scores, minimal_pair_idxs, 4)
+            for row, minimal_pair_idx, row_indexes, row_scores in zip(scores, minimal_pair_idxs, indexes,
+                                                                      alternative_scores):
+                expected = np.delete(row, minimal_pair_idx)
+                expected.sort()
+                width = min(4, len(expected))
+                self.assertEqual(expected[:width].tolist(), row_scores[:width].tolist())
+                self.assertEqual(row[row_indexes[:width]].tolist(), row_scores[:width].tolist())
+                self.assertNotIn(minimal_pair_idx, row_indexes.tolist())
+                self.assertEqual(width, len(set(row_indexes[:width].tolist())))
+                self.assertTrue(np.all(row_indexes[width:] == -1))
+
+    def test_solution_alternatives(self):
+        workflow_input = generate_SSM_input(6, primer_growth=False, separateTM=True)
+        workflow_input.config.separate_forward_reverse_temperatures = True
+        solver = SSMSolver(workflow_input.sequences, workflow_input.config,
+                           NullPrimerGenerator(), AllPrimerGenerator())
+        flanks = SSMFlankingSequences(workflow_input.sequences.forward_primer,
+                                      workflow_input.sequences.reverse_primer)
+        mutations = workflow_input.parse_mutations(solver.goi_range[0])
+        _, possible_pairs = solver.generate_primers(mutations, solver.secondary_primer_generator, "secondary")
+        temp_combinations = solver.get_temp_combinations()
+
+        solution = solver.find_best_temp_combination(possible_pairs, temp_combinations, flanks)
+        self.assertEqual([[]] * len(possible_pairs), solution.alternatives)
+
+        workflow_input.config.alternative_primer_pairs = 3
+        alternatives_solution = solver.find_best_temp_combination(possible_pairs, temp_combinations, flanks)
+        self.assertEqual(solution.primer_non_optimalities(), alternatives_solution.primer_non_optimalities())
+
+        for pair, alternatives in zip(alternatives_solution.result, alternatives_solution.alternatives):
+            self.assertEqual(3, len(alternatives))
+            non_optimalities = [alternative.non_optimality for alternative in alternatives]
+            self.assertEqual(sorted(non_optimalities), non_optimalities)
+            self.assertLessEqual(pair.non_optimality, non_optimalities[0])
+            self.assertNotIn((pair.fw_primer, pair.rw_primer),
+                             [(alternative.fw_primer, alternative.rw_primer) for alternative in alternatives])
+
+        output = ssm_solve(workflow_input, NullPrimerGenerator(), AllPrimerGenerator())
+        self.assertTrue(all(len(result["alternatives"]) == 3 for result in output["results"]))
+
+
+class SsmSolveStreamTest(unittest.TestCase):
+    def assert_stream_equal(self, workflow_input):
+        progress = []
+        stream = ssm_solve_stream(workflow_input, NullPrimerGenerator(), AllPrimerGenerator(),
+                                  lambda stage, done, total: progress.append((stage, done, total)))
+
+        output = next(stream)
+        self.assertEqual([], output.results)
+        self.assertNotIn("results", [stage for stage, _, _ in progress])
+
+        mutation_outputs = []
+        for mutation_output in stream:
+            mutation_outputs.append(mutation_output.to_json())
+            self.assertEqual(("results", len(mutation_outputs), len(workflow_input.mutations)), progress[-1])
+
+        result = ssm_solve(workflow_input, NullPrimerGenerator(), AllPrimerGenerator())
+        self.assertEqual(result["results"], mutation_outputs)
+        result.pop("results")
+        self.assertEqual(result, {key: value for key, value in output.to_json().items() if key != "results"})
+
+        stages = [stage for stage, _, _ in progress]
+        self.assertEqual(["results", "temperatures"], sorted(set(stages) - {"primers"}))
+        temperatures = [(done, total) for stage, done, total in progress if stage == "temperatures"]
+        self.assertEqual(temperatures[-1][0], temperatures[-1][1])
+
+    def test_fast_approximation(self):
+        self.assert_stream_equal(generate_SSM_input(3, primer_growth=True, separateTM=True))
+
+    def test_all_temp_combinations(self):
+        workflow_input = generate_SSM_input(6, primer_growth=False, separateTM=True)
+        workflow_input.config.separate_forward_reverse_temperatures = True
+        self.assert_stream_equal(workflow_input)
+
+
+class RecordingRedis:
+    """ Redis client recording lists appended by pipelines """
+
+    def __init__(self):
+        self.lists = {}
+        self.expires = {}
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+
+    def expire(self, key, seconds):
+        self.expires[key] = seconds
+
+    def execute(self):
+        pass
+
+
+class SsmStreamLinesTest(unittest.TestCase):
+    def test_lines_are_appended_while_streaming(self):
+        workflow_input = generate_SSM_input(3, primer_growth=True, separateTM=True)
+        task = mock.Mock()
+        task.request.id = "task"
+        task.backend.expires = 3600
+        client = RecordingRedis()
+        key = SSM_STREAM_KEY.format("task")
+
+        stream = SSMStreamLines(task, client).append_all(
+            ssm_solve_stream(workflow_input, NullPrimerGenerator(), AllPrimerGenerator()))
+        next(stream)
+        # Output is appended before the results are built
+        self.assertEqual(["output"], [json.loads(line)["type"] for line in client.lists[key]])
+        results = [result.to_json() for result in stream]
+
+        lines = [json.loads(line) for line in client.lists[key]]
+        self.assertEqual(["output"] + ["result"] * 3, [line["type"] for line in lines])
+        self.assertEqual(results, [line["result"] for line in lines[1:]])
+        self.assertEqual([], lines[0]["output"]["results"])
+        self.assertEqual(3600, client.expires[key])
+
+
+def _map_in_ssm_executor(queue):
+    config = SSMConfig()
+    config.parallel_solve = True
+    executor = mutation_maker.ssm._get_ssm_executor(config)
+    queue.put(list(executor.map(abs, [-1, -2, -3])))
+
+
+class SsmParallelSolveTest(unittest.TestCase):
+    def assert_parallel_equal(self, workflow_input):
+        serial_result = ssm_solve(workflow_input, NullPrimerGenerator(), AllPrimerGenerator())
+        workflow_input.config.parallel_solve = True
+        with mock.patch("mutation_maker.ssm.SSM_PROCESSES", 2):
+            parallel_result = ssm_solve(workflow_input, NullPrimerGenerator(), AllPrimerGenerator())
+            self.assertIsNotNone(mutation_maker.ssm._ssm_executor)
+        serial_result.pop("input_data")
+        parallel_result.pop("input_data")
+        self.assertEqual(serial_result, parallel_result)
+
+    def test_pool_in_daemonic_process(self):
+        # Prefork Celery workers are daemonic processes
+        queue = multiprocessing.Queue()
+        with mock.patch("mutation_maker.ssm.SSM_PROCESSES", 2):
+            process = multiprocessing.Process(target=_map_in_ssm_executor, args=(queue,), daemon=True)
+            process.start()
+            self.assertEqual([1, 2, 3], queue.get(timeout=60))
+            process.join()
+
+    def test_fast_approximation(self):
+        self.assert_parallel_equal(generate_SSM_input(3, primer_growth=True, separateTM=True))
+
+    def test_all_temp_combinations(self):
+        workflow_input = generate_SSM_input(6, primer_growth=False, separateTM=True)
+        workflow_input.config.separate_forward_reverse_temperatures = True
+        self.assert_parallel_equal(workflow_input)
+
+
 """
 calculate_mutagenic_primer_search_area
 ssm_solve
@@ -15,12 +15,15 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import random
 import unittest
 from mutation_maker.mutation import AminoMutation
-from mutation_maker.ssm_fast_approximation import grow_primers, grow_forward_primer, grow_reverse_primer
+from mutation_maker.ssm_fast_approximation import grow_primers, grow_forward_primer, grow_reverse_primer, \
+    find_best_overlaps, find_best_overlaps_for_temps, compute_grown_solution_score, GrownSolutionScorer, \
+    find_alternative_pairs
 
-from mutation_maker.ssm_types import SSMPrimerSpec
-from mutation_maker.temperature_calculator import TemperatureConfig
+from mutation_maker.ssm_types import SSMPrimerSpec, SSMConfig, SSMFlankingSequences, SSMGrownSolution
+from mutation_maker.temperature_calculator import TemperatureConfig, PrimerDimerCalculator
 
 
 class SSMPrimerGrowthTest(unittest.TestCase):
@@ -95,3 +98,92 @@ class SSMPrimerGrowthTest(unittest.TestCase):
 
         self.assertEqual(expected_fw, fw_computed[0])
         self.assertEqual(expected_rv, rv_computed[0])
+
+
+class SSMGrownSolutionScoreTest(unittest.TestCase):
+    def test_scorer_memoizes_scores(self):
+        rng = random.Random(0)
+        sequence = "".join(rng.choice("ACGT") for _ in range(300))
+        flanks = SSMFlankingSequences("ATGATGATGATGATGATGATG", "TACTACTACTACTACTACTAC")
+        overlaps = [SSMPrimerSpec(offset, 20, 0, 60.0) for offset in [50, 120, 200]]
+        # Solutions share overlaps and reverse primers and differ in one forward primer
+        rw_primers = [SSMPrimerSpec(offset - 15, 35, 15, 58.0) for offset in [50, 120, 200]]
+        solutions = [SSMGrownSolution(overlaps, [SSMPrimerSpec(offset, 33 + i, 13 + i, 61.0)
+                                                 for offset in [50, 120, 200]], rw_primers)
+                     for i in range(2)]
+        solutions.append(SSMGrownSolution(overlaps, solutions[0].fw_primers[:2] + solutions[1].fw_primers[2:],
+                                          rw_primers))
+
+        for compute_hairpin_homodimer in [False, True]:
+            config = SSMConfig(compute_hairpin_homodimer=compute_hairpin_homodimer)
+            pd_calc = PrimerDimerCalculator(config.temperature_config.k, config.temperature_config.mg,
+                                            config.temperature_config.dntp)
+            scorer = GrownSolutionScorer(config, sequence, flanks)
+            for solution in solutions:
+                self.assertEqual(compute_grown_solution_score(config, sequence, solution, flanks, pd_calc),
+                                 scorer(solution))
+            # The last solution has the reaction temperatures of the first one and is scored from the cache
+            self.assertEqual(6, len(scorer.scores))
+
+    def test_find_alternative_pairs(self):
+        rng = random.Random(0)
+        sequence = "".join(rng.choice("ACGT") for _ in range(300))
+        flanks = SSMFlankingSequences("ATGATGATGATGATGATGATG", "TACTACTACTACTACTACTAC")
+        overlaps = [SSMPrimerSpec(offset, 20, 0, 60.0) for offset in [50, 120]]
+        rw_primers = [SSMPrimerSpec(offset - 15, 35, 15, 58.0) for offset in [50, 120]]
+        solutions = [SSMGrownSolution(overlaps, [SSMPrimerSpec(offset, 33 + i, 13 + i, 61.0 + i)
+                                                 for offset in [50, 120]], rw_primers)
+                     for i in range(4)]
+        scorer = GrownSolutionScorer(SSMConfig(), sequence, flanks)
+        best_solution = solutions[1]
+
+        alternatives = find_alternative_pairs(solutions + solutions, best_solution, scorer, 2)
+
+        self.assertEqual(2, len(alternatives))
+        for i, pairs in enumerate(alternatives):
+            candidates = [(solution.overlaps[i], solution.fw_primers[i], solution.rw_primers[i])
+                          for solution in solutions if solution is not best_solution]
+            scores = scorer.score_pairs(*zip(*candidates), best_solution.fw_temp, best_solution.rw_temp,
+                                        best_solution.overlap_temp)
+            expected = sorted(zip(scores, range(len(candidates))))[:2]
+            self.assertEqual([candidates[idx] + (score,) for score, idx in expected], [tuple(pair) for pair in pairs])
+
+
+def scan_best_overlap(sequence, min_five_end_size, min_overlap_size, max_overlap_size, mutation, overlap_temp,
+                      temp_calculator, half_temp_range):
+    """ Overlap scan of find_best_overlaps calling the calculator on each overlap """
+    best = None
+    for length in range(min_overlap_size, max_overlap_size - 1):
+        for offset in range((mutation.position + mutation.length) - length, mutation.position - 1):
+            if (offset + length) <= (mutation.position + mutation.length + min_five_end_size) or \
+                    (offset + min_five_end_size) >= mutation.position:
+                continue
+            tm = temp_calculator(sequence[offset:offset + length])
+            if best is None or tm < best.three_end_temp:
+                best = SSMPrimerSpec(offset, length, 0, tm)
+            if abs(best.three_end_temp - overlap_temp) < half_temp_range:
+                break
+    return best
+
+
+class SSMOverlapSearchTest(unittest.TestCase):
+    def test_find_best_overlaps_for_temps(self):
+        temp_calculator = TemperatureConfig().create_calculator()
+        rng = random.Random(0)
+        # Temperatures of overlaps decrease with their offset at the boundary of GC and AT rich regions
+        sequence = "GGGCCCGCGGCCGCGGGCCCGC" * 3 + "ATATTATAATTTAAATAT" * 3 + \
+            "".join(rng.choice("ACGT") for _ in range(200))
+        mutations = [AminoMutation(position, "", "", "", 3) for position in [60, 64, 72, 150, 240]]
+        overlap_temps = [float(temp) for temp in range(0, 90, 3)]
+
+        results = find_best_overlaps_for_temps(sequence, 3, 10, 30, mutations, overlap_temps, temp_calculator, 2.5)
+
+        self.assertEqual(len(overlap_temps), len(results))
+        # The scan stops at different overlaps for different temperatures
+        self.assertGreater(len({overlaps[0] for overlaps in results}), 1)
+        for overlap_temp, overlaps in zip(overlap_temps, results):
+            expected = [scan_best_overlap(sequence, 3, 10, 30, mutation, overlap_temp, temp_calculator, 2.5)
+                        for mutation in mutations]
+            self.assertEqual(expected, overlaps)
+            self.assertEqual(expected, find_best_overlaps(sequence, 3, 10, 30, mutations, overlap_temp,
+                                                          temp_calculator, 2.5))
@@ -121,6 +121,17 @@ export type SSMMutationPairingReport = {
   secondary_algorithm_used: boolean
 }
 
+export type SSMAlternativeData = {
+  parameters_in_range: boolean
+  non_optimality: number
+  forward_primer: SSMPrimerData
+  reverse_primer: SSMPrimerData
+  overlap: {
+    length: number
+    temperature: number
+  }
+}
+
 export type SSMMutationData = {
   mutation: string
   result_found: boolean
@@ -133,6 +144,7 @@ export type SSMMutationData = {
     length: number
     temperature: number
   }
+  alternatives?: SSMAlternativeData[]
 }
 
 export type SSMResponseData = {
@@ -15,10 +15,22 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
 import subprocess
 
+# Tags of primer3 outputs of batches read by Mutation Maker (numbers and positions of primers, errors),
+# other tags are left out to keep responses small
+BATCH_OUTPUT_TAG_PATTERN = re.compile(r"PRIMER_(LEFT|RIGHT)_(\d+|NUM_RETURNED)=|PRIMER_ERROR=")
+
 
 def lambda_handler(payload, context):
+    """
+    Designs primers of a Boulder-IO record (string payload) or of a batch of records (list payload).
+    Output of a batch is a list of outputs of its records in their order.
+    """
+    if isinstance(payload, list):
+        return design_batch(payload)
+
     binary = os.path.abspath("primer3_core")
 
     # config_str_template = open("config_string").read()
@@ -39,3 +51,43 @@ def lambda_handler(payload, context):
                                stderr=subprocess.STDOUT)
     out, err = process.communicate()
     return out.decode("ascii")
+
+
+def global_tags(record):
+    return frozenset(line.split("=", 1)[0] for line in record.splitlines()
+                     if "=" in line and not line.startswith("SEQUENCE_"))
+
+
+def design_batch(records):
+    thermo_params_path = os.path.join(os.path.abspath("."), "thermo-params/")
+    records = [f"{record}PRIMER_THERMODYNAMIC_PARAMETERS_PATH={thermo_params_path}\n=\n" for record in records]
+
+    # primer3_core keeps global tags of a record for the following ones,
+    # consecutive records with the same global tags are designed by one process
+    outputs = []
+    start = 0
+    for end in range(1, len(records) + 1):
+        if end == len(records) or global_tags(records[end]) != global_tags(records[start]):
+            outputs.extend(run_primer3(records[start:end]))
+            start = end
+    return outputs
+
+
+def run_primer3(records):
+    process = subprocess.Popen(os.path.abspath("primer3_core"),
+                               stdout=subprocess.PIPE,
+                               stdin=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    out, err = process.communicate("".join(records).encode("ascii"))
+
+    outputs = []
+    lines = []
+    for line in out.decode("ascii").splitlines():
+        if line == "=":
+            outputs.append("".join(f"{line}\n" for line in lines))
+            lines = []
+        elif BATCH_OUTPUT_TAG_PATTERN.match(line):
+            lines.append(line)
+    if len(outputs) != len(records):
+        raise RuntimeError(f"primer3_core designed {len(outputs)} of {len(records)} records: {out[-1000:]}")
+    return outputs